@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Post, Comment, UserProfile
+from .models import Post, Comment, UserProfile, Reaction
 
 # Register your models here.
 
@@ -13,6 +13,11 @@ class PostModelAdmin(admin.ModelAdmin):
 class CommentModelAdmin(admin.ModelAdmin):
     list_display = ('id', 'comment', 'created_on', 'author', 'post')
 
+# Reaction model registration
+@admin.register(Reaction)
+class ReactionModelAdmin(admin.ModelAdmin):
+    list_display = ('id', 'post', 'user', 'value', 'created_on')
+
 # UserProfile model registration
 @admin.register(UserProfile)
 class UserProfileModelAdmin(admin.ModelAdmin):
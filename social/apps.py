@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class SocialConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "social"
+
+    def ready(self):
+        from . import middleware, search
+        post_migrate.connect(search.ensure_triggers, sender=self)
+        middleware.install_template_timer()
@@ -0,0 +1,355 @@
+"""
+Repeatable load benchmark of the social routes
+
+Every named route of social/urls.py is requested through the Django test client against the
+configured database (fill it first with "manage.py generate_fake_data") and the latency
+percentiles and query counts are collected into a JSON friendly dict.
+Two runs can be diffed with compare_runs() to catch regressions.
+run_concurrency_benchmark() compares the throughput of the sync views through the WSGI handler
+with their async versions through the ASGI handler under concurrent load.
+"""
+import asyncio
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.test import AsyncClient, Client, override_settings
+from django.urls import URLPattern, reverse
+from django.utils.http import urlencode
+
+from . import sharding, urls as social_urls
+from .models import Post, Comment, Hashtag, UserProfile
+
+# How each route is driven: url name -> (method, kind of object its url kwargs point at)
+# Delete views are only requested with GET (confirmation page)
+ROUTE_PLANS = {
+    'latest-post-list': ('GET', None),
+    'hot-post-list': ('GET', None),
+    'home-timeline': ('GET', None),
+    'my-post-list': ('GET', None),
+    'post-detail': ('GET', 'post'),
+    'post-comments': ('GET', 'post'),
+    'post-edit': ('GET', 'post'),
+    'post-delete': ('GET', 'post'),
+    'comment-delete': ('GET', 'comment'),
+    'like': ('POST', 'post'),
+    'dislike': ('POST', 'post'),
+    'profile': ('GET', 'profile'),
+    'profile-edit': ('GET', 'profile'),
+    'add-follower': ('POST', 'follow'),
+    'remove-follower': ('POST', 'follow'),
+    'search': ('GET', 'search'),
+    'tag': ('GET', 'tag'),
+    'mentions': ('GET', 'mention'),
+    'error-page': ('GET', None),
+    'request-metrics': ('GET', None),
+    'api-react': ('POST', 'post'),
+    'api-unreact': ('POST', 'post'),
+    'api-follow': ('POST', 'follow'),
+    'api-unfollow': ('POST', 'follow'),
+    'async-latest-post-list': ('GET', None),
+    'async-post-detail': ('GET', 'post'),
+    'async-profile': ('GET', 'profile'),
+}
+
+# Staff only routes, requested by the dedicated BENCHMARK_USERNAME user instead of the dataset's user
+STAFF_ROUTES = {'request-metrics'}
+BENCHMARK_USERNAME = 'benchmark-staff'
+
+# POST data of the routes that need some
+ROUTE_DATA = {
+    'api-react': {'value': 'like'},
+}
+
+# Routes that change data are undone by an unmeasured request, so every iteration sees the same state
+# url name -> ("before"/"after" the measured request, url name of the undoing route)
+PAIRED_ROUTES = {
+    'like': ('after', 'like'),
+    'dislike': ('after', 'dislike'),
+    'add-follower': ('after', 'remove-follower'),
+    'remove-follower': ('before', 'add-follower'),
+    'api-react': ('after', 'api-unreact'),
+    'api-unreact': ('before', 'api-react'),
+    'api-follow': ('after', 'api-unfollow'),
+    'api-unfollow': ('before', 'api-follow'),
+}
+
+
+# sync route -> its async version, compared by run_concurrency_benchmark()
+ASYNC_ROUTES = {
+    'latest-post-list': 'async-latest-post-list',
+    'post-detail': 'async-post-detail',
+    'profile': 'async-profile',
+}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def most_commented_post(**filters):
+    # the posts may be spread over the shards
+    posts = [Post.objects.using(db).filter(**filters).order_by('-comments_count').first() for db in sharding.get_post_dbs()]
+    return max(filter(None, posts), key=lambda post: post.comments_count, default=None)
+
+
+def count_posts():
+    return sum(Post.objects.using(db).count() for db in sharding.get_post_dbs())
+
+
+def pick_fixtures():
+    """
+    The heaviest objects of the dataset: the most followed user (acting as the logged in user),
+    his/her most commented post and a comment on it, another user to follow/unfollow,
+    the most used hashtag, the most mentioned user and a word of the post to search for
+    """
+    profiles = UserProfile.objects.exclude(user__username=BENCHMARK_USERNAME)
+    profile = profiles.annotate(number_of_followers=Count('followers')).order_by('-number_of_followers').first()
+    if profile is None:
+        raise ValueError("The database is empty, run generate_fake_data first")
+    user = profile.user
+    post = most_commented_post(author=user) or most_commented_post()
+    comment = Comment.objects.using(post._state.db).filter(post=post).order_by('-created_on').first() if post else None
+    other = User.objects.exclude(pk=user.pk).exclude(username=BENCHMARK_USERNAME).exclude(followers=user.profile).first()
+    tag = Hashtag.objects.annotate(uses=Count('post_tags')).filter(uses__gt=0).order_by('-uses').first()
+    mentioned = User.objects.annotate(uses=Count('mentions')).filter(uses__gt=0).order_by('-uses').first()
+    words = re.findall(r'[^\W\d_]{4,}', post.body) if post else []
+    return {
+        'user': user, 'post': post, 'comment': comment, 'profile': profile, 'other': other,
+        'tag': tag and tag.name, 'mention': mentioned and mentioned.username, 'query': words[0] if words else None,
+    }
+
+
+def get_staff_user():
+    """
+    The user requesting STAFF_ROUTES, created by the first run so no account of the dataset is ever made staff
+    """
+    user, created = User.objects.get_or_create(username=BENCHMARK_USERNAME, defaults={'is_staff': True})
+    if created:
+        user.set_unusable_password()
+        user.save(update_fields=['password'])
+    elif not user.is_staff:
+        raise ValueError("The user %s exists and isn't staff" % BENCHMARK_USERNAME)
+    return user
+
+
+def build_url(name, kind, fixtures):
+    if kind is None:
+        return reverse(name)
+    if kind == 'post' and fixtures['post']:
+        return reverse(name, kwargs={'pk': fixtures['post'].pk})
+    if kind == 'comment' and fixtures['comment']:
+        return reverse(name, kwargs={'post_pk': fixtures['post'].pk, 'pk': fixtures['comment'].pk})
+    if kind == 'profile':
+        return reverse(name, kwargs={'pk': fixtures['profile'].pk})
+    if kind == 'follow' and fixtures['other']:
+        return reverse(name, kwargs={'pk': fixtures['other'].pk})
+    if kind == 'tag' and fixtures['tag']:
+        return reverse(name, kwargs={'name': fixtures['tag']})
+    if kind == 'mention' and fixtures['mention']:
+        return reverse(name, kwargs={'username': fixtures['mention']})
+    if kind == 'search' and fixtures['query']:
+        return reverse(name) + '?' + urlencode({'q': fixtures['query']})
+    return None
+
+
+class QueryCounter:
+    # execute_wrapper counting every query, unlike connection.queries it has no size limit
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def send(client, method, url, data=None):
+    return client.post(url, data or {}) if method == 'POST' else client.get(url)
+
+
+def get_routes():
+    names = []
+    for pattern in social_urls.urlpatterns:
+        if isinstance(pattern, URLPattern) and pattern.name and pattern.name not in names:
+            names.append(pattern.name)
+    return names
+
+
+def run_benchmark(iterations=20, warmup=2, host='localhost', stdout=None):
+    fixtures = pick_fixtures()
+    client = Client(HTTP_HOST=host)
+    client.force_login(fixtures['user'])
+    staff_client = Client(HTTP_HOST=host)
+    staff_client.force_login(get_staff_user())
+
+    results = {}
+    skipped = []
+    for name in get_routes():
+        plan = ROUTE_PLANS.get(name)
+        url = build_url(name, plan[1], fixtures) if plan else None
+        if url is None:
+            skipped.append(name)
+            continue
+        method = plan[0]
+        route_client = staff_client if name in STAFF_ROUTES else client
+        paired = PAIRED_ROUTES.get(name)
+        if paired:
+            paired_method, paired_kind = ROUTE_PLANS[paired[1]]
+            paired_url = build_url(paired[1], paired_kind, fixtures)
+
+        latencies = []
+        queries = []
+        status = None
+        for i in range(warmup + iterations):
+            if paired and paired[0] == 'before':
+                send(route_client, paired_method, paired_url, ROUTE_DATA.get(paired[1]))
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                response = send(route_client, method, url, ROUTE_DATA.get(name))
+                elapsed = (time.perf_counter() - start) * 1000
+            if paired and paired[0] == 'after':
+                send(route_client, paired_method, paired_url, ROUTE_DATA.get(paired[1]))
+            status = response.status_code
+            if i >= warmup:
+                latencies.append(elapsed)
+                queries.append(counter.count)
+
+        results[name] = {
+            'method': method,
+            'url': url,
+            'status': status,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'queries': int(statistics.median(queries)),
+        }
+        if stdout:
+            stdout.write("%-20s p50 %8.2fms  p95 %8.2fms  queries %d" % (name, results[name]['p50_ms'], results[name]['p95_ms'], results[name]['queries']))
+
+    return {
+        'meta': {
+            'iterations': iterations,
+            'posts': count_posts(),
+            'users': User.objects.exclude(username=BENCHMARK_USERNAME).count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'routes': results,
+        'skipped': skipped,
+    }
+
+
+def compare_runs(baseline, current, threshold=25.0):
+    """
+    Diff two runs, returns (rows, regressions)
+    A route regresses when its p95 grows more than `threshold` percent or it runs more queries
+    """
+    rows = []
+    regressions = []
+    for name, now in current['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            rows.append((name, None, now['p95_ms'], None, now['queries'], None))
+            continue
+        change = (now['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+        rows.append((name, before['p95_ms'], now['p95_ms'], before['queries'], now['queries'], change))
+        if change > threshold or now['queries'] > before['queries']:
+            regressions.append(name)
+    return rows, regressions
+
+
+def summarize_load(latencies, elapsed):
+    return {
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+    }
+
+
+def wsgi_load(url, user, concurrency, requests):
+    """
+    `requests` GETs of `url` through the WSGI handler, `concurrency` threads with a client each
+    """
+    def worker(count):
+        client = Client()
+        client.force_login(user)
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            client.get(url)
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [latency for result in executor.map(worker, counts) for latency in result]
+    return summarize_load(latencies, time.perf_counter() - start)
+
+
+def asgi_load(url, user, concurrency, requests):
+    """
+    `requests` GETs of `url` through the ASGI handler, at most `concurrency` in flight on one event loop
+    """
+    client = AsyncClient()
+    client.force_login(user)
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                await client.get(url)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for i in range(requests)))
+        return summarize_load(latencies, time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+
+def run_concurrency_benchmark(concurrency=16, requests=200, stdout=None):
+    """
+    Throughput of every ASYNC_ROUTES pair: the sync view served by WSGI threads against the
+    async view served by the ASGI handler, both in process so only the serving model differs
+    """
+    fixtures = pick_fixtures()
+    results = {}
+    with override_settings(ALLOWED_HOSTS=['testserver']): # the host the async test client always sends
+        for name, async_name in ASYNC_ROUTES.items():
+            results[name] = compare_serving(name, async_name, fixtures, concurrency, requests)
+            if results[name] and stdout:
+                stdout.write("%-20s wsgi %8.1f req/s  asgi %8.1f req/s" % (name, results[name]['wsgi']['requests_per_s'], results[name]['asgi']['requests_per_s']))
+
+    return {
+        'meta': {
+            'concurrency': concurrency,
+            'requests': requests,
+            'posts': count_posts(),
+            'users': User.objects.count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'routes': {name: result for name, result in results.items() if result},
+    }
+
+
+def compare_serving(name, async_name, fixtures, concurrency, requests):
+    kind = ROUTE_PLANS[name][1]
+    url, async_url = build_url(name, kind, fixtures), build_url(async_name, kind, fixtures)
+    if url is None:
+        return None
+    asgi_load(async_url, fixtures['user'], concurrency, concurrency) # warm up
+    return {
+        'wsgi': wsgi_load(url, fixtures['user'], concurrency, requests),
+        'asgi': asgi_load(async_url, fixtures['user'], concurrency, requests),
+    }
@@ -0,0 +1,132 @@
+"""
+Profile picture pipeline
+
+An uploaded picture is decoded once with Pillow and turned into square WebP avatars of the
+SOCIAL_AVATAR_SIZES sizes, stored as "<thumbnails dir>/<content hash>-<size>.webp".
+Names depend only on the content, so the same picture is never processed twice and the files
+can be cached forever. The work runs after the upload is committed, in a thread pool or as a
+background job (social/jobs.py), until it is done templates keep showing the original picture.
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = 'uploads/profile_pictures/thumbs'
+
+_executor = None
+
+
+class InvalidPicture(ValueError):
+    """
+    The uploaded file isn't an image Pillow can decode, processing it again won't help
+    """
+
+
+def get_avatar_sizes():
+    return sorted(getattr(settings, 'SOCIAL_AVATAR_SIZES', [48, 100, 200]))
+
+
+def thumbnail_name(digest, size):
+    return '%s/%s-%d.webp' % (THUMBNAIL_DIR, digest, size)
+
+
+def thumbnail_url(digest, size):
+    """
+    URL of the smallest avatar at least `size` pixels wide (the largest one if none is)
+    """
+    sizes = get_avatar_sizes()
+    size = next((available for available in sizes if available >= size), sizes[-1])
+    return default_storage.url(thumbnail_name(digest, size))
+
+
+def render_thumbnails(name):
+    """
+    Create the avatars of the picture stored as `name`, returns its content hash
+    Doesn't touch the database, so it can run in a thread or a worker process
+    """
+    from PIL import Image, ImageOps
+
+    with default_storage.open(name, 'rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+
+    sizes = get_avatar_sizes()
+    if all(default_storage.exists(thumbnail_name(digest, size)) for size in sizes):
+        return digest
+
+    # the data is in memory, whatever fails from here to the square image is the picture itself
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft('RGB', (sizes[-1] * 2, sizes[-1] * 2)) # JPEGs are decoded straight at a reduced scale
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        # crop to a square once, then scale down from the largest avatar to the smallest
+        image = ImageOps.fit(image, (sizes[-1], sizes[-1]), Image.LANCZOS)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as error:
+        raise InvalidPicture("%s: %s" % (name, error)) from error
+
+    for size in reversed(sizes):
+        image = image.resize((size, size), Image.LANCZOS) if image.width != size else image
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=getattr(settings, 'SOCIAL_AVATAR_QUALITY', 80), method=4)
+        name = thumbnail_name(digest, size)
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(output.getvalue()))
+    return digest
+
+
+def process_profile_picture(profile_pk):
+    """
+    Create the avatars of a profile and record their hash
+    The hash is only stored if the picture wasn't changed again in the meantime
+    A picture that can't be decoded keeps showing the original, the other errors (storage, database)
+    are raised for the job to be retried
+    """
+    from .models import UserProfile
+
+    try:
+        profile = UserProfile.objects.filter(pk=profile_pk).first()
+        if profile is None or not profile.picture:
+            return
+        name = profile.picture.name
+        try:
+            digest = render_thumbnails(name)
+        except InvalidPicture as error:
+            logger.warning("Could not decode the picture of profile %s: %s", profile_pk, error)
+            return
+        if UserProfile.objects.filter(pk=profile_pk, picture=name).update(picture_hash=digest):
+            UserProfile.bump_version(profile_pk) # post cards show the avatar
+    finally:
+        close_old_connections()
+
+
+def log_failure(future):
+    # the thread pool keeps the exceptions in the futures, nobody else would see them
+    error = future.exception()
+    if error is not None:
+        logger.error("Could not process a profile picture", exc_info=error)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SOCIAL_IMAGE_WORKERS', 2), thread_name_prefix='avatars')
+    return _executor
+
+
+def schedule_profile_picture(profile_pk):
+    # run after the upload is committed, off the request thread
+    from . import jobs
+
+    if jobs.is_inline():
+        transaction.on_commit(lambda: get_executor().submit(process_profile_picture, profile_pk).add_done_callback(log_failure))
+    else:
+        jobs.enqueue('process_profile_picture', profile_pk=profile_pk)
@@ -0,0 +1,256 @@
+"""
+Background jobs stored in the database (the Job table), no broker needed
+
+enqueue() inserts a Job in the current transaction, so a job exists if and only if the data it works
+on was committed. "manage.py run_jobs" runs a pool of worker processes that claim jobs, run them
+and record how long each attempt took. A failed attempt is retried with exponential backoff.
+
+Claiming is a compare-and-set: one "UPDATE ... WHERE id IN (SELECT ... LIMIT n) AND status = queued"
+marks the jobs with a claim token. SQLite runs it under its write lock, so two workers never get the
+same job. Databases that support it use SELECT ... FOR UPDATE SKIP LOCKED instead.
+A claimed job holds a lease (SOCIAL_JOB_LEASE seconds, kept in run_at): the jobs of a worker that died
+are queued again once their lease expires.
+
+With SOCIAL_JOBS_INLINE (the default, nothing else to run) a job runs right after the commit in the
+request, as before. With SOCIAL_JOBS_INLINE=0 the jobs are queued and "run_jobs" must keep running.
+"""
+import datetime
+import logging
+import os
+import random
+import socket
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Avg, Count, F, Max, Subquery
+from django.utils import timezone
+
+from . import sharding
+from .models import Job, Post, TimelineEntry
+from .tags import index_post
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = {}
+
+
+def job(name=None, max_attempts=None):
+    """
+    Register a function as a job, called with the keyword arguments given to enqueue()
+    The arguments are stored as JSON: pass primary keys, not model instances
+    """
+    def register(func):
+        REGISTRY[name or func.__name__] = (func, max_attempts)
+        return func
+    return register
+
+
+def is_inline():
+    return getattr(settings, 'SOCIAL_JOBS_INLINE', True)
+
+
+def enqueue(name, delay=None, **payload):
+    """
+    Queue the job `name`, to run after `delay` (timedelta) if given
+    Inline mode runs it once the current transaction is committed instead
+    """
+    func, max_attempts = REGISTRY[name]
+    if is_inline():
+        transaction.on_commit(lambda: func(**payload))
+        return None
+    return Job.objects.create(
+        name=name,
+        payload=payload,
+        run_at=timezone.now() + (delay or datetime.timedelta()),
+        max_attempts=max_attempts or getattr(settings, 'SOCIAL_JOB_MAX_ATTEMPTS', 5),
+    )
+
+
+def get_lease():
+    return datetime.timedelta(seconds=getattr(settings, 'SOCIAL_JOB_LEASE', 600))
+
+
+def get_backoff(attempts):
+    # 5s, 10s, 20s... (SOCIAL_JOB_BACKOFF) up to an hour, with jitter so failed jobs don't retry in lockstep
+    base = getattr(settings, 'SOCIAL_JOB_BACKOFF', 5)
+    delay = min(base * 2 ** max(attempts - 1, 0), getattr(settings, 'SOCIAL_JOB_MAX_BACKOFF', 3600))
+    return datetime.timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+def new_claim_token():
+    return '%s:%d:%s' % (socket.gethostname()[:60], os.getpid(), uuid.uuid4().hex[:12])
+
+
+def claim(limit=10):
+    """
+    Claim up to `limit` queued jobs that are due, oldest first, and return them
+    """
+    now = timezone.now()
+    token = new_claim_token()
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by('run_at')
+    changes = {'status': Job.RUNNING, 'claimed_by': token, 'run_at': now + get_lease(), 'started_on': now, 'attempts': F('attempts') + 1}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            pks = list(due.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            Job.objects.filter(pk__in=pks).update(**changes)
+    else:
+        # a single statement: the job is still queued when the UPDATE reaches it, or it isn't taken
+        Job.objects.filter(status=Job.QUEUED, pk__in=Subquery(due.values('pk')[:limit])).update(**changes)
+    return list(Job.objects.filter(claimed_by=token, status=Job.RUNNING).order_by('run_at', 'pk'))
+
+
+def run(job):
+    """
+    Run a claimed job and record the outcome: done, queued again with a backoff, or failed
+    Returns True if it succeeded
+    """
+    func, max_attempts = REGISTRY.get(job.name, (None, None))
+    started = time.monotonic()
+    error = None
+    try:
+        if func is None:
+            raise LookupError("Unknown job %r" % job.name)
+        func(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+    duration = time.monotonic() - started
+
+    now = timezone.now()
+    done = {'duration': duration, 'claimed_by': ''}
+    if error is None:
+        done.update(status=Job.DONE, run_at=now, last_error='')
+    elif job.attempts < job.max_attempts:
+        done.update(status=Job.QUEUED, run_at=now + get_backoff(job.attempts), last_error=error)
+    else:
+        done.update(status=Job.FAILED, run_at=now, last_error=error)
+    # only if the lease wasn't lost to another worker in the meantime
+    Job.objects.filter(pk=job.pk, claimed_by=job.claimed_by).update(**done)
+
+    waited = (job.started_on - job.created_on).total_seconds()
+    if error is None:
+        logger.info("%s done in %.3fs (attempt %d, waited %.1fs)", job, duration, job.attempts, waited)
+    else:
+        logger.warning("%s failed in %.3fs (attempt %d of %d):\n%s", job, duration, job.attempts, job.max_attempts, error)
+    return error is None
+
+
+def recover():
+    """
+    Queue again the running jobs whose lease expired (their worker died), fail those out of attempts
+    Also deletes the finished jobs older than SOCIAL_JOB_KEEP_DAYS
+    """
+    now = timezone.now()
+    expired = Job.objects.filter(status=Job.RUNNING, run_at__lt=now)
+    expired.filter(attempts__gte=F('max_attempts')).update(status=Job.FAILED, claimed_by='', last_error='Lease expired')
+    requeued = expired.update(status=Job.QUEUED, claimed_by='', last_error='Lease expired')
+
+    cutoff = now - datetime.timedelta(days=getattr(settings, 'SOCIAL_JOB_KEEP_DAYS', 7))
+    Job.objects.filter(status=Job.DONE, run_at__lt=cutoff).delete()
+    return requeued
+
+
+def work(batch_size=10, burst=False, stop=None):
+    """
+    Worker loop: claim and run jobs until `stop` (a threading/multiprocessing Event) is set,
+    or the queue is empty with burst=True. Returns (jobs done, jobs failed)
+    """
+    poll = getattr(settings, 'SOCIAL_JOB_POLL_INTERVAL', 1.0)
+    succeeded = failed = 0
+    last_recovery = 0
+    while stop is None or not stop.is_set():
+        jobs = []
+        try:
+            if time.monotonic() - last_recovery > poll * 30:
+                recover()
+                last_recovery = time.monotonic()
+            jobs = claim(batch_size)
+            for claimed in jobs:
+                if run(claimed):
+                    succeeded += 1
+                else:
+                    failed += 1
+        except Exception:
+            # e.g. the database is locked for too long: the claimed jobs come back when their lease expires
+            logger.exception("Job worker error")
+        finally:
+            close_old_connections()
+        if not jobs:
+            if burst:
+                break
+            if stop is not None:
+                stop.wait(poll)
+            else:
+                time.sleep(poll)
+    return succeeded, failed
+
+
+def job_stats(since=None):
+    """
+    [(name, status, count, average seconds, max seconds, average seconds waited), ...] of the stored jobs
+    """
+    jobs = Job.objects.all()
+    if since is not None:
+        jobs = jobs.filter(started_on__gte=since)
+    rows = jobs.values('name', 'status').annotate(
+        count=Count('pk'),
+        average=Avg('duration'),
+        longest=Max('duration'),
+        waited=Avg(F('started_on') - F('created_on')),
+    ).order_by('name', 'status')
+    return [
+        (row['name'], dict(Job.STATUS_CHOICES)[row['status']], row['count'], row['average'], row['longest'],
+         row['waited'].total_seconds() if row['waited'] is not None else None)
+        for row in rows
+    ]
+
+
+# Jobs of the social app
+
+@job()
+def process_new_post(post_pk):
+    # copy a new post into the home timelines of the followers, store its hashtags/mentions
+    post = Post.objects.using(sharding.post_db(post_pk)).filter(pk=post_pk).first()
+    if post is not None:
+        TimelineEntry.fan_out(post)
+        index_post(post)
+
+
+@job()
+def reindex_post(post_pk):
+    # hashtags/mentions of an edited post
+    post = Post.objects.using(sharding.post_db(post_pk)).filter(pk=post_pk).first()
+    if post is not None:
+        index_post(post)
+
+
+@job()
+def sync_timeline(owner_pk, author_pk):
+    """
+    After a follow/unfollow: copy the latest posts of the author into the owner's home timeline,
+    or remove them, depending on the follow *now*, so a follow and an unfollow can run in any order
+    """
+    owner = User.objects.filter(pk=owner_pk).first()
+    author = User.objects.filter(pk=author_pk).first()
+    if owner is None or author is None:
+        return
+    if author.profile.followers.filter(pk=owner_pk).exists():
+        TimelineEntry.backfill(owner, author)
+    else:
+        TimelineEntry.prune(owner, author)
+
+
+@job()
+def process_profile_picture(profile_pk):
+    from .images import process_profile_picture as process
+    process(profile_pk)
+
+
+@job()
+def purge_post(post_pk):
+    # comments, reactions and entries of a soft-deleted post, in small batches (see Post.purge)
+    Post.purge(post_pk)
@@ -0,0 +1,181 @@
+"""
+Live "N new posts" notifications of the latest posts page, as Server-Sent Events
+
+latest_posts_events() is a plain ASGI app mounted by twitter_clone/asgi.py on LIVE_PATH, so a
+connection waiting for news holds no thread and no database connection.
+When PostListView.post creates a post, publish_post() hands it to the in-process `broadcaster`,
+which wakes every open connection: the database is queried once when a connection opens
+(posts newer than its ?after=<cursor>) and never while it waits.
+An event only carries the number of posts newer than the cursor of the page, which fetches the
+new cards itself with ?after=<cursor> when the user asks for them (social/live_posts.html).
+
+The broadcaster lives in the process: with several ASGI worker processes a client only hears
+about the posts written through its own worker, until the next time it connects.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+from . import sharding
+from .pagination import decode_cursor
+
+LIVE_PATH = '/live/latest-posts/'
+
+
+class Broadcaster:
+    """
+    Publishes events from any thread to the asyncio connections subscribed in this process
+    The last `size` events are kept so a connection woken late still sees all of them
+    """
+
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def publish(self, event):
+        with self.lock:
+            self.seq += 1
+            self.events.append((self.seq, event))
+            subscribers = list(self.subscribers)
+        for loop, wakeup in subscribers:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def subscribe(self):
+        # (subscription, seq of the last event already published), must be called from the event loop
+        subscription = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            self.subscribers.add(subscription)
+            return subscription, self.seq
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def events_since(self, seq):
+        """
+        ([events published after seq], events dropped because they were too old, last seq)
+        """
+        with self.lock:
+            events = [event for event_seq, event in self.events if event_seq > seq]
+            return events, self.seq - seq - len(events), self.seq
+
+
+broadcaster = Broadcaster()
+
+
+def get_max_count():
+    return getattr(settings, 'SOCIAL_LIVE_MAX_COUNT', 99)
+
+
+def publish_post(post):
+    # tell the open latest posts pages about a new post, once it is committed
+    event = {'pk': post.pk}
+    transaction.on_commit(lambda: broadcaster.publish(event))
+
+
+def newer_posts(position):
+    """
+    (count, highest pk) of the posts newer than the (created_on, id) position, count is capped
+    at get_max_count() + 1: a descending range scan of the (created_on, id) index with a LIMIT
+    """
+    from .models import Post
+
+    try:
+        dbs = sharding.get_post_dbs() # the counts of every shard are added up
+        if position is None:
+            return 0, max(Post.objects.using(db).order_by('-pk').values_list('pk', flat=True).first() or 0 for db in dbs)
+        created_on, pk = position
+        pks = []
+        for db in dbs:
+            pks += (
+                Post.objects.using(db).filter(Q(created_on__gt=created_on) | Q(created_on=created_on, pk__gt=pk))
+                .order_by('-created_on', '-id').values_list('pk', flat=True)[:get_max_count() + 1]
+            )
+        return min(len(pks), get_max_count() + 1), max(pks, default=pk)
+    finally:
+        close_old_connections()
+
+
+def format_event(count, cursor):
+    data = json.dumps({'count': min(count, get_max_count()), 'more': count > get_max_count(), 'since': cursor})
+    return ('event: posts\ndata: %s\n\n' % data).encode()
+
+
+async def latest_posts_events(scope, receive, send):
+    """
+    GET LIVE_PATH?after=<cursor of the newest post on the page> -> text/event-stream of
+    "posts" events {"count": posts newer than the cursor, "more": there are even more, "since": the cursor}
+    """
+    if scope['method'] not in ('GET', 'HEAD'):
+        await send({'type': 'http.response.start', 'status': 405, 'headers': [(b'allow', b'GET, HEAD')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    cursor = (query.get('after') or [None])[0]
+    position = decode_cursor(cursor) if cursor else None
+
+    subscription, seq = broadcaster.subscribe()
+    try:
+        count, highest_pk = await sync_to_async(newer_posts)(position)
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'), # nginx must not buffer the stream
+            ],
+        })
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        if count:
+            await send({'type': 'http.response.body', 'body': format_event(count, cursor), 'more_body': True})
+
+        wakeup = subscription[1]
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        heartbeat = getattr(settings, 'SOCIAL_LIVE_HEARTBEAT', 15)
+        try:
+            while not disconnected.done():
+                woken = asyncio.ensure_future(wakeup.wait())
+                done, pending = await asyncio.wait({woken, disconnected}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if disconnected.done():
+                    break
+                if not done: # keep proxies from closing an idle connection
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                    continue
+
+                wakeup.clear()
+                events, dropped, seq = broadcaster.events_since(seq)
+                # posts already counted by the first query have a pk <= highest_pk
+                new = [event for event in events if event['pk'] > highest_pk]
+                if new or dropped:
+                    count += len(new) + dropped
+                    highest_pk = max([highest_pk] + [event['pk'] for event in new])
+                    await send({'type': 'http.response.body', 'body': format_event(count, cursor), 'more_body': True})
+        finally:
+            disconnected.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        pass # client went away while we were writing
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
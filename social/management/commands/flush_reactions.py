@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from social import reaction_queue
+
+
+class Command(BaseCommand):
+    """
+    Apply the likes/dislikes queued in write-behind mode (SOCIAL_REACTION_WRITE_BEHIND)
+    Drains the queue once (before a deploy, after a crash), or with --watch keeps flushing
+    as a dedicated process, for setups where SOCIAL_REACTION_FLUSH_THREAD is turned off
+    """
+    help = "Apply the queued reactions in batched transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="default SOCIAL_REACTION_FLUSH_BATCH")
+        parser.add_argument('--watch', action='store_true', help="keep flushing new reactions until interrupted")
+
+    def handle(self, *args, **options):
+        interval = getattr(settings, 'SOCIAL_REACTION_FLUSH_INTERVAL', 0.2)
+        flushed = 0
+        while True:
+            count = reaction_queue.flush(options['batch_size'])
+            flushed += count
+            if count:
+                continue
+            if not options['watch']:
+                break
+            close_old_connections()
+            time.sleep(interval)
+        self.stdout.write(self.style.SUCCESS("Applied %d queued reactions" % flushed))
@@ -0,0 +1,165 @@
+import datetime
+import random
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from social import sharding
+from social.models import Post, Comment, UserProfile, UserStats, Reaction, TimelineEntry
+from social.tags import index_new_posts
+
+WORDS = (
+    "django python tweet today coffee weekend music code bug deploy coffee love new day "
+    "great awesome release football movie book travel food night morning rain sun work"
+).split()
+TAGS = ["python", "django", "music", "football", "travel", "food", "news", "tech", "movies", "weekend"]
+
+
+def zipf_weights(n, alpha):
+    # weight of the item of rank r is 1/r^alpha -> few very popular items, long tail of quiet ones
+    return [1.0 / (rank ** alpha) for rank in range(1, n + 1)]
+
+
+class Command(BaseCommand):
+    """
+    Fill the database with a synthetic, production-like dataset:
+    followers and post authorship follow a power law (a few celebrities, many quiet users),
+    likes and comments go mostly to a small set of hot posts.
+    Everything is inserted with bulk_create, then the denormalized counters, user stats and hot scores are recomputed.
+    Every generated user can log in with the password given by --password.
+    """
+    help = "Bulk-generate users, posts, comments, follows and reactions with realistic skew"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=10000)
+        parser.add_argument('--comments', type=int, default=20000)
+        parser.add_argument('--reactions', type=int, default=50000)
+        parser.add_argument('--follows-per-user', type=int, default=20, help="average number of accounts each user follows")
+        parser.add_argument('--days', type=int, default=90, help="posts are spread over the last N days")
+        parser.add_argument('--alpha', type=float, default=1.1, help="power-law exponent of the popularity skew")
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--password', default='admin@123')
+        parser.add_argument('--prefix', default='fake_user_')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        alpha = options['alpha']
+
+        users = self.create_users(options['users'], options['prefix'], options['password'])
+        user_ids = [user.pk for user in users]
+        self.rng.shuffle(user_ids) # popularity rank is independent of the signup order
+        user_weights = zipf_weights(len(user_ids), alpha)
+
+        follows = self.create_follows(user_ids, user_weights, options['follows_per_user'])
+        post_ids = self.create_posts(options['posts'], user_ids, user_weights, options['days'])
+
+        hot_post_ids = list(post_ids)
+        self.rng.shuffle(hot_post_ids)
+        post_weights = zipf_weights(len(hot_post_ids), alpha)
+        self.create_comments(options['comments'], hot_post_ids, post_weights, user_ids)
+        self.create_reactions(options['reactions'], hot_post_ids, post_weights, user_ids)
+        self.create_timelines(follows)
+
+        if sharding.is_enabled(): # generated on "default", like the posts from before sharding
+            call_command('reshard_posts', batch_size=self.batch_size, stdout=self.stdout)
+        call_command('reconcile_post_counters', batch_size=self.batch_size, stdout=self.stdout)
+        call_command('reconcile_user_stats', chunk_size=self.batch_size, stdout=self.stdout)
+        call_command('rescore_hot_posts', batch_size=self.batch_size, stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS("Generated %d users, %d follows, %d posts" % (len(users), len(follows), len(post_ids))))
+
+    def bulk_create(self, model, objs, **kwargs):
+        with transaction.atomic():
+            return model.objects.bulk_create(objs, batch_size=self.batch_size, **kwargs)
+
+    def sentence(self):
+        words = self.rng.choices(WORDS, k=self.rng.randint(5, 25))
+        if self.rng.random() < 0.3:
+            words.append("#" + self.rng.choice(TAGS))
+        return " ".join(words)
+
+    def create_users(self, count, prefix, password):
+        password = make_password(password) # hashing is slow, every fake user shares the same hash
+        start = User.objects.filter(username__startswith=prefix).count()
+        users = self.bulk_create(User, [
+            User(username="%s%d" % (prefix, start + i), email="%s%d@example.com" % (prefix, start + i), password=password)
+            for i in range(count)
+        ])
+        if not users or users[0].pk is None: # backends that don't return ids from bulk_create
+            users = list(User.objects.filter(username__startswith=prefix).order_by('-pk')[:count])
+        self.bulk_create(UserProfile, [UserProfile(user_id=user.pk) for user in users], ignore_conflicts=True)
+        self.bulk_create(UserStats, [UserStats(user_id=user.pk) for user in users], ignore_conflicts=True) # counted by reconcile_user_stats
+        self.stdout.write("Created %d users" % len(users))
+        return users
+
+    def create_follows(self, user_ids, user_weights, follows_per_user):
+        Follow = UserProfile.followers.through
+        follows = set()
+        for follower_id in user_ids:
+            # number of accounts followed is itself skewed, most users follow a few, some follow many
+            count = min(len(user_ids) - 1, int(self.rng.expovariate(1.0 / follows_per_user)) + 1)
+            for followed_id in self.rng.choices(user_ids, weights=user_weights, k=count):
+                if followed_id != follower_id:
+                    follows.add((followed_id, follower_id))
+        self.bulk_create(Follow, [Follow(userprofile_id=followed_id, user_id=follower_id) for followed_id, follower_id in follows], ignore_conflicts=True)
+        self.stdout.write("Created %d follows" % len(follows))
+        return follows
+
+    def create_posts(self, count, user_ids, user_weights, days):
+        now = timezone.now()
+        authors = self.rng.choices(user_ids, weights=user_weights, k=count)
+        created = sorted(now - datetime.timedelta(seconds=self.rng.uniform(0, days * 86400)) for i in range(count))
+        posts = self.bulk_create(Post, [
+            Post(body=self.sentence(), author_id=author_id, created_on=created_on)
+            for author_id, created_on in zip(authors, created)
+        ])
+        for i in range(0, len(posts), self.batch_size):
+            index_new_posts(posts[i:i + self.batch_size])
+        self.stdout.write("Created %d posts" % len(posts))
+        return [post.pk for post in posts]
+
+    def create_comments(self, count, post_ids, post_weights, user_ids):
+        now = timezone.now()
+        comments = [
+            Comment(comment=self.sentence(), post_id=post_id, author_id=self.rng.choice(user_ids),
+                    created_on=now - datetime.timedelta(seconds=self.rng.uniform(0, 86400)))
+            for post_id in self.rng.choices(post_ids, weights=post_weights, k=count)
+        ] if post_ids else []
+        self.bulk_create(Comment, comments)
+        self.stdout.write("Created %d comments" % len(comments))
+
+    def create_reactions(self, count, post_ids, post_weights, user_ids):
+        reactions = {}
+        if post_ids:
+            for post_id in self.rng.choices(post_ids, weights=post_weights, k=count):
+                value = Reaction.LIKE if self.rng.random() < 0.8 else Reaction.DISLIKE
+                reactions[(post_id, self.rng.choice(user_ids))] = value
+        self.bulk_create(Reaction, [
+            Reaction(post_id=post_id, user_id=user_id, value=value) for (post_id, user_id), value in reactions.items()
+        ], ignore_conflicts=True)
+        self.stdout.write("Created %d reactions" % len(reactions))
+
+    def create_timelines(self, follows):
+        # Same result as fanning out every post on write, skipping celebrity authors
+        followers = {}
+        for followed_id, follower_id in follows:
+            followers.setdefault(followed_id, []).append(follower_id)
+
+        entries = []
+        for author_id, follower_ids in followers.items():
+            if len(follower_ids) > settings.SOCIAL_FANOUT_LIMIT:
+                continue
+            posts = Post.objects.filter(author_id=author_id).values_list('pk', 'created_on')
+            for pk, created_on in posts.iterator():
+                entries.extend(TimelineEntry(owner_id=owner_id, post_id=pk, created_on=created_on) for owner_id in follower_ids)
+            if len(entries) >= self.batch_size * 10:
+                self.bulk_create(TimelineEntry, entries, ignore_conflicts=True)
+                entries = []
+        self.bulk_create(TimelineEntry, entries, ignore_conflicts=True)
+        self.stdout.write("Materialized home timelines")
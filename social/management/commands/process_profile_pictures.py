@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from social.images import InvalidPicture, render_thumbnails
+from social.models import UserProfile
+
+
+def _setup_worker():
+    # worker processes started with "spawn" don't inherit the configured Django
+    django.setup()
+
+
+class Command(BaseCommand):
+    """
+    Create the avatars of the profile pictures that don't have them yet (or of all of them with --all)
+    Each distinct picture file is processed once, in a pool of worker processes
+    """
+    help = "Backfill the pre-sized WebP avatars of the existing profile pictures in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--all', action='store_true', help="process pictures that already have avatars too")
+
+    def handle(self, *args, **options):
+        profiles = UserProfile.objects.exclude(picture='')
+        if not options['all']:
+            profiles = profiles.filter(picture_hash='')
+        names = list(profiles.values_list('picture', flat=True).distinct())
+        if not names:
+            self.stdout.write("Nothing to process")
+            return
+
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_setup_worker) as executor:
+            futures = {executor.submit(render_thumbnails, name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    digest = future.result()
+                except (InvalidPicture, OSError) as error: # not an image, or a missing file
+                    failed += 1
+                    self.stderr.write("%s: %s" % (name, error))
+                    continue
+                authors = UserProfile.objects.filter(picture=name).exclude(picture_hash=digest)
+                author_ids = list(authors.values_list('pk', flat=True))
+                authors.update(picture_hash=digest)
+                UserProfile.bump_version(*author_ids) # post cards show the avatar
+                done += 1
+
+        self.stdout.write(self.style.SUCCESS("Processed %d pictures, %d failed" % (done, failed)))
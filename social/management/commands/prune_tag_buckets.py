@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from social.tags import prune_tag_buckets
+
+
+class Command(BaseCommand):
+    """
+    Delete the trending tags counters older than SOCIAL_TRENDING_WINDOW_HOURS (social/tags.py)
+    They are never read again, run it from cron every hour or so
+    """
+    help = "Delete the hourly tag counters that left the trending window, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = prune_tag_buckets(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Deleted %d tag buckets" % deleted))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from social import sharding
+from social.models import Post
+
+
+class Command(BaseCommand):
+    """
+    Purge every soft-deleted post (Post.deleted_on set) with its comments, reactions and entries
+    The "purge_post" job does it after each delete, this command catches the posts whose job failed or was lost
+    Every statement deletes at most --batch-size rows, so it can run while the site is up
+    """
+    help = "Delete the soft-deleted posts with their comments and reactions, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        purged = 0
+        for db in sharding.get_post_dbs():
+            # a short list, read through the partial index of the deleted posts
+            pks = list(Post.all_objects.using(db).filter(deleted_on__isnull=False).values_list('pk', flat=True))
+            for pk in pks:
+                if Post.purge(pk, batch_size=options['batch_size']):
+                    purged += 1
+
+        self.stdout.write(self.style.SUCCESS("Purged %d deleted posts" % purged))
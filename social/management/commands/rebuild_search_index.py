@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from social import search, sharding
+
+NEW_TABLE = search.SEARCH_TABLE + '_new'
+
+
+class Command(BaseCommand):
+    """
+    Build the full-text index of all posts and comments again, next to the live one, and swap them
+    Rows are copied in id order, one batch (and one transaction) at a time, so writers are never blocked for long;
+    meanwhile the searches use the old index and the writes reach both through a second set of triggers.
+    The swap is a single transaction: a search never sees an empty or half built index
+    With sharded posts every shard has its own index, they are rebuilt one after the other
+    """
+    help = "Re-index post bodies and comments into the FTS5 search table in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError("Full-text search needs SQLite FTS5, nothing to rebuild on %s" % connection.vendor)
+
+        for db in sharding.get_post_dbs():
+            self.rebuild(db or DEFAULT_DB_ALIAS, options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
+
+    def rebuild(self, using, batch_size):
+        with connections[using].cursor() as cursor:
+            with transaction.atomic(using=using):
+                # whatever an interrupted rebuild left behind first
+                self.run_sql(cursor, search.get_drop_triggers_sql('search_new') + ["DROP TABLE IF EXISTS %s" % NEW_TABLE])
+                self.run_sql(cursor, [search.CREATE_INDEX_SQL % NEW_TABLE] + search.get_triggers_sql(NEW_TABLE, 'search_new'))
+
+            for table, rowid, post_id, column in search.INDEXED_SOURCES:
+                last_id = 0
+                batches = 0
+                while last_id is not None:
+                    with transaction.atomic(using=using):
+                        last_id = search.index_batch(cursor, table, last_id, batch_size, index_table=NEW_TABLE)
+                    batches += 1
+                self.stdout.write("Indexed %s of %s in %d batches" % (table, using, batches))
+
+            # merge the b-trees written batch by batch into one, for faster queries
+            cursor.execute("INSERT INTO %s(%s) VALUES ('optimize')" % (NEW_TABLE, NEW_TABLE))
+
+            with transaction.atomic(using=using):
+                # no trigger may point to a missing table while it is renamed
+                self.run_sql(cursor, search.get_drop_triggers_sql('search_new') + search.get_drop_triggers_sql())
+                self.run_sql(cursor, [
+                    "DROP TABLE %s" % search.SEARCH_TABLE,
+                    "ALTER TABLE %s RENAME TO %s" % (NEW_TABLE, search.SEARCH_TABLE),
+                ])
+                self.run_sql(cursor, search.TRIGGERS_SQL)
+
+    def run_sql(self, cursor, statements):
+        for sql in statements:
+            cursor.execute(sql)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+from social import sharding
+from social.models import Post, Reaction
+
+
+class Command(BaseCommand):
+    """
+    Recount likes/dislikes/comments of every post and fix the denormalized counters that drifted
+    Posts are walked in id order, one batch (and one transaction) at a time
+    """
+    help = "Recompute Post.likes_count/dislikes_count/comments_count in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        checked = fixed = 0
+        for db in sharding.get_post_dbs(): # each shard holds the reactions and comments of its posts
+            counts = self.reconcile(Post.objects.using(db), db, options['batch_size'])
+            checked, fixed = checked + counts[0], fixed + counts[1]
+
+        self.stdout.write(self.style.SUCCESS("Checked %d posts, fixed %d drifted counters" % (checked, fixed)))
+
+    def reconcile(self, posts, db, batch_size):
+        last_pk = 0
+        checked = fixed = 0
+
+        while True:
+            pks = list(posts.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+
+            with transaction.atomic(using=db):
+                batch = posts.filter(pk__in=pks).annotate(
+                    real_likes=Count('reactions', filter=Q(reactions__value=Reaction.LIKE), distinct=True),
+                    real_dislikes=Count('reactions', filter=Q(reactions__value=Reaction.DISLIKE), distinct=True),
+                    real_comments=Count('comment', distinct=True),
+                ).only('likes_count', 'dislikes_count', 'comments_count', 'created_on')
+
+                drifted = []
+                for post in batch:
+                    if (post.likes_count, post.dislikes_count, post.comments_count) != (post.real_likes, post.real_dislikes, post.real_comments):
+                        post.likes_count = post.real_likes
+                        post.dislikes_count = post.real_dislikes
+                        post.comments_count = post.real_comments
+                        post.hot_score = post.compute_hot_score()
+                        drifted.append(post)
+                posts.bulk_update(drifted, ['likes_count', 'dislikes_count', 'comments_count', 'hot_score'])
+
+            checked += len(pks)
+            fixed += len(drifted)
+        return checked, fixed
@@ -0,0 +1,80 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from social.models import UserStats
+
+
+def _setup_worker():
+    # worker processes started with "spawn" don't inherit the configured Django
+    django.setup()
+
+
+def reconcile_chunk(first_pk, last_pk, fix=True):
+    """
+    Recompute the stats of the users with first_pk <= pk <= last_pk
+    Returns (users checked, [(user pk, field, stored value, real value), ...])
+    """
+    real = UserStats.compute(first_pk, last_pk)
+    drift = []
+    with transaction.atomic():
+        stored = {stats.pk: stats for stats in UserStats.objects.filter(pk__gte=first_pk, pk__lte=last_pk)}
+        missing = [UserStats(user_id=pk, **counts) for pk, counts in real.items() if pk not in stored]
+        drifted = []
+        for pk, counts in real.items():
+            stats = stored.get(pk)
+            if stats is None:
+                drift.extend((pk, field, None, value) for field, value in counts.items())
+                continue
+            changed = [(field, getattr(stats, field), value) for field, value in counts.items() if getattr(stats, field) != value]
+            if changed:
+                drift.extend((pk, field, before, after) for field, before, after in changed)
+                for field, before, after in changed:
+                    setattr(stats, field, after)
+                drifted.append(stats)
+        if fix:
+            UserStats.objects.bulk_create(missing, ignore_conflicts=True)
+            UserStats.objects.bulk_update(drifted, UserStats.COUNTER_FIELDS)
+    return len(real), drift
+
+
+class Command(BaseCommand):
+    """
+    Recount posts/comments/followers/following/likes received of every user and fix the UserStats that drifted
+    Users are split into chunks of consecutive ids, recomputed by a pool of worker processes
+    with one grouped query per counter and chunk. The drift is reported per counter, and per user with -v 2
+    """
+    help = "Recompute UserStats in parallel chunks and report any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=4, help="1 to run in this process")
+        parser.add_argument('--dry-run', action='store_true', help="only report the drift")
+
+    def handle(self, *args, **options):
+        pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        size = options['chunk_size']
+        chunks = [(pks[i], pks[min(i + size, len(pks)) - 1]) for i in range(0, len(pks), size)]
+        fix = not options['dry_run']
+
+        if options['workers'] > 1 and len(chunks) > 1:
+            connections.close_all() # forked workers must not share this process' connections
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_setup_worker) as executor:
+                results = list(executor.map(reconcile_chunk, *zip(*chunks), [fix] * len(chunks)))
+        else:
+            results = [reconcile_chunk(first_pk, last_pk, fix) for first_pk, last_pk in chunks]
+
+        checked = sum(count for count, drift in results)
+        drift = [row for count, drift in results for row in drift]
+        per_field = {}
+        for pk, field, before, after in drift:
+            per_field[field] = per_field.get(field, 0) + 1
+            if options['verbosity'] > 1:
+                self.stdout.write("user %d %s: %s -> %d" % (pk, field, '(missing)' if before is None else before, after))
+        for field, count in sorted(per_field.items()):
+            self.stdout.write("%-16s %d drifted" % (field, count))
+        self.stdout.write(self.style.SUCCESS("Checked %d users, %d drifted values %s" % (
+            checked, len(drift), "reported" if options['dry_run'] else "fixed"
+        )))
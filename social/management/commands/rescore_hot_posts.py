@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from social import sharding
+from social.models import Post
+
+
+class Command(BaseCommand):
+    """
+    Recompute Post.hot_score from the counters (see social/ranking.py)
+    The scores are moved incrementally on every reaction/comment, this periodic pass removes the
+    float drift of the increments and applies a changed SOCIAL_HOT_HALF_LIFE_HOURS/SOCIAL_HOT_COMMENT_WEIGHT.
+    Posts are walked in id order, one batch (and one transaction) at a time, only changed scores are written
+    """
+    help = "Recompute Post.hot_score in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--tolerance', type=float, default=1e-9, help="scores closer than this to the real one are left alone")
+
+    def handle(self, *args, **options):
+        checked = fixed = 0
+        for db in sharding.get_post_dbs():
+            counts = self.rescore(Post.objects.using(db), db, options['batch_size'], options['tolerance'])
+            checked, fixed = checked + counts[0], fixed + counts[1]
+
+        self.stdout.write(self.style.SUCCESS("Checked %d posts, rescored %d" % (checked, fixed)))
+
+    def rescore(self, posts, db, batch_size, tolerance):
+        last_pk = 0
+        checked = fixed = 0
+
+        while True:
+            with transaction.atomic(using=db):
+                batch = list(posts.filter(pk__gt=last_pk).order_by('pk').only(
+                    'likes_count', 'dislikes_count', 'comments_count', 'created_on', 'hot_score'
+                )[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+
+                drifted = []
+                for post in batch:
+                    score = post.compute_hot_score()
+                    if abs(post.hot_score - score) > tolerance:
+                        post.hot_score = score
+                        drifted.append(post)
+                posts.bulk_update(drifted, ['hot_score'])
+
+            checked += len(batch)
+            fixed += len(drifted)
+        return checked, fixed
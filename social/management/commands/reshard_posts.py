@@ -0,0 +1,93 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from social import sharding
+from social.models import Post, Comment, Reaction, UserProfile
+
+
+class Command(BaseCommand):
+    """
+    Move the posts, with their comments and reactions, to the shard of their author (social/sharding.py)
+    Run it once SOCIAL_POST_SHARDS is set (the posts are still on "default") and after adding shards
+    (whole slots move). Users and profiles are copied to the shards first.
+    Every batch is copied to its new shard, then deleted from the old one: the command can be
+    interrupted and run again, a post found on two shards meanwhile shows once in the feeds.
+    The new shard of the moved posts from before sharding (small ids) is recorded in the cache
+    read by sharding.post_db(), which must be shared by every process.
+    """
+    help = "Move posts, comments and reactions to the shard of their author, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError("SOCIAL_POST_SHARDS is empty, there is nothing to move the posts to")
+        batch_size = options['batch_size']
+
+        copied = self.copy_users(batch_size)
+        self.stdout.write("Copied %d users to the shards" % copied)
+
+        moved = 0
+        for source in dict.fromkeys([DEFAULT_DB_ALIAS] + sharding.get_shards()):
+            count = self.move_posts(source, batch_size)
+            if count:
+                self.stdout.write("Moved %d posts away from %s" % (count, source))
+            moved += count
+        self.stdout.write(self.style.SUCCESS("Moved %d posts to the shard of their author" % moved))
+
+    def copy_users(self, batch_size):
+        last_pk = 0
+        copied = 0
+        while True:
+            users = list(User.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not users:
+                return copied
+            last_pk = users[-1].pk
+            profiles = UserProfile.objects.filter(pk__in=[user.pk for user in users])
+            sharding.copy_users(users, list(profiles))
+            copied += len(users)
+
+    def move_posts(self, source, batch_size):
+        """
+        Walk the posts of `source` in id order and move the ones whose author belongs to another shard
+        """
+        last_pk = 0
+        moved = 0
+        while True:
+            posts = list(Post.all_objects.using(source).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not posts:
+                return moved
+            last_pk = posts[-1].pk
+
+            targets = {}
+            for post in posts:
+                target = sharding.author_db(post.author_id)
+                if target != source:
+                    targets.setdefault(target, []).append(post)
+            for target, group in targets.items():
+                self.move(group, source, target)
+                moved += len(group)
+
+    def move(self, posts, source, target):
+        pks = [post.pk for post in posts]
+        comments = list(Comment.objects.using(source).filter(post_id__in=pks))
+        reactions = list(Reaction.objects.using(source).filter(post_id__in=pks))
+        for reaction in reactions:
+            reaction.pk = None # reaction ids are per database, a reaction is known by its (post, user)
+
+        # no signals on either side: the rows move, the counters and user stats stay as they are
+        with transaction.atomic(using=target):
+            # copies left by an interrupted run are replaced
+            Reaction.objects.using(target).filter(post_id__in=pks)._raw_delete(target)
+            Comment.objects.using(target).filter(post_id__in=pks)._raw_delete(target)
+            Post.all_objects.using(target).filter(pk__in=pks)._raw_delete(target)
+            Post.all_objects.using(target).bulk_create(posts)
+            Comment.objects.using(target).bulk_create(comments)
+            Reaction.objects.using(target).bulk_create(reactions)
+        sharding.record_legacy_locations(pks, target) # before they are gone from the source
+
+        with transaction.atomic(using=source):
+            Reaction.objects.using(source).filter(post_id__in=pks)._raw_delete(source)
+            Comment.objects.using(source).filter(post_id__in=pks)._raw_delete(source)
+            Post.all_objects.using(source).filter(pk__in=pks)._raw_delete(source)
@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from social.benchmark import run_benchmark, run_concurrency_benchmark, compare_runs
+
+
+class Command(BaseCommand):
+    """
+    Drive every route of social/urls.py through the test client and report
+    p50/p95/p99 latency and query counts as JSON
+    With --compare the run is diffed against an earlier JSON report and the command
+    fails when a route got slower than --threshold percent (p95) or runs more queries
+    With --concurrency the sync (WSGI) and async (ASGI) versions of the feed, post detail and
+    profile pages are compared under that many concurrent requests instead
+    """
+    help = "Benchmark the social routes, optionally diffing against a previous run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--output', help="write the JSON report to this file")
+        parser.add_argument('--compare', help="JSON report of an earlier run to diff against")
+        parser.add_argument('--threshold', type=float, default=25.0, help="allowed p95 slowdown in percent")
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--concurrency', type=int, help="compare WSGI and ASGI throughput with this many concurrent requests")
+        parser.add_argument('--requests', type=int, default=200, help="requests per route and server with --concurrency")
+
+    def handle(self, *args, **options):
+        try:
+            if options['concurrency']:
+                report = run_concurrency_benchmark(options['concurrency'], options['requests'], stdout=self.stderr)
+            else:
+                report = run_benchmark(options['iterations'], options['warmup'], options['host'], stdout=self.stderr)
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+        if options['compare'] and not options['concurrency']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            rows, regressions = compare_runs(baseline, report, options['threshold'])
+            self.stderr.write("%-20s %12s %12s %8s %8s %9s" % ('route', 'p95 before', 'p95 now', 'q before', 'q now', 'change'))
+            for name, p95_before, p95_now, queries_before, queries_now, change in rows:
+                self.stderr.write("%-20s %12s %12.2f %8s %8d %9s" % (
+                    name,
+                    '-' if p95_before is None else '%.2f' % p95_before,
+                    p95_now,
+                    '-' if queries_before is None else queries_before,
+                    queries_now,
+                    '-' if change is None else '%+.1f%%' % change,
+                ))
+            if regressions:
+                raise CommandError("Regressions in: %s" % ", ".join(regressions))
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import signal
+import sys
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from social import jobs
+
+
+def _worker(index, batch_size, burst, verbosity, stop, results):
+    # worker processes started with "spawn" don't inherit the configured Django
+    django.setup()
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent stops the pool, a job is never cut in half
+    if verbosity > 1:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('[worker %d] %%(message)s' % index))
+        jobs.logger.addHandler(handler)
+        jobs.logger.setLevel(logging.INFO)
+    results.put(jobs.work(batch_size=batch_size, burst=burst, stop=stop))
+
+
+class Command(BaseCommand):
+    """
+    Run the background jobs of social/jobs.py with a pool of worker processes
+    Every worker claims a few due jobs at a time, runs them and records their duration;
+    failures are retried with exponential backoff. Stops on Ctrl-C/SIGTERM once the running jobs
+    are finished, or by itself when the queue is empty with --burst. Each job is logged with -v 2,
+    and the time spent per job name is reported at the end
+    """
+    help = "Run the queued background jobs with a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None, help="default SOCIAL_JOB_WORKERS")
+        parser.add_argument('--batch-size', type=int, default=10, help="jobs claimed at a time by a worker")
+        parser.add_argument('--burst', action='store_true', help="exit once there are no jobs left")
+        parser.add_argument('--stats', action='store_true', help="only print the timings of the stored jobs")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.print_stats()
+            return
+
+        started = timezone.now()
+        processes = options['processes'] or getattr(settings, 'SOCIAL_JOB_WORKERS', 2)
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        connections.close_all() # forked workers must not share this process' connections
+        pool = [
+            multiprocessing.Process(
+                target=_worker, name='job-worker-%d' % i,
+                args=(i, options['batch_size'], options['burst'], options['verbosity'], stop, results),
+            )
+            for i in range(processes)
+        ]
+        for process in pool:
+            process.start()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            for process in pool:
+                while process.is_alive():
+                    process.join(0.5)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, waiting for the running jobs...")
+            stop.set()
+            for process in pool:
+                process.join()
+
+        succeeded = failed = 0
+        while not results.empty():
+            done, errors = results.get()
+            succeeded += done
+            failed += errors
+        self.print_stats(since=started)
+        self.stdout.write(self.style.SUCCESS("%d workers ran %d jobs, %d failed attempts" % (processes, succeeded + failed, failed)))
+
+    def print_stats(self, since=None):
+        for name, status, count, average, longest, waited in jobs.job_stats(since):
+            self.stdout.write("%-24s %-8s %6d jobs  avg %8.3fs  max %8.3fs  waited %8.1fs" % (
+                name, status, count, average or 0, longest or 0, waited or 0,
+            ))
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from social import stamps
+
+
+class Command(BaseCommand):
+    """
+    Local stand-in for replication: copy the primary SQLite database onto the replica file
+    (SOCIAL_REPLICA_PATH). The copy is an online backup written next to the replica and moved
+    over it, so readers of the replica see either the old or the new snapshot, never half of one.
+    With --interval it keeps copying, the interval is the replication lag the sticky cookie must cover
+    After each copy the replica position is stored for the ETags of the replica pages (social/stamps.py)
+    """
+    help = "Copy the primary database to the read replica"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None, help="copy again every N seconds until interrupted")
+
+    def handle(self, *args, **options):
+        alias = getattr(settings, 'SOCIAL_READ_REPLICA', None)
+        if not alias:
+            raise CommandError("No read replica configured, set SOCIAL_REPLICA_PATH")
+        primary, replica = settings.DATABASES['default'], settings.DATABASES[alias]
+        if not (primary['ENGINE'].endswith('sqlite3') and replica['ENGINE'].endswith('sqlite3')):
+            raise CommandError("sync_replica only copies SQLite databases, use the replication of your database server")
+
+        while True:
+            start, position = time.perf_counter(), time.time()
+            self.copy(str(primary['NAME']), str(replica['NAME']))
+            connections[alias].close() # reopen on the new file
+            stamps.set_replica_position(position) # the copy holds every write committed before it started
+            self.stdout.write(self.style.SUCCESS("Copied the primary to %s in %.3fs" % (replica['NAME'], time.perf_counter() - start)))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def copy(self, source_path, replica_path):
+        temporary = replica_path + '.tmp'
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(temporary)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        os.replace(temporary, replica_path)
@@ -0,0 +1,146 @@
+"""
+Media files serving
+
+serve_media() serves the files of MEDIA_ROOT without reading them through Python:
+- a strong ETag from the content hash (computed once per path/mtime/size) answers
+  If-None-Match / If-Modified-Since with 304 Not Modified
+- "Range: bytes=..." requests get a 206 Partial Content with only the asked bytes
+- the content-hashed avatars (social/images.py) never change and are sent with a one year
+  "immutable" Cache-Control, other uploads with SOCIAL_MEDIA_MAX_AGE
+- full responses are a FileResponse, so the WSGI server can use its file_wrapper (sendfile),
+  with SOCIAL_MEDIA_ACCEL_REDIRECT the body is left to nginx (X-Accel-Redirect)
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_safe
+
+from .images import THUMBNAIL_DIR
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+HASHED_NAME_RE = re.compile(r'^%s/(?P<digest>[0-9a-f]{32}-\d+)\.webp$' % re.escape(THUMBNAIL_DIR))
+RANGE_RE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+@lru_cache(maxsize=4096)
+def content_hash(path, mtime_ns, size):
+    # mtime and size are part of the cache key, a replaced file gets hashed again
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def get_etag(name, path, stat):
+    match = HASHED_NAME_RE.match(name)
+    if match: # the name already is the content hash
+        return quote_etag(match.group('digest'))
+    return quote_etag(content_hash(path, stat.st_mtime_ns, stat.st_size))
+
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive byte range of a single range "Range" header, None to send the whole
+    file (missing, malformed or multiple ranges), False if it can't be satisfied
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or not (match.group('start') or match.group('end')):
+        return None
+    if match.group('start'):
+        start = int(match.group('start'))
+        end = min(int(match.group('end')), size - 1) if match.group('end') else size - 1
+    else: # "bytes=-500" -> last 500 bytes
+        start = max(size - int(match.group('end')), 0)
+        end = size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Not found")
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404("Not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Not found")
+
+    name = path.replace(os.sep, '/')
+    etag = get_etag(name, full_path, stat)
+    last_modified = http_date(stat.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if HASHED_NAME_RE.match(name) else 'public, max-age=%d' % getattr(settings, 'SOCIAL_MEDIA_MAX_AGE', 3600),
+        'Accept-Ranges': 'bytes',
+    }
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    if (if_none_match and etag_matches(if_none_match, etag)) or (
+        not if_none_match and if_modified_since and int(stat.st_mtime) <= if_modified_since
+    ):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if (not if_range or if_range.strip() in (etag, last_modified)):
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(full_path, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        response['Content-Length'] = end - start + 1
+    elif getattr(settings, 'SOCIAL_MEDIA_ACCEL_REDIRECT', None):
+        # nginx sends the file itself from its internal location
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.SOCIAL_MEDIA_ACCEL_REDIRECT.rstrip('/') + '/' + name
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        response['Content-Length'] = stat.st_size
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
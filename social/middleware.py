@@ -0,0 +1,205 @@
+"""
+Request timing middleware
+
+For every request it records the number of SQL queries, the DB time, the template render time
+and the total view time, sends them back in a "Server-Timing" header and keeps the last
+SOCIAL_TIMING_WINDOW samples of each url name (e.g. "latest-post-list") in memory.
+SOCIAL_QUERY_BUDGETS = {"<url name>": <max queries>} declares a query budget per url name,
+with SOCIAL_QUERY_BUDGET_STRICT = True (tests/CI) a request over its budget raises QueryBudgetExceeded.
+It works for sync and async views alike, so it doesn't force ASGI requests back into a thread.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import Template as DjangoTemplate
+
+logger = logging.getLogger(__name__)
+
+_current_timing = contextvars.ContextVar('social_request_timing', default=None)
+
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestTiming:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.view_time = 0.0
+
+
+def _time_query(execute, sql, params, many, context):
+    timing = _current_timing.get()
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if timing is not None:
+            timing.queries += 1
+            timing.db_time += time.perf_counter() - start
+
+
+def _install_query_timer():
+    # Connections are per thread, and async views query from a worker thread, so the wrapper is added to the
+    # connections of the thread running the queries. It does nothing outside of a request, so it stays installed.
+    for alias in connections:
+        wrappers = connections[alias].execute_wrappers
+        if _time_query not in wrappers:
+            wrappers.append(_time_query)
+
+
+_original_template_render = DjangoTemplate.render
+
+
+def _timed_template_render(self, context=None, request=None):
+    # Templates rendered from inside another template (e.g. crispy forms) are already part of the outer render
+    timing = _current_timing.get()
+    if timing is None or timing.template_depth:
+        return _original_template_render(self, context, request)
+
+    timing.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_template_render(self, context, request)
+    finally:
+        timing.template_depth -= 1
+        timing.template_time += time.perf_counter() - start
+
+
+def install_template_timer():
+    """
+    Time the renders of the Django templates, called once by SocialConfig.ready()
+    The wrapper does nothing outside of a request timed by RequestTimingMiddleware
+    """
+    if DjangoTemplate.render is not _timed_template_render:
+        DjangoTemplate.render = _timed_template_render
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class RequestStats:
+    """
+    Rolling window of (view ms, db ms, template ms, queries) samples per url name
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, url_name, timing):
+        sample = (timing.view_time * 1000, timing.db_time * 1000, timing.template_time * 1000, timing.queries)
+        with self.lock:
+            self.samples[url_name].append(sample)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self.lock:
+            samples = {url_name: list(rows) for url_name, rows in self.samples.items()}
+
+        summary = {}
+        for url_name, rows in samples.items():
+            view_ms = [row[0] for row in rows]
+            histogram = dict.fromkeys(["<=%d" % bucket for bucket in HISTOGRAM_BUCKETS_MS] + [">%d" % HISTOGRAM_BUCKETS_MS[-1]], 0)
+            for value in view_ms:
+                for bucket in HISTOGRAM_BUCKETS_MS:
+                    if value <= bucket:
+                        histogram["<=%d" % bucket] += 1
+                        break
+                else:
+                    histogram[">%d" % HISTOGRAM_BUCKETS_MS[-1]] += 1
+
+            summary[url_name] = {
+                'count': len(rows),
+                'view_ms': {'p50': _percentile(view_ms, 50), 'p95': _percentile(view_ms, 95), 'p99': _percentile(view_ms, 99)},
+                'db_ms_avg': sum(row[1] for row in rows) / len(rows),
+                'template_ms_avg': sum(row[2] for row in rows) / len(rows),
+                'queries_avg': sum(row[3] for row in rows) / len(rows),
+                'queries_max': max(row[3] for row in rows),
+                'query_budget': get_query_budget(url_name),
+                'histogram': histogram,
+            }
+        return summary
+
+
+request_stats = RequestStats(getattr(settings, 'SOCIAL_TIMING_WINDOW', 1000))
+
+
+def get_query_budget(url_name):
+    return getattr(settings, 'SOCIAL_QUERY_BUDGETS', {}).get(url_name)
+
+
+class RequestTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        timing = RequestTiming()
+        token = _current_timing.set(timing)
+        start = time.perf_counter()
+        try:
+            _install_query_timer()
+            response = self.get_response(request)
+        finally:
+            timing.view_time = time.perf_counter() - start
+            _current_timing.reset(token)
+        return self.finish(request, response, timing)
+
+    async def __acall__(self, request):
+        timing = RequestTiming()
+        token = _current_timing.set(timing)
+        start = time.perf_counter()
+        try:
+            await sync_to_async(_install_query_timer)()
+            response = await self.get_response(request)
+        finally:
+            timing.view_time = time.perf_counter() - start
+            _current_timing.reset(token)
+        return self.finish(request, response, timing)
+
+    def finish(self, request, response, timing):
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.url_name if resolver_match and resolver_match.url_name else '<unnamed>'
+        request_stats.record(url_name, timing)
+
+        response['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", tpl;dur=%.2f, view;dur=%.2f' % (
+            timing.db_time * 1000, timing.queries, timing.template_time * 1000, timing.view_time * 1000
+        )
+
+        budget = get_query_budget(url_name)
+        if budget is not None and timing.queries > budget:
+            message = "%s ran %d queries, its budget is %d" % (url_name, timing.queries, budget)
+            if getattr(settings, 'SOCIAL_QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+        return response
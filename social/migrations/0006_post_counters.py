@@ -0,0 +1,45 @@
+# Generated by Django 4.1.4 on 2026-10-18 17:58
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_counters(apps, schema_editor):
+    Post = apps.get_model("social", "Post")
+    posts = Post.objects.annotate(
+        real_likes=Count("likes", distinct=True),
+        real_dislikes=Count("dislikes", distinct=True),
+        real_comments=Count("comment", distinct=True),
+    )
+    for post in posts.iterator():
+        Post.objects.filter(pk=post.pk).update(
+            likes_count=post.real_likes,
+            dislikes_count=post.real_dislikes,
+            comments_count=post.real_comments,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0005_post_dislikes_post_likes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="comments_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="dislikes_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="likes_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
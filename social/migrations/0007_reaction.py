@@ -0,0 +1,109 @@
+# Generated by Django 4.1.4 on 2026-10-18 17:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+LIKE = 1
+DISLIKE = -1
+
+
+def copy_likes_and_dislikes(apps, schema_editor):
+    """
+    Move the rows of the likes/dislikes M2M tables into Reaction
+    A user found in both tables keeps the like
+    """
+    Post = apps.get_model("social", "Post")
+    Reaction = apps.get_model("social", "Reaction")
+    for through, value in (
+        (Post.likes.through, LIKE),
+        (Post.dislikes.through, DISLIKE),
+    ):
+        rows = through.objects.values_list("post_id", "user_id").iterator()
+        batch = []
+        for post_id, user_id in rows:
+            batch.append(Reaction(post_id=post_id, user_id=user_id, value=value))
+            if len(batch) >= 1000:
+                Reaction.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        Reaction.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def copy_reactions_back(apps, schema_editor):
+    Post = apps.get_model("social", "Post")
+    Reaction = apps.get_model("social", "Reaction")
+    for through, value in (
+        (Post.likes.through, LIKE),
+        (Post.dislikes.through, DISLIKE),
+    ):
+        through.objects.bulk_create(
+            [
+                through(post_id=post_id, user_id=user_id)
+                for post_id, user_id in Reaction.objects.filter(
+                    value=value
+                ).values_list("post_id", "user_id")
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("social", "0006_post_counters"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Reaction",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "value",
+                    models.SmallIntegerField(choices=[(1, "Like"), (-1, "Dislike")]),
+                ),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reactions",
+                        to="social.post",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reactions",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="reaction",
+            constraint=models.UniqueConstraint(
+                fields=("post", "user"), name="unique_reaction_per_post_user"
+            ),
+        ),
+        migrations.RunPython(copy_likes_and_dislikes, copy_reactions_back),
+        migrations.RemoveField(
+            model_name="post",
+            name="dislikes",
+        ),
+        migrations.RemoveField(
+            model_name="post",
+            name="likes",
+        ),
+    ]
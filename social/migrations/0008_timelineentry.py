@@ -0,0 +1,82 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_timelines(apps, schema_editor):
+    # Existing follows get the latest posts of the followed account, like a new follow would
+    UserProfile = apps.get_model("social", "UserProfile")
+    Post = apps.get_model("social", "Post")
+    TimelineEntry = apps.get_model("social", "TimelineEntry")
+    follows = UserProfile.followers.through.objects.values_list(
+        "userprofile_id", "user_id"
+    )
+    for author_id, owner_id in follows.iterator():
+        posts = Post.objects.filter(author_id=author_id).order_by("-created_on", "-id")
+        TimelineEntry.objects.bulk_create(
+            [
+                TimelineEntry(owner_id=owner_id, post_id=pk, created_on=created_on)
+                for pk, created_on in posts.values_list("pk", "created_on")[
+                    : settings.SOCIAL_TIMELINE_BACKFILL
+                ]
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("social", "0007_reaction"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TimelineEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_on", models.DateTimeField()),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timeline_entries",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timeline_entries",
+                        to="social.post",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="timelineentry",
+            index=models.Index(
+                fields=["owner", "-created_on", "-post"],
+                name="timeline_owner_created_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="timelineentry",
+            constraint=models.UniqueConstraint(
+                fields=("owner", "post"), name="unique_timeline_entry_per_owner_post"
+            ),
+        ),
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
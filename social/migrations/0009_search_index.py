@@ -0,0 +1,65 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:20
+
+from django.db import migrations
+
+# FTS5 index of post bodies and comments, kept in sync by triggers
+# rowid = post id * 2 for posts and comment id * 2 + 1 for comments
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE social_search USING fts5("
+    "body, post_id UNINDEXED, created_on UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+    # posts
+    "CREATE TRIGGER social_post_search_ai AFTER INSERT ON social_post BEGIN "
+    "INSERT INTO social_search(rowid, body, post_id, created_on) VALUES (new.id * 2, new.body, new.id, new.created_on); END",
+    "CREATE TRIGGER social_post_search_au AFTER UPDATE OF body ON social_post BEGIN "
+    "DELETE FROM social_search WHERE rowid = old.id * 2; "
+    "INSERT INTO social_search(rowid, body, post_id, created_on) VALUES (new.id * 2, new.body, new.id, new.created_on); END",
+    "CREATE TRIGGER social_post_search_ad AFTER DELETE ON social_post BEGIN "
+    "DELETE FROM social_search WHERE rowid = old.id * 2; END",
+    # comments
+    "CREATE TRIGGER social_comment_search_ai AFTER INSERT ON social_comment BEGIN "
+    "INSERT INTO social_search(rowid, body, post_id, created_on) VALUES (new.id * 2 + 1, new.comment, new.post_id, new.created_on); END",
+    "CREATE TRIGGER social_comment_search_au AFTER UPDATE OF comment ON social_comment BEGIN "
+    "DELETE FROM social_search WHERE rowid = old.id * 2 + 1; "
+    "INSERT INTO social_search(rowid, body, post_id, created_on) VALUES (new.id * 2 + 1, new.comment, new.post_id, new.created_on); END",
+    "CREATE TRIGGER social_comment_search_ad AFTER DELETE ON social_comment BEGIN "
+    "DELETE FROM social_search WHERE rowid = old.id * 2 + 1; END",
+    # index what is already there
+    "INSERT INTO social_search(rowid, body, post_id, created_on) SELECT id * 2, body, id, created_on FROM social_post",
+    "INSERT INTO social_search(rowid, body, post_id, created_on) SELECT id * 2 + 1, comment, post_id, created_on FROM social_comment",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS social_post_search_ai",
+    "DROP TRIGGER IF EXISTS social_post_search_au",
+    "DROP TRIGGER IF EXISTS social_post_search_ad",
+    "DROP TRIGGER IF EXISTS social_comment_search_ai",
+    "DROP TRIGGER IF EXISTS social_comment_search_au",
+    "DROP TRIGGER IF EXISTS social_comment_search_ad",
+    "DROP TABLE IF EXISTS social_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite only, other databases use the icontains fallback of social.search
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in CREATE_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0008_timelineentry"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
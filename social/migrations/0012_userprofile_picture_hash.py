@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0011_post_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="picture_hash",
+            field=models.CharField(blank=True, default="", max_length=32),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def backfill_user_stats(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    Post = apps.get_model("social", "Post")
+    Comment = apps.get_model("social", "Comment")
+    Reaction = apps.get_model("social", "Reaction")
+    UserProfile = apps.get_model("social", "UserProfile")
+    UserStats = apps.get_model("social", "UserStats")
+    Follow = UserProfile.followers.through
+
+    stats = {
+        pk: UserStats(user_id=pk) for pk in User.objects.values_list("pk", flat=True)
+    }
+    grouped = [
+        ("posts_count", Post.objects.values_list("author_id").annotate(n=Count("pk"))),
+        (
+            "comments_count",
+            Comment.objects.values_list("author_id").annotate(n=Count("pk")),
+        ),
+        (
+            "followers_count",
+            Follow.objects.values_list("userprofile_id").annotate(n=Count("pk")),
+        ),
+        (
+            "following_count",
+            Follow.objects.values_list("user_id").annotate(n=Count("pk")),
+        ),
+        (
+            "likes_received",
+            Reaction.objects.filter(value=1)
+            .values_list("post__author_id")
+            .annotate(n=Count("pk")),
+        ),
+    ]
+    for field, rows in grouped:
+        for pk, count in rows:
+            if pk in stats:
+                setattr(stats[pk], field, count)
+    UserStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("social", "0012_userprofile_picture_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("posts_count", models.PositiveIntegerField(default=0)),
+                ("comments_count", models.PositiveIntegerField(default=0)),
+                ("followers_count", models.PositiveIntegerField(default=0)),
+                ("following_count", models.PositiveIntegerField(default=0)),
+                ("likes_received", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_user_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,226 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:25
+
+import datetime
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F
+from django.utils import timezone
+
+HASHTAG_RE = re.compile(r"(?<![\w&#])#(\w{1,50})")
+MENTION_RE = re.compile(r"(?<![\w@])@([\w.@+-]{1,150})")
+
+
+def backfill_tags(apps, schema_editor):
+    # Same parsing as social.tags.parse_post(), only the posts of the trending window are counted
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    Post = apps.get_model("social", "Post")
+    Hashtag = apps.get_model("social", "Hashtag")
+    PostTag = apps.get_model("social", "PostTag")
+    Mention = apps.get_model("social", "Mention")
+    TagBucket = apps.get_model("social", "TagBucket")
+    window = getattr(settings, "SOCIAL_TRENDING_WINDOW_HOURS", 24)
+    cutoff = timezone.now() - datetime.timedelta(hours=window)
+
+    last_pk = 0
+    while True:
+        posts = list(
+            Post.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", "body", "created_on")[:1000]
+        )
+        if not posts:
+            break
+        last_pk = posts[-1][0]
+
+        parsed = [
+            (
+                pk,
+                created_on,
+                {name.lower() for name in HASHTAG_RE.findall(body)},
+                {name.rstrip(".") for name in MENTION_RE.findall(body)},
+            )
+            for pk, body, created_on in posts
+        ]
+        names = set().union(*(tags for pk, created_on, tags, usernames in parsed))
+        usernames = set().union(*(users for pk, created_on, tags, users in parsed))
+        Hashtag.objects.bulk_create(
+            [Hashtag(name=name) for name in names], ignore_conflicts=True
+        )
+        tag_ids = dict(Hashtag.objects.filter(name__in=names).values_list("name", "pk"))
+        user_ids = dict(
+            User.objects.filter(username__in=usernames).values_list("username", "pk")
+        )
+
+        buckets = {}
+        post_tags = []
+        mentions = []
+        for pk, created_on, tags, users in parsed:
+            post_tags.extend(
+                PostTag(post_id=pk, tag_id=tag_ids[name], created_on=created_on)
+                for name in tags
+            )
+            mentions.extend(
+                Mention(post_id=pk, user_id=user_ids[name], created_on=created_on)
+                for name in users
+                if name in user_ids
+            )
+            if created_on >= cutoff:
+                hour = created_on.replace(minute=0, second=0, microsecond=0)
+                for name in tags:
+                    key = (tag_ids[name], hour)
+                    buckets[key] = buckets.get(key, 0) + 1
+        PostTag.objects.bulk_create(post_tags, ignore_conflicts=True)
+        Mention.objects.bulk_create(mentions, ignore_conflicts=True)
+        for (tag_id, hour), count in buckets.items():
+            bucket, created = TagBucket.objects.get_or_create(tag_id=tag_id, hour=hour)
+            TagBucket.objects.filter(pk=bucket.pk).update(count=F("count") + count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("social", "0013_userstats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Hashtag",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="TagBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hour", models.DateTimeField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="buckets",
+                        to="social.hashtag",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PostTag",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_on", models.DateTimeField()),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="post_tags",
+                        to="social.post",
+                    ),
+                ),
+                (
+                    "tag",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="post_tags",
+                        to="social.hashtag",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Mention",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_on", models.DateTimeField()),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="mentions",
+                        to="social.post",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="mentions",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="tagbucket",
+            index=models.Index(fields=["hour"], name="tag_bucket_hour_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="tagbucket",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "hour"), name="unique_tag_bucket"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="posttag",
+            index=models.Index(
+                fields=["tag", "-created_on", "-post"], name="post_tag_created_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="posttag",
+            constraint=models.UniqueConstraint(
+                fields=("tag", "post"), name="unique_post_tag"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="mention",
+            index=models.Index(
+                fields=["user", "-created_on", "-post"], name="mention_user_created_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="mention",
+            constraint=models.UniqueConstraint(
+                fields=("user", "post"), name="unique_post_mention"
+            ),
+        ),
+        migrations.RunPython(backfill_tags, migrations.RunPython.noop),
+    ]
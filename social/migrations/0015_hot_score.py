@@ -0,0 +1,60 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:29
+
+import datetime
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+
+HOT_EPOCH = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def backfill_hot_scores(apps, schema_editor):
+    # Same formula as social.ranking.hot_score()
+    Post = apps.get_model("social", "Post")
+    half_life = getattr(settings, "SOCIAL_HOT_HALF_LIFE_HOURS", 12) * 3600.0
+    comment_weight = getattr(settings, "SOCIAL_HOT_COMMENT_WEIGHT", 2)
+
+    last_pk = 0
+    while True:
+        posts = list(
+            Post.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .only("likes_count", "dislikes_count", "comments_count", "created_on")[
+                :1000
+            ]
+        )
+        if not posts:
+            break
+        last_pk = posts[-1].pk
+
+        for post in posts:
+            points = (
+                post.likes_count
+                - post.dislikes_count
+                + comment_weight * post.comments_count
+            )
+            post.hot_score = (
+                math.copysign(math.log2(1 + abs(points)), points) if points else 0.0
+            ) + (post.created_on - HOT_EPOCH).total_seconds() / half_life
+        Post.objects.bulk_update(posts, ["hot_score"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0014_hashtags"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="hot_score",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(fields=["-hot_score", "-id"], name="post_hot_score_idx"),
+        ),
+        migrations.RunPython(backfill_hot_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:49
+
+import importlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+search_index = importlib.import_module("social.migrations.0009_search_index")
+
+
+def create_shard_search_index(apps, schema_editor):
+    # The data migrations only run on "default" (PostShardRouter.allow_migrate), so the search
+    # index of 0009 is created here on the shards, unless an earlier migrate already did it
+    from social import sharding
+
+    connection = schema_editor.connection
+    if not sharding.is_shard_database(connection.alias):
+        return
+    if "social_search" in connection.introspection.table_names():
+        return
+    search_index.create_search_index(apps, schema_editor)
+
+
+def drop_shard_search_index(apps, schema_editor):
+    from social import sharding
+
+    if sharding.is_shard_database(schema_editor.connection.alias):
+        search_index.drop_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0017_comment_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="mention",
+            name="post",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="mentions",
+                to="social.post",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="posttag",
+            name="post",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="post_tags",
+                to="social.post",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="timelineentry",
+            name="post",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="timeline_entries",
+                to="social.post",
+            ),
+        ),
+        migrations.RunPython(
+            create_shard_search_index, drop_shard_search_index, hints={"shards": True}
+        ),
+    ]
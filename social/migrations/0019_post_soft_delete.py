@@ -0,0 +1,26 @@
+# Generated by Django 4.1.4 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0018_entries_without_post_constraint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="deleted_on",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(
+                condition=models.Q(("deleted_on__isnull", False)),
+                fields=["deleted_on"],
+                name="post_deleted_on_idx",
+            ),
+        ),
+    ]
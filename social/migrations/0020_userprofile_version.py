@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("social", "0019_post_soft_delete"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
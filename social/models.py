@@ -1,29 +1,354 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError, DEFAULT_DB_ALIAS
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db.models import F, Q, Count, Subquery
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
+from asgiref.sync import sync_to_async
+from .pagination import akeyset_paginate, keyset_paginate, merge_keyset_pages
+from . import ranking, reaction_queue, sharding, stamps
+
+# The deleted posts wait for Post.purge() with deleted_on set, hidden from every page
+class PostManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_on__isnull=True)
 
 # Post model
 class Post(models.Model):
     body = models.TextField()
     created_on = models.DateTimeField(default=timezone.now)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
-    likes = models.ManyToManyField(User, blank=True, related_name="likes")
-    dislikes = models.ManyToManyField(User, blank=True, related_name="dislikes")
+    # Denormalized counters so the feeds don't run COUNT queries per post
+    # kept up to date by Reaction.toggle() and the comment signals below, "reconcile_post_counters" fixes any drift
+    likes_count = models.PositiveIntegerField(default=0)
+    dislikes_count = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    # Bumped on every change that shows on the post card (edit, reaction, comment, author profile), used in the card cache key
+    version = models.PositiveIntegerField(default=0)
+    # "Hot" ranking, see social/ranking.py: moved along with the counters, recomputed by "rescore_hot_posts"
+    hot_score = models.FloatField(default=0)
+    # Soft delete: set by soft_delete(), the row goes with its comments and reactions in Post.purge()
+    deleted_on = models.DateTimeField(null=True, blank=True)
+
+    objects = PostManager()
+    all_objects = models.Manager() # with the deleted posts
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', '-created_on', '-id'], name='post_author_created_idx'), # author timelines, keyset order
+            models.Index(fields=['-created_on', '-id'], name='post_created_id_idx'), # latest posts, keyset order
+            models.Index(fields=['-hot_score', '-id'], name='post_hot_score_idx'), # hot posts, keyset order
+            models.Index(fields=['deleted_on'], name='post_deleted_on_idx', condition=Q(deleted_on__isnull=False)), # posts to purge
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.hot_score = self.compute_hot_score()
+            if self.pk is None and sharding.is_enabled(): # an id carrying the slot of the author
+                return sharding.save_with_new_id(self, self.author_id, super().save, **kwargs)
+        super().save(*args, **kwargs)
+
+    def compute_hot_score(self):
+        return ranking.hot_score(self.likes_count, self.dislikes_count, self.comments_count, self.created_on)
+
+    # add (or subtract with negative values) to the counters with a single UPDATE, the hot score follows
+    @staticmethod
+    def update_counters(pk, **deltas):
+        db = sharding.post_db(pk)
+        Post.objects.using(db).filter(pk=pk).update(
+            version=F('version') + 1,
+            hot_score=ranking.hot_score_delta(**deltas),
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+        stamps.touch_post(pk, using=db)
+        if deltas.get('likes_count'):
+            UserStats.add_likes_received(pk, deltas['likes_count'])
+
+    def soft_delete(self):
+        """
+        Hide the post right away, its comments and reactions stay until Post.purge() (the "purge_post" job)
+        The author's numbers drop now, returns False if the post was already deleted
+        """
+        db = self._state.db
+        with transaction.atomic(using=db):
+            if not Post.objects.using(db).filter(pk=self.pk).update(deleted_on=timezone.now()):
+                return False
+            # the counters of a hidden post don't move anymore (update_counters() doesn't see it)
+            likes = Post.all_objects.using(db).filter(pk=self.pk).values_list('likes_count', flat=True).first() or 0
+            UserStats.objects.filter(pk=self.author_id).update(posts_count=F('posts_count') - 1, likes_received=F('likes_received') - likes)
+        stamps.touch_post(self.pk, self.author_id, using=db)
+        return True
+
+    @staticmethod
+    def purge(pk, batch_size=None):
+        """
+        Delete a soft-deleted post with its comments, reactions, timeline/tag/mention entries,
+        batch_size rows per statement (SOCIAL_PURGE_BATCH) so the write lock is only held briefly
+        Without signals: the commenters' numbers are updated per batch. Returns False if there was nothing to purge
+        """
+        batch_size = batch_size or getattr(settings, 'SOCIAL_PURGE_BATCH', 500)
+        db = sharding.post_db(pk) or DEFAULT_DB_ALIAS
+        if not Post.all_objects.using(db).filter(pk=pk, deleted_on__isnull=False).exists():
+            return False
+
+        comments = Comment.objects.using(db).filter(post_id=pk)
+        while True:
+            with transaction.atomic(using=db):
+                rows = list(comments.values_list('pk', 'author_id')[:batch_size])
+                if not rows:
+                    break
+                Comment.objects.using(db).filter(pk__in=[comment_pk for comment_pk, author_id in rows])._raw_delete(db)
+                authors = {}
+                for comment_pk, author_id in rows:
+                    authors[author_id] = authors.get(author_id, 0) + 1
+                by_count = {}
+                for author_id, count in authors.items():
+                    by_count.setdefault(count, []).append(author_id)
+                for count, author_ids in by_count.items():
+                    UserStats.update_counters(author_ids, comments_count=-count)
+
+        # the entries are on "default" with sharded posts
+        for model, using in ((Reaction, db), (TimelineEntry, DEFAULT_DB_ALIAS), (PostTag, DEFAULT_DB_ALIAS), (Mention, DEFAULT_DB_ALIAS)):
+            while True:
+                pks = list(model.objects.using(using).filter(post_id=pk).values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                model.objects.using(using).filter(pk__in=pks)._raw_delete(using)
+
+        Post.all_objects.using(db).filter(pk=pk)._raw_delete(db)
+        return True
+
+    # invalidate the cached post cards of the matching posts, on every shard unless the filters name the post or its author
+    @staticmethod
+    def bump_version(**filters):
+        if 'pk' in filters:
+            dbs = [sharding.post_db(filters['pk'])]
+        elif 'author' in filters or 'author_id' in filters:
+            author = filters.get('author', filters.get('author_id'))
+            dbs = [sharding.author_db(getattr(author, 'pk', author))]
+        else:
+            dbs = sharding.get_post_dbs()
+        for db in dbs:
+            Post.objects.using(db).filter(**filters).update(version=F('version') + 1)
+        if 'pk' in filters:
+            stamps.touch_post(filters['pk'])
+        else: # the author on the cards, the post pages only show the username
+            authors = filters.get('author_id__in', [filters.get('author', filters.get('author_id'))])
+            stamps.touch([stamps.FEED] + [stamps.profile_stamp(getattr(author, 'pk', author)) for author in authors if author is not None])
     
     # get the item according to params
+    # For "filter"/"all"/"hot", passing page_size returns a KeysetPage instead of the whole queryset
+    # With sharding "filter" reads the shard of the author, "all"/"hot" merge a page of every shard
+    @staticmethod
+    def get_post_data(filter_type, filter_by=None, cursor=None, direction="older", page_size=None):
+        if filter_type == "get":
+            return Post.objects.using(sharding.post_db(filter_by)).get(id=filter_by)
+        time_field = 'hot_score' if filter_type == "hot" else 'created_on'
+        querysets = Post.get_post_querysets(filter_type, filter_by)
+
+        if page_size is None:
+            if len(querysets) > 1:
+                raise ValueError("posts of several shards can only be read one page at a time")
+            return querysets[0]
+        pages = [keyset_paginate(posts, cursor=cursor, direction=direction, page_size=page_size, time_field=time_field) for posts in querysets]
+        if len(pages) == 1:
+            return pages[0]
+        return merge_keyset_pages(pages, cursor=cursor, direction=direction, page_size=page_size, time_field=time_field)
+
+    # get_post_data() for async views, "filter"/"all"/"hot" always return a KeysetPage
+    @staticmethod
+    async def aget_post_data(filter_type, filter_by=None, cursor=None, direction="older", page_size=None):
+        if filter_type == "get":
+            db = await sync_to_async(sharding.post_db)(filter_by) if sharding.is_enabled() else None
+            return await Post.objects.using(db).select_related('author').aget(id=filter_by)
+        time_field = 'hot_score' if filter_type == "hot" else 'created_on'
+        pages = [
+            await akeyset_paginate(posts, cursor=cursor, direction=direction, page_size=page_size, time_field=time_field)
+            for posts in Post.get_post_querysets(filter_type, filter_by)
+        ]
+        if len(pages) == 1:
+            return pages[0]
+        return merge_keyset_pages(pages, cursor=cursor, direction=direction, page_size=page_size, time_field=time_field)
+
     @staticmethod
-    def get_post_data(filter_type, filter_by=None):
+    def get_post_queryset(filter_type, filter_by=None, using=None):
+        posts = Post.objects.using(using).select_related('author__profile')
         if filter_type == "filter":
-            return Post.objects.filter(author=filter_by).order_by('-created_on') #ordered by latest date
-        elif filter_type == "get":
-            return Post.objects.get(id=filter_by)
+            return posts.filter(author=filter_by).order_by('-created_on', '-id') #ordered by latest date
         elif filter_type == "all":
-            return Post.objects.all().order_by('-created_on')
+            return posts.order_by('-created_on', '-id')
+        elif filter_type == "hot":
+            return posts.order_by('-hot_score', '-id')
         else: 
             raise Exception("not valid input")
 
+    # get_post_queryset() of every database to read: the shard of the author for "filter", all the shards otherwise
+    @staticmethod
+    def get_post_querysets(filter_type, filter_by=None):
+        if filter_type == "filter":
+            dbs = [sharding.author_db(getattr(filter_by, 'pk', filter_by))]
+        else:
+            dbs = sharding.get_post_dbs()
+        return [Post.get_post_queryset(filter_type, filter_by, using=db) for db in dbs]
+
+    @staticmethod
+    def get_posts(pks):
+        """
+        {pk: post} of the posts with these ids, with their authors, one query per shard
+        """
+        posts = {}
+        for db in sharding.get_post_dbs():
+            posts.update(Post.objects.using(db).select_related('author__profile').in_bulk(list(pks)))
+        return posts
+
+    @staticmethod
+    def paginate_entries(entries, cursor=None, direction="older", page_size=None):
+        """
+        KeysetPage of the posts of timeline/tag/mention entries (post + copy of its created_on), same cursors
+        The posts are joined in, or read from the shards when they are stored there
+        """
+        if not sharding.is_enabled():
+            entries = entries.filter(post__deleted_on__isnull=True).select_related('post__author__profile')
+        page = keyset_paginate(entries, cursor=cursor, direction=direction, page_size=page_size, id_field='post_id')
+        if sharding.is_enabled():
+            posts = Post.get_posts([entry.post_id for entry in page])
+            page.object_list = [posts[entry.post_id] for entry in page if entry.post_id in posts]
+        else:
+            page.object_list = [entry.post for entry in page]
+        page.id_field = 'pk'
+        return page
+
+# Like/Dislike of a user on a post - at most one row per (post, user)
+class Reaction(models.Model):
+    LIKE = 1
+    DISLIKE = -1
+    VALUE_CHOICES = [(LIKE, 'Like'), (DISLIKE, 'Dislike')]
+    COUNTER_FIELDS = {LIKE: 'likes_count', DISLIKE: 'dislikes_count'}
+    NAMES = {LIKE: 'like', DISLIKE: 'dislike'} # how reactions are named in the JSON API and templates
+
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='reactions')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reactions')
+    value = models.SmallIntegerField(choices=VALUE_CHOICES)
+    created_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'user'], name='unique_reaction_per_post_user'),
+        ]
+
+    @staticmethod
+    def toggle(post_pk, user, value):
+        """
+        Clicking LIKE/DISLIKE: same reaction again removes it, the opposite one is switched over
+        Every statement hits the (post, user) unique index, so a click costs the same however many users reacted
+        Returns the user's reaction after the click (None if it was removed)
+        """
+        if reaction_queue.is_enabled():
+            before, after = reaction_queue.push(post_pk, user.pk, lambda current: reaction_queue.NONE if current == value else value)
+            return after or None
+        other = -value
+        db = sharding.post_db(post_pk)
+        reactions = Reaction.objects.using(db)
+        for attempt in range(2):
+            try:
+                with transaction.atomic(using=db):
+                    if reactions.filter(post_id=post_pk, user=user, value=value).delete()[0]:
+                        Post.update_counters(post_pk, **{Reaction.COUNTER_FIELDS[value]: -1})
+                        return None
+
+                    if reactions.filter(post_id=post_pk, user=user, value=other).update(value=value):
+                        Post.update_counters(post_pk, **{Reaction.COUNTER_FIELDS[value]: 1, Reaction.COUNTER_FIELDS[other]: -1})
+                        return value
+
+                    reactions.create(post_id=post_pk, user=user, value=value)
+                    Post.update_counters(post_pk, **{Reaction.COUNTER_FIELDS[value]: 1})
+                    return value
+            except IntegrityError:
+                # Another click of the same user inserted the row first, run again against that row
+                if attempt:
+                    raise
+
+    @staticmethod
+    def set(post_pk, user, value):
+        """
+        Make `value` the user's reaction to the post, whatever it was before (JSON API)
+        Unlike toggle() sending it twice changes nothing, returns True if the reaction changed
+        """
+        if reaction_queue.is_enabled():
+            before, after = reaction_queue.push(post_pk, user.pk, lambda current: value)
+            return before != after
+        other = -value
+        db = sharding.post_db(post_pk)
+        reactions = Reaction.objects.using(db)
+        for attempt in range(2):
+            with transaction.atomic(using=db):
+                if reactions.filter(post_id=post_pk, user=user, value=other).update(value=value):
+                    Post.update_counters(post_pk, **{Reaction.COUNTER_FIELDS[value]: 1, Reaction.COUNTER_FIELDS[other]: -1})
+                    return True
+                try:
+                    with transaction.atomic(using=db):
+                        reactions.create(post_id=post_pk, user=user, value=value)
+                except IntegrityError:
+                    # The user already reacted, with this value or concurrently with the other one: check again
+                    continue
+                Post.update_counters(post_pk, **{Reaction.COUNTER_FIELDS[value]: 1})
+                return True
+        return False
+
+    @staticmethod
+    def clear(post_pk, user):
+        """
+        Remove the user's reaction to the post if there is one, returns True if there was
+        """
+        if reaction_queue.is_enabled():
+            before, after = reaction_queue.push(post_pk, user.pk, lambda current: reaction_queue.NONE)
+            return before != after
+        db = sharding.post_db(post_pk)
+        with transaction.atomic(using=db):
+            for value, counter in Reaction.COUNTER_FIELDS.items():
+                if Reaction.objects.using(db).filter(post_id=post_pk, user=user, value=value).delete()[0]:
+                    Post.update_counters(post_pk, **{counter: -1})
+                    return True
+        return False
+
+    @staticmethod
+    def get_user_reactions(user, post_ids):
+        """
+        {post id: "like"/"dislike"} of the reactions of the user to these posts, one query on the (post, user) index
+        """
+        if not user.is_authenticated or not post_ids:
+            return {}
+        values = {}
+        for db in sharding.get_post_dbs():
+            values.update(Reaction.objects.using(db).filter(user=user, post_id__in=post_ids).values_list('post_id', 'value'))
+        if reaction_queue.is_enabled(): # clicks not flushed yet
+            values.update(reaction_queue.pending_for_user(user.pk, post_ids))
+        return {post_id: Reaction.NAMES[value] for post_id, value in values.items() if value}
+
+    @staticmethod
+    async def aget_user_reactions(user, post_ids):
+        if not user.is_authenticated or not post_ids:
+            return {}
+        values = {}
+        for db in sharding.get_post_dbs():
+            rows = Reaction.objects.using(db).filter(user=user, post_id__in=post_ids).values_list('post_id', 'value')
+            values.update({post_id: value async for post_id, value in rows})
+        if reaction_queue.is_enabled():
+            values.update(await sync_to_async(reaction_queue.pending_for_user)(user.pk, post_ids))
+        return {post_id: Reaction.NAMES[value] for post_id, value in values.items() if value}
+
+    @staticmethod
+    def get_counts(post_pk):
+        """
+        {"likes_count", "dislikes_count"} of a post, with the clicks not flushed yet
+        """
+        counts = Post.objects.using(sharding.post_db(post_pk)).filter(pk=post_pk).values('likes_count', 'dislikes_count').first()
+        if counts and reaction_queue.is_enabled():
+            for field, delta in reaction_queue.pending_counts([post_pk]).get(post_pk, {}).items():
+                counts[field] = max(counts[field] + delta, 0)
+        return counts
+
 # Comment model
 class Comment(models.Model):
     comment = models.TextField()
@@ -31,6 +356,33 @@ class Comment(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     post = models.ForeignKey('Post', on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', '-created_on', '-id'], name='comment_post_created_id_idx'), # comment thread of a post, keyset order
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.pk is None and sharding.is_enabled(): # stored with its post, ids unique across the shards
+            return sharding.save_with_new_id(self, self.post_id, super().save, **kwargs)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def get_comment_page(post_pk, cursor=None, page_size=None):
+        """
+        One KeysetPage of the comments of a post, latest first, with their authors
+        ?before=<cursor> of the page gives the next (older) comments
+        """
+        comments = Comment.objects.using(sharding.post_db(post_pk)).filter(post_id=post_pk).select_related('author')
+        page_size = page_size or getattr(settings, 'SOCIAL_COMMENT_PAGE_SIZE', 20)
+        return keyset_paginate(comments, cursor=cursor, page_size=page_size)
+
+    @staticmethod
+    async def aget_comment_page(post_pk, cursor=None, page_size=None):
+        db = await sync_to_async(sharding.post_db)(post_pk) if sharding.is_enabled() else None
+        comments = Comment.objects.using(db).filter(post_id=post_pk).select_related('author')
+        page_size = page_size or getattr(settings, 'SOCIAL_COMMENT_PAGE_SIZE', 20)
+        return await akeyset_paginate(comments, cursor=cursor, page_size=page_size)
+
 # User Profile model
 class UserProfile(models.Model):
     user = models.OneToOneField(User, primary_key=True, verbose_name='user', related_name='profile', on_delete=models.CASCADE)
@@ -40,21 +392,349 @@ class UserProfile(models.Model):
     location = models.CharField(max_length=100, blank=True, null=True)
     picture = models.ImageField(upload_to='uploads/profile_pictures', default='uploads/profile_pictures/blank-profile-picture.png', blank=True)
     followers = models.ManyToManyField(User, blank=True, related_name='followers')
+    # content hash of the processed avatars of `picture` (social/images.py), empty until they are ready
+    picture_hash = models.CharField(max_length=32, blank=True, default='')
+    # part of the cache key of the post cards of the user (social/templatetags/post_cards.py), bumped when their avatar changes
+    version = models.PositiveIntegerField(default=0)
 
-    # We will use "signals" to save the userInfo into UserProfile every time it's saved
-    # sender - User
-    # receiver - decorator(@receiver)
-    # instanct - User object being saved
-    # created - true/false
+    # invalidate the cached post cards of these users, and copy their profiles to the shards the posts are joined with them
+    @staticmethod
+    def bump_version(*pks):
+        if not pks:
+            return
+        UserProfile.objects.filter(pk__in=pks).update(version=F('version') + 1)
+        if sharding.is_enabled():
+            profiles = list(UserProfile.objects.select_related('user').filter(pk__in=pks))
+            sharding.copy_users([profile.user for profile in profiles], profiles)
+        stamps.touch([stamps.FEED] + [stamps.profile_stamp(pk) for pk in pks])
+
+    # Accounts followed by `user` that have too many followers to fan out their posts on write
+    @staticmethod
+    def get_celebrity_ids(user):
+        followed = UserProfile.followers.through.objects.filter(user=user).values('userprofile_id')
+        return list(
+            UserStats.objects.filter(pk__in=followed, followers_count__gt=settings.SOCIAL_FANOUT_LIMIT)
+            .values_list('pk', flat=True)
+        )
+
+    @staticmethod
+    def is_celebrity(user):
+        return UserStats.objects.filter(pk=user.pk, followers_count__gt=settings.SOCIAL_FANOUT_LIMIT).exists()
+
+# Numbers shown for a user, kept up to date by the signals below instead of being counted on every page
+# "reconcile_user_stats" recomputes them and fixes any drift
+class UserStats(models.Model):
+    COUNTER_FIELDS = ['posts_count', 'comments_count', 'followers_count', 'following_count', 'likes_received']
+
+    user = models.OneToOneField(User, primary_key=True, related_name='stats', on_delete=models.CASCADE)
+    posts_count = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    likes_received = models.PositiveIntegerField(default=0) # likes on all the posts of the user
+
+    # add (or subtract with negative values) to the counters of one or more users with a single UPDATE
+    @staticmethod
+    def update_counters(user_pks, **deltas):
+        UserStats.objects.filter(pk__in=user_pks).update(**{field: F(field) + delta for field, delta in deltas.items()})
+
+    @staticmethod
+    def add_likes_received(post_pk, delta):
+        author = Subquery(Post.objects.filter(pk=post_pk).values('author_id'))
+        if sharding.is_enabled(): # the post is on a shard, no subquery across databases
+            author = Post.objects.using(sharding.post_db(post_pk)).filter(pk=post_pk).values_list('author_id', flat=True).first()
+        UserStats.objects.filter(pk=author).update(likes_received=F('likes_received') + delta)
+
+    @staticmethod
+    def get_for(user):
+        # stats of a user fetched with select_related('stats'), zeros if the row is missing until the next reconcile
+        return getattr(user, 'stats', None) or UserStats(user=user)
+
+    @staticmethod
+    def compute(first_pk, last_pk):
+        """
+        Real counters of the users with first_pk <= pk <= last_pk, {user pk: {field: value}}
+        One grouped query per counter, each one restricted to the range through an index
+        """
+        user_ids = User.objects.filter(pk__range=(first_pk, last_pk)).values_list('pk', flat=True)
+        stats = {pk: dict.fromkeys(UserStats.COUNTER_FIELDS, 0) for pk in user_ids}
+        Follow = UserProfile.followers.through
+        grouped = [
+            ('followers_count', Follow.objects.filter(userprofile__gte=first_pk, userprofile__lte=last_pk).values('userprofile_id').annotate(n=Count('pk'))),
+            ('following_count', Follow.objects.filter(user__gte=first_pk, user__lte=last_pk).values('user_id').annotate(n=Count('pk'))),
+        ]
+        for db in sharding.get_post_dbs(): # summed over the shards
+            grouped += [
+                ('posts_count', Post.objects.using(db).filter(author__gte=first_pk, author__lte=last_pk).values('author_id').annotate(n=Count('pk'))),
+                ('comments_count', Comment.objects.using(db).filter(author__gte=first_pk, author__lte=last_pk).values('author_id').annotate(n=Count('pk'))),
+                ('likes_received', Reaction.objects.using(db).filter(post__author__gte=first_pk, post__author__lte=last_pk, value=Reaction.LIKE).values('post__author_id').annotate(n=Count('pk'))),
+            ]
+        for field, rows in grouped:
+            for row in rows:
+                pk, count = list(row.values())
+                if pk in stats:
+                    stats[pk][field] += count
+        return stats
+
+# Home timeline - materialized list of posts of the accounts a user follows
+# Rows are written when a post is created (fan-out on write), except for celebrity authors
+# whose posts are merged in when the timeline is read (fan-out on read)
+class TimelineEntry(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='timeline_entries', db_constraint=False) # the post may be on a shard
+    created_on = models.DateTimeField() # copy of post.created_on, so the timeline is paginated without a join
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'post'], name='unique_timeline_entry_per_owner_post'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-created_on', '-post'], name='timeline_owner_created_idx'),
+        ]
+
+    @staticmethod
+    def fan_out(post):
+        """
+        Copy a new post into the timeline of every follower of its author
+        Skipped for celebrity authors, their followers read the posts straight from the Post table
+        """
+        follower_ids = list(
+            UserProfile.followers.through.objects.filter(userprofile_id=post.author_id)
+            .values_list('user_id', flat=True)[:settings.SOCIAL_FANOUT_LIMIT + 1]
+        )
+        if len(follower_ids) > settings.SOCIAL_FANOUT_LIMIT:
+            return
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(owner_id=user_id, post=post, created_on=post.created_on) for user_id in follower_ids],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+
+    @staticmethod
+    def backfill(owner, author):
+        # After following someone, copy their latest posts into the follower's timeline
+        if UserProfile.is_celebrity(author):
+            return
+        posts = Post.objects.using(sharding.author_db(author.pk)).filter(author=author).order_by('-created_on', '-id').values_list('pk', 'created_on')[:settings.SOCIAL_TIMELINE_BACKFILL]
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(owner=owner, post_id=pk, created_on=created_on) for pk, created_on in posts],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+
+    @staticmethod
+    def prune(owner, author):
+        # After unfollowing someone, remove their posts from the follower's timeline
+        if not sharding.is_enabled():
+            TimelineEntry.objects.filter(owner=owner, post__author=author).delete()
+            return
+        # the posts are on a shard: through the timeline of the owner, a few hundred entries at a time
+        entries = TimelineEntry.objects.filter(owner=owner)
+        last_pk = 0
+        while True:
+            post_ids = list(entries.filter(post_id__gt=last_pk).order_by('post_id').values_list('post_id', flat=True)[:500])
+            if not post_ids:
+                return
+            authored = Post.objects.using(sharding.author_db(author.pk)).filter(pk__in=post_ids, author=author).values_list('pk', flat=True)
+            entries.filter(post_id__in=list(authored)).delete()
+            last_pk = post_ids[-1]
+
+    @staticmethod
+    def get_home_timeline(user, cursor=None, direction="older", page_size=None):
+        """
+        One page of the home timeline: the materialized entries merged with the latest posts
+        of the celebrity accounts the user follows (and the user's own posts)
+        """
+        entries = Post.paginate_entries(TimelineEntry.objects.filter(owner=user), cursor=cursor, direction=direction, page_size=page_size)
+
+        # one index range scan per pulled author, an "author IN (...)" query would have to sort
+        pages = [entries]
+        for author_id in UserProfile.get_celebrity_ids(user) + [user.pk]:
+            pulled = Post.objects.using(sharding.author_db(author_id)).filter(author_id=author_id).select_related('author__profile')
+            pages.append(keyset_paginate(pulled, cursor=cursor, direction=direction, page_size=page_size))
+
+        return merge_keyset_pages(pages, cursor=cursor, direction=direction, page_size=page_size)
+
+# Hashtags and mentions parsed from the post bodies when they are written (social/tags.py)
+class Hashtag(models.Model):
+    name = models.CharField(max_length=50, unique=True) # lowercase, without the "#"
+
+    def __str__(self):
+        return '#' + self.name
+
+class PostTag(models.Model):
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='post_tags', db_constraint=False) # the post may be on a shard
+    tag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name='post_tags')
+    created_on = models.DateTimeField() # copy of post.created_on, so a tag page is paginated without a join
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tag', 'post'], name='unique_post_tag'),
+        ]
+        indexes = [
+            models.Index(fields=['tag', '-created_on', '-post'], name='post_tag_created_idx'),
+        ]
+
+class Mention(models.Model):
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='mentions', db_constraint=False) # the post may be on a shard
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mentions')
+    created_on = models.DateTimeField() # copy of post.created_on
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='unique_post_mention'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_on', '-post'], name='mention_user_created_idx'),
+        ]
+
+# Uses of a tag during one hour, read by the trending tags panel
+class TagBucket(models.Model):
+    tag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name='buckets')
+    hour = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tag', 'hour'], name='unique_tag_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['hour'], name='tag_bucket_hour_idx'),
+        ]
+
+# Background job stored in the database, run by the "run_jobs" workers (social/jobs.py)
+class Job(models.Model):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    name = models.CharField(max_length=100) # registered with @job in social/jobs.py
+    payload = models.JSONField(default=dict) # keyword arguments of the job function
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=QUEUED)
+    # when a queued job may run, when the lease of a running job expires, when a finished job ended
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    claimed_by = models.CharField(max_length=100, blank=True, default='') # claim token of the worker running it
+    created_on = models.DateTimeField(default=timezone.now)
+    started_on = models.DateTimeField(null=True, blank=True) # of the last attempt
+    duration = models.FloatField(null=True, blank=True) # seconds of the last attempt
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'), # claiming, lease recovery, purge
+            models.Index(fields=['claimed_by'], name='job_claimed_by_idx'),
+        ]
+
+    def __str__(self):
+        return '%s #%s' % (self.name, self.pk)
+
+# We will use "signals" to save the userInfo into UserProfile every time it's saved
+# sender - User
+# receiver - decorator(@receiver)
+# instanct - User object being saved
+# created - true/false
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     # Creates user, doesn't save it to the DB
     if created:
         UserProfile.objects.create(user=instance) # Here instance means "user object - the sender"
+        UserStats.objects.create(user=instance)
 
 @receiver(post_save, sender=User)
 def save_user_prfoile(sender, instance, **kwargs):
     instance.profile.save() # instance is actual model that saved in database
 
- 
\ No newline at end of file
+# With sharded posts every shard keeps a copy of the users and profiles, the posts are joined with them there
+@receiver(post_save, sender=UserProfile)
+def copy_user_to_shards(sender, instance, **kwargs):
+    if sharding.is_enabled():
+        sharding.copy_users([instance.user], [instance])
+
+@receiver(post_delete, sender=User)
+def delete_user_from_shards(sender, instance, using, **kwargs):
+    if sharding.is_enabled() and using not in sharding.get_copy_dbs():
+        sharding.delete_user_copies(instance.pk)
+
+ 
+# Keep Post.comments_count and UserStats.comments_count in sync with the comments table
+@receiver(post_save, sender=Comment)
+def increase_comments_count(sender, instance, created, **kwargs):
+    if created:
+        Post.update_counters(instance.post_id, comments_count=1)
+        UserStats.update_counters([instance.author_id], comments_count=1)
+
+@receiver(post_delete, sender=Comment)
+def decrease_comments_count(sender, instance, **kwargs):
+    Post.update_counters(instance.post_id, comments_count=-1)
+    UserStats.update_counters([instance.author_id], comments_count=-1)
+
+# Keep UserStats.posts_count/likes_received in sync with the posts table
+@receiver(post_save, sender=Post)
+def increase_posts_count(sender, instance, created, using, **kwargs):
+    if created:
+        UserStats.update_counters([instance.author_id], posts_count=1)
+        stamps.touch_post(instance.pk, instance.author_id, using=using)
+
+@receiver(pre_delete, sender=Post)
+def decrease_likes_received(sender, instance, using, **kwargs):
+    if instance.deleted_on is not None:
+        return # counted off by soft_delete()
+    # the stored likes_count, the instance being deleted may hold an outdated one
+    likes = Subquery(Post.objects.filter(pk=instance.pk).values('likes_count'))
+    if sharding.is_enabled(): # the post is on a shard, no subquery across databases
+        likes = Post.objects.using(using).filter(pk=instance.pk).values_list('likes_count', flat=True).first() or 0
+    UserStats.objects.filter(pk=instance.author_id).update(likes_received=F('likes_received') - likes)
+
+@receiver(post_delete, sender=Post)
+def decrease_posts_count(sender, instance, using, **kwargs):
+    if instance.deleted_on is None: # else counted off by soft_delete()
+        UserStats.update_counters([instance.author_id], posts_count=-1)
+    stamps.touch_post(instance.pk, instance.author_id, using=using)
+    if sharding.is_enabled(): # the cascade only reached the shard of the post
+        for model in (TimelineEntry, PostTag, Mention):
+            model.objects.filter(post_id=instance.pk).delete()
+
+# Keep UserStats.followers_count/following_count in sync with UserProfile.followers
+# profile.followers.add(user) and user.followers.add(profile) both land here, "reverse" tells them apart
+@receiver(m2m_changed, sender=UserProfile.followers.through)
+def update_follow_counts(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action in ('pre_remove', 'pre_clear'):
+        # remove() reports every pk it was given and clear() none, keep the follows that really go away
+        follows = sender.objects.filter(user_id=instance.pk) if reverse else sender.objects.filter(userprofile_id=instance.pk)
+        if pk_set is not None:
+            follows = follows.filter(**{'userprofile_id__in' if reverse else 'user_id__in': pk_set})
+        instance._removed_follows = list(follows.values_list('userprofile_id' if reverse else 'user_id', flat=True))
+        return
+    if action in ('post_remove', 'post_clear'):
+        pk_set, delta = instance.__dict__.pop('_removed_follows', []), -1
+    elif action == 'post_add':
+        delta = 1 # pk_set only holds the follows that didn't exist yet
+    else:
+        return
+    if not pk_set:
+        return
+
+    if reverse: # instance is the follower, pk_set the followed profiles
+        UserStats.update_counters([instance.pk], following_count=delta * len(pk_set))
+        UserStats.update_counters(pk_set, followers_count=delta)
+    else: # instance is the followed profile, pk_set the followers
+        UserStats.update_counters([instance.pk], followers_count=delta * len(pk_set))
+        UserStats.update_counters(pk_set, following_count=delta)
+    stamps.touch([stamps.profile_stamp(pk) for pk in [instance.pk, *pk_set]], using=using) # numbers and follow buttons
+
+# Deleting a user removes its follows without m2m_changed
+@receiver(pre_delete, sender=User)
+def remove_follow_counts(sender, instance, using, **kwargs):
+    if using in sharding.get_copy_dbs():
+        return # a copy of the user on a post shard, its follows are on "default"
+    Follow = UserProfile.followers.through
+    followed = list(Follow.objects.filter(user_id=instance.pk).values_list('userprofile_id', flat=True))
+    followers = list(Follow.objects.filter(userprofile_id=instance.pk).values_list('user_id', flat=True))
+    UserStats.update_counters(followed, followers_count=-1)
+    UserStats.update_counters(followers, following_count=-1)
+    stamps.touch([stamps.profile_stamp(pk) for pk in [instance.pk, *followed, *followers]], using=using)
@@ -0,0 +1,182 @@
+"""
+Keyset (cursor) pagination
+
+Pages are fetched with "WHERE (created_on, id) < cursor ORDER BY created_on, id LIMIT n"
+instead of OFFSET, so a page costs the same no matter how deep into the table it is.
+A cursor is just "<created_on in epoch microseconds>_<id>" which is cheap to build and parse,
+or "s<score>_<id>" for pages ordered by a float (the hot posts).
+"""
+import datetime
+import math
+
+from django.conf import settings
+from django.db.models import FloatField, Q
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def get_page_size():
+    return getattr(settings, 'SOCIAL_PAGE_SIZE', 20)
+
+
+def encode_cursor(created_on, pk):
+    """
+    Turn the (created_on, id) position of a row into a short url-safe string
+    `created_on` may also be a float score, kept exact with repr()
+    """
+    if isinstance(created_on, float):
+        return "s%r_%d" % (created_on, pk)
+    delta = created_on - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return "%d_%d" % (micros, pk)
+
+
+def decode_cursor(cursor, score=False):
+    """
+    Reverse of encode_cursor(), returns None for a missing or malformed cursor
+    or one of the other kind (score=True for the float cursors)
+    """
+    try:
+        micros, pk = cursor.split("_")
+        if score != micros.startswith("s"):
+            return None
+        if score:
+            value = float(micros[1:])
+            return (value, int(pk)) if math.isfinite(value) else None
+        return EPOCH + datetime.timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def get_cursor(request):
+    """
+    Read the cursor from the query string
+    ?before=<cursor> -> older page, ?after=<cursor> -> newer page
+    """
+    after = request.GET.get('after')
+    if after:
+        return after, "newer"
+    return request.GET.get('before'), "older"
+
+
+class KeysetPage:
+    """
+    One page of rows plus the cursors needed to link to the older/newer pages
+    """
+
+    def __init__(self, object_list, has_older, has_newer, time_field="created_on", id_field="pk"):
+        self.object_list = object_list
+        self.has_older = has_older and bool(object_list)
+        self.has_newer = has_newer and bool(object_list)
+        self.time_field = time_field
+        self.id_field = id_field
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    def _cursor_for(self, obj):
+        return encode_cursor(getattr(obj, self.time_field), getattr(obj, self.id_field))
+
+    @property
+    def older_cursor(self):
+        if self.has_older:
+            return self._cursor_for(self.object_list[-1])
+
+    @property
+    def newer_cursor(self):
+        if self.has_newer:
+            return self._cursor_for(self.object_list[0])
+
+    @property
+    def top_cursor(self):
+        # position of the newest row of the page, whether or not there are newer ones
+        if self.object_list:
+            return self._cursor_for(self.object_list[0])
+
+
+def keyset_paginate(queryset, cursor=None, direction="older", page_size=None, time_field="created_on", id_field="pk"):
+    """
+    Return a KeysetPage of `queryset`, newest first
+
+    direction="older" -> rows strictly after the cursor in (-created_on, -id) order
+    direction="newer" -> rows strictly before the cursor, still returned newest first
+    One extra row is fetched to know whether there is another page.
+    """
+    page_size = page_size or get_page_size()
+    position = _decode_position(queryset, cursor, time_field)
+    queryset = _keyset_queryset(queryset, position, direction, time_field, id_field)
+    rows = list(queryset[:page_size + 1])
+    return _keyset_page(rows, position, direction, page_size, time_field, id_field)
+
+
+async def akeyset_paginate(queryset, cursor=None, direction="older", page_size=None, time_field="created_on", id_field="pk"):
+    """
+    keyset_paginate() for async views
+    """
+    page_size = page_size or get_page_size()
+    position = _decode_position(queryset, cursor, time_field)
+    queryset = _keyset_queryset(queryset, position, direction, time_field, id_field)
+    rows = [obj async for obj in queryset[:page_size + 1]]
+    return _keyset_page(rows, position, direction, page_size, time_field, id_field)
+
+
+def _decode_position(queryset, cursor, time_field):
+    if not cursor:
+        return None
+    return decode_cursor(cursor, score=isinstance(queryset.model._meta.get_field(time_field), FloatField))
+
+
+def _keyset_queryset(queryset, position, direction, time_field, id_field):
+    if position and direction == "newer":
+        created_on, pk = position
+        return queryset.filter(
+            Q(**{time_field + '__gt': created_on}) | Q(**{time_field: created_on, id_field + '__gt': pk})
+        ).order_by(time_field, id_field)
+
+    if position:
+        created_on, pk = position
+        queryset = queryset.filter(
+            Q(**{time_field + '__lt': created_on}) | Q(**{time_field: created_on, id_field + '__lt': pk})
+        )
+    return queryset.order_by('-' + time_field, '-' + id_field)
+
+
+def _keyset_page(rows, position, direction, page_size, time_field, id_field):
+    if position and direction == "newer":
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        return KeysetPage(rows, has_older=True, has_newer=has_newer, time_field=time_field, id_field=id_field)
+
+    has_older = len(rows) > page_size
+    return KeysetPage(rows[:page_size], has_older=has_older, has_newer=position is not None, time_field=time_field, id_field=id_field)
+
+
+def merge_keyset_pages(pages, cursor=None, direction="older", page_size=None, time_field="created_on", id_field="pk"):
+    """
+    Merge several newest-first KeysetPages (e.g. one per source table or database shard) into a single page
+    Every source was fetched with the same cursor, so the merged page is exact as long as
+    each source page holds page_size rows
+    """
+    page_size = page_size or get_page_size()
+    rows = {}
+    for page in pages:
+        for obj in page:
+            rows[obj.pk] = obj # a row being moved between shards shows once
+    rows = sorted(rows.values(), key=lambda obj: (getattr(obj, time_field), getattr(obj, id_field)), reverse=True)
+
+    # the sources answered a malformed cursor with their first page, so does the merged page
+    position = decode_cursor(cursor, score=isinstance(getattr(rows[0], time_field), float)) if rows and cursor else None
+
+    more_in_sources = len(rows) > page_size
+    if position and direction == "newer":
+        has_newer = more_in_sources or any(page.has_newer for page in pages)
+        return KeysetPage(rows[-page_size:], has_older=True, has_newer=has_newer, time_field=time_field, id_field=id_field)
+
+    has_older = more_in_sources or any(page.has_older for page in pages)
+    return KeysetPage(rows[:page_size], has_older=has_older, has_newer=position is not None, time_field=time_field, id_field=id_field)
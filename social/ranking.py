@@ -0,0 +1,58 @@
+"""
+"Hot" ranking of the posts
+
+hot score = sign(points) * log2(1 + |points|) + age of the post in half-lives since HOT_EPOCH
+with points = likes - dislikes + SOCIAL_HOT_COMMENT_WEIGHT * comments
+
+Ranking by it is ranking by points * 2^(-age / half-life): every SOCIAL_HOT_HALF_LIFE_HOURS a post
+needs twice the points to stay level with a new one. Written this way the score of a post never
+changes while nobody touches it, so it is stored in Post.hot_score and served from an index.
+A reaction or comment adds the difference of the points term in the same UPDATE as the counters
+(hot_score_delta()), the "rescore_hot_posts" batch job recomputes the stored scores from the
+counters to wash out float drift and apply changed settings.
+"""
+import datetime
+import math
+
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Abs, Log, Sign
+
+HOT_EPOCH = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def get_half_life_seconds():
+    return getattr(settings, 'SOCIAL_HOT_HALF_LIFE_HOURS', 12) * 3600.0
+
+
+def get_comment_weight():
+    return getattr(settings, 'SOCIAL_HOT_COMMENT_WEIGHT', 2)
+
+
+def time_term(created_on):
+    return (created_on - HOT_EPOCH).total_seconds() / get_half_life_seconds()
+
+
+def points_term(likes, dislikes, comments):
+    points = likes - dislikes + get_comment_weight() * comments
+    return math.copysign(math.log2(1 + abs(points)), points) if points else 0.0
+
+
+def hot_score(likes, dislikes, comments, created_on):
+    return points_term(likes, dislikes, comments) + time_term(created_on)
+
+
+def _points_term_expression(likes, dislikes, comments):
+    points = likes - dislikes + Value(get_comment_weight()) * comments
+    return Sign(points) * Log(Value(2.0), Abs(points) + Value(1.0))
+
+
+def hot_score_delta(**deltas):
+    """
+    Expression adding to hot_score the change of the points term caused by the counter `deltas`
+    (e.g. likes_count=1), the F() references read the counters before the UPDATE
+    """
+    fields = ['likes_count', 'dislikes_count', 'comments_count']
+    before = [F(field) for field in fields]
+    after = [F(field) + deltas.get(field, 0) for field in fields]
+    return F('hot_score') + _points_term_expression(*after) - _points_term_expression(*before)
@@ -0,0 +1,299 @@
+"""
+Write-behind queue of the likes/dislikes (SOCIAL_REACTION_WRITE_BEHIND)
+
+SQLite runs one writer at a time, so under a burst of clicks on a viral post every reaction
+(row + counters + user stats) waits for the previous one. In write-behind mode a click only
+appends a row to a small SQLite side file (SOCIAL_REACTION_QUEUE_PATH, its own lock, fsync'ed),
+and a flusher thread applies the queued reactions in batched transactions: one transaction and
+one counter UPDATE per post for the whole batch, whatever the number of clicks.
+
+A queued row holds the reaction the user ends up with (value, or 0 for none), never "toggle",
+so applying a batch twice after a crash changes nothing. Until a row is flushed the reads merge it:
+Reaction.get_user_reactions() shows the user's own reaction, pending_counts() the counters.
+
+The queue lock is only held to claim a batch and to delete it: the batch is applied to the main
+database in between, while clicks keep being queued. A claim (claimed_at) keeps a second flusher
+off the batch until it is deleted, or until SOCIAL_REACTION_FLUSH_LEASE seconds have passed when
+its flusher died half-way.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+from . import sharding, stamps
+
+logger = logging.getLogger(__name__)
+
+NONE = 0 # queued value of a removed reaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS pending_user_post_idx ON pending (user_id, post_id);
+CREATE INDEX IF NOT EXISTS pending_post_idx ON pending (post_id);
+"""
+
+_local = threading.local()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'SOCIAL_REACTION_WRITE_BEHIND', False)
+
+
+def get_connection():
+    # one connection per thread (and per process, a forked worker opens its own)
+    path = str(getattr(settings, 'SOCIAL_REACTION_QUEUE_PATH', 'reaction_queue.sqlite3'))
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.key != (os.getpid(), path):
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL") # readers never wait for the flusher
+        conn.execute("PRAGMA synchronous=FULL") # a queued click survives a power loss
+        conn.executescript(SCHEMA)
+        if 'claimed_at' not in {column[1] for column in conn.execute("PRAGMA table_info(pending)")}:
+            conn.execute("ALTER TABLE pending ADD COLUMN claimed_at REAL") # queue file of an older version
+        _local.conn, _local.key = conn, (os.getpid(), path)
+    return conn
+
+
+class _immediate:
+    # BEGIN IMMEDIATE ... COMMIT on the queue: takes its write lock first, so queued rows and flushes never interleave
+    def __enter__(self):
+        self.conn = get_connection()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def _in_clause(values):
+    return ",".join("?" * len(values))
+
+
+def pending_for_user(user_pk, post_ids):
+    """
+    {post id: queued value} of the user's reactions not flushed yet (NONE when removed)
+    """
+    if not post_ids:
+        return {}
+    post_ids = list(post_ids)
+    rows = get_connection().execute(
+        "SELECT post_id, value FROM pending WHERE user_id = ? AND post_id IN (%s) ORDER BY id" % _in_clause(post_ids),
+        [user_pk, *post_ids],
+    )
+    return dict(rows.fetchall()) # the last queued value of each post wins
+
+
+def pending_for_posts(post_ids):
+    # {(post id, user id): queued value} of the reactions to these posts not flushed yet
+    if not post_ids:
+        return {}
+    post_ids = list(post_ids)
+    rows = get_connection().execute(
+        "SELECT post_id, user_id, value FROM pending WHERE post_id IN (%s) ORDER BY id" % _in_clause(post_ids), post_ids,
+    )
+    return {(post_id, user_id): value for post_id, user_id, value in rows}
+
+
+def current_values(pairs):
+    """
+    {(post id, user id): value} of the stored reactions of these pairs, missing ones are NONE
+    """
+    from .models import Reaction
+
+    if not pairs:
+        return {}
+    post_ids = {post_id for post_id, user_id in pairs}
+    user_ids = {user_id for post_id, user_id in pairs}
+    stored = {}
+    for db in sharding.get_post_dbs():
+        rows = Reaction.objects.using(db).filter(post_id__in=post_ids, user_id__in=user_ids).values_list('post_id', 'user_id', 'value')
+        stored.update(((post_id, user_id), value) for post_id, user_id, value in rows)
+    return {pair: stored.get(pair, NONE) for pair in pairs}
+
+
+def counter_deltas(changes):
+    """
+    {post id: {counter: delta}} of [(post id, value before, value after), ...]
+    """
+    from .models import Reaction
+
+    deltas = {}
+    for post_id, before, after in changes:
+        if before == after:
+            continue
+        counters = deltas.setdefault(post_id, {})
+        if before != NONE:
+            field = Reaction.COUNTER_FIELDS[before]
+            counters[field] = counters.get(field, 0) - 1
+        if after != NONE:
+            field = Reaction.COUNTER_FIELDS[after]
+            counters[field] = counters.get(field, 0) + 1
+    return deltas
+
+
+def pending_counts(post_ids):
+    """
+    {post id: {counter: delta}} still to be added to the stored counters of these posts
+    """
+    pending = pending_for_posts(post_ids)
+    stored = current_values(list(pending))
+    return counter_deltas((post_id, stored[post_id, user_id], value) for (post_id, user_id), value in pending.items())
+
+
+def push(post_pk, user_pk, decide):
+    """
+    Queue the reaction `decide(current value)` of the user to the post, returns (value before, value after)
+    The current value is the queued one if there is one, else the stored one
+    """
+    with _immediate() as conn:
+        row = conn.execute(
+            "SELECT value FROM pending WHERE user_id = ? AND post_id = ? ORDER BY id DESC LIMIT 1", [user_pk, post_pk]
+        ).fetchone()
+        before = row[0] if row else current_values([(post_pk, user_pk)])[post_pk, user_pk]
+        after = decide(before)
+        if after != before:
+            conn.execute("INSERT INTO pending (post_id, user_id, value) VALUES (?, ?, ?)", [post_pk, user_pk, after])
+    if after != before:
+        stamps.touch_post(post_pk) # the pages show the pending reactions right away
+    start_flusher()
+    return before, after
+
+
+def flush(limit=None):
+    """
+    Apply up to `limit` queued reactions (SOCIAL_REACTION_FLUSH_BATCH), in one transaction per shard, returns how many
+    """
+    limit = limit or getattr(settings, 'SOCIAL_REACTION_FLUSH_BATCH', 1000)
+    rows = claim(limit)
+    if not rows:
+        return 0
+    row_ids = [row_id for row_id, post_id, user_id, value in rows]
+    try:
+        final = {(post_id, user_id): value for row_id, post_id, user_id, value in rows}
+        by_db = {}
+        for (post_id, user_id), value in final.items():
+            by_db.setdefault(sharding.post_db(post_id), {})[post_id, user_id] = value
+        for db, reactions in by_db.items():
+            apply(reactions, db)
+    except BaseException:
+        release(row_ids, delete=False) # the next flush retries them
+        raise
+    release(row_ids, delete=True)
+    return len(rows)
+
+
+def claim(limit):
+    """
+    Mark the oldest `limit` queued rows as being applied and return them, nothing while another flusher holds a batch
+    """
+    now = time.time()
+    lease = getattr(settings, 'SOCIAL_REACTION_FLUSH_LEASE', 60)
+    with _immediate() as conn:
+        # a claimed batch is always the oldest rows, so the first row tells whether one is being applied
+        first = conn.execute("SELECT claimed_at FROM pending ORDER BY id LIMIT 1").fetchone()
+        if first is None or (first[0] is not None and first[0] > now - lease):
+            return []
+        rows = conn.execute("SELECT id, post_id, user_id, value FROM pending ORDER BY id LIMIT ?", [limit]).fetchall()
+        conn.execute("UPDATE pending SET claimed_at = ? WHERE id <= ?", [now, rows[-1][0]])
+    return rows
+
+
+def release(row_ids, delete, size=500):
+    # delete the applied rows, or drop the claim on them when they could not be applied
+    with _immediate() as conn:
+        for i in range(0, len(row_ids), size):
+            chunk = row_ids[i:i + size]
+            if delete:
+                conn.execute("DELETE FROM pending WHERE id IN (%s)" % _in_clause(chunk), chunk)
+            else:
+                conn.execute("UPDATE pending SET claimed_at = NULL WHERE id IN (%s)" % _in_clause(chunk), chunk)
+
+
+def apply(final, db):
+    """
+    Store the {(post id, user id): value} reactions to posts of the database `db` and move the counters
+    """
+    from .models import Post, Reaction
+
+    reactions = Reaction.objects.using(db)
+    with transaction.atomic(using=db):
+        # posts/users deleted since the click have nothing left to react to
+        post_ids = set(Post.objects.using(db).filter(pk__in={post_id for post_id, user_id in final}).values_list('pk', flat=True))
+        user_ids = set(User.objects.filter(pk__in={user_id for post_id, user_id in final}).values_list('pk', flat=True))
+        final = {(post_id, user_id): value for (post_id, user_id), value in final.items() if post_id in post_ids and user_id in user_ids}
+        stored = current_values(list(final))
+        changed = {pair: value for pair, value in final.items() if stored[pair] != value}
+
+        for query in _pairs_queries([pair for pair, value in changed.items() if value == NONE]):
+            reactions.filter(query).delete()
+        for value in Reaction.COUNTER_FIELDS:
+            switched = [pair for pair, after in changed.items() if after == value and stored[pair] != NONE]
+            for query in _pairs_queries(switched):
+                reactions.filter(query).update(value=value)
+        reactions.bulk_create([
+            Reaction(post_id=post_id, user_id=user_id, value=value)
+            for (post_id, user_id), value in changed.items() if value != NONE and stored[post_id, user_id] == NONE
+        ], ignore_conflicts=True)
+
+        deltas = counter_deltas((post_id, stored[post_id, user_id], value) for (post_id, user_id), value in changed.items())
+        for post_id, counters in deltas.items():
+            counters = {field: delta for field, delta in counters.items() if delta}
+            if counters: # a like and a dislike swapped between two users cancel out
+                Post.update_counters(post_id, **counters)
+
+
+def _pairs_queries(pairs, size=200):
+    # WHERE (post_id = ? AND user_id IN (...)) OR ... for a few posts at a time
+    users = {}
+    for post_id, user_id in pairs:
+        users.setdefault(post_id, []).append(user_id)
+    post_ids = list(users)
+    for i in range(0, len(post_ids), size):
+        query = Q()
+        for post_id in post_ids[i:i + size]:
+            query |= Q(post_id=post_id, user_id__in=users[post_id])
+        yield query
+
+
+def run_flusher():
+    interval = getattr(settings, 'SOCIAL_REACTION_FLUSH_INTERVAL', 0.2)
+    while True:
+        try:
+            flushed = flush()
+        except Exception:
+            logger.exception("Could not flush the queued reactions")
+            flushed = 0
+        finally:
+            close_old_connections()
+        if not flushed:
+            time.sleep(interval)
+
+
+def start_flusher():
+    # one daemon thread per process, started by the first queued reaction
+    # (unless SOCIAL_REACTION_FLUSH_THREAD is off because "flush_reactions --watch" runs on its own)
+    global _flusher
+    if not getattr(settings, 'SOCIAL_REACTION_FLUSH_THREAD', True):
+        return
+    if _flusher is not None and _flusher[0] == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher is None or _flusher[0] != os.getpid():
+            thread = threading.Thread(target=run_flusher, name='reaction-flusher', daemon=True)
+            thread.start()
+            _flusher = (os.getpid(), thread)
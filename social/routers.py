@@ -0,0 +1,150 @@
+"""
+Database routers: read replica, and the post shards of social/sharding.py (PostShardRouter)
+
+With SOCIAL_READ_REPLICA set to a DATABASES alias, the GET requests of the url names listed in
+SOCIAL_REPLICA_URL_NAMES (the read-heavy pages) read from the replica, everything else, and every
+write, goes to "default". ReadReplicaMiddleware decides per request and ReadReplicaRouter follows:
+- a request that writes switches back to the primary for the rest of the request
+- after a write the browser gets a cookie keeping it on the primary for SOCIAL_REPLICA_STICKY_SECONDS,
+  longer than the replication lag, so users always see their own posts and reactions
+- sessions are always read from the primary, a login is never lost to the lag
+Locally the replica is a second SQLite file, refreshed by "manage.py sync_replica".
+"""
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import sharding
+
+STICKY_COOKIE = 'social_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_current_routing = contextvars.ContextVar('social_db_routing', default=None)
+
+
+def get_replica_alias():
+    return getattr(settings, 'SOCIAL_READ_REPLICA', None)
+
+
+def reads_replica():
+    """
+    Whether the current request reads from the replica (see ReadReplicaRouter.db_for_read)
+    """
+    routing = _current_routing.get()
+    return bool(get_replica_alias()) and routing is not None and routing.replica and not routing.wrote
+
+
+class RequestRouting:
+    # mutated rather than replaced, so the decisions made in process_view/worker threads are seen by the request
+    def __init__(self, sticky):
+        self.sticky = sticky
+        self.replica = False
+        self.wrote = False
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = _current_routing.get()
+        if routing is None or not routing.replica or routing.wrote or model._meta.app_label == 'sessions':
+            return 'default'
+        return get_replica_alias() or 'default'
+
+    def db_for_write(self, model, **hints):
+        routing = _current_routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # the replica holds the same rows
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is a copy of the primary, it is never migrated on its own
+        return db != get_replica_alias()
+
+
+class PostShardRouter:
+    """
+    Sends new posts, comments and reactions to their shard (social/sharding.py), and the rows related
+    to a sharded row to the database it was read from
+    Queries without an instance go through the helpers of social/sharding.py, this router returns None
+    """
+    SHARDED_MODELS = ('post', 'comment', 'reaction')
+
+    def is_sharded(self, model):
+        return model._meta.app_label == 'social' and model._meta.model_name in self.SHARDED_MODELS
+
+    def get_db(self, model, instance):
+        if instance is None or not sharding.is_enabled() or not self.is_sharded(model) or not self.is_sharded(instance):
+            return None
+        if not instance._state.adding:
+            return instance._state.db # where it was read from
+        if instance._meta.model_name == 'post':
+            return sharding.author_db(instance.author_id) if instance.author_id is not None else None
+        post = instance._state.fields_cache.get('post') # a new comment/reaction goes where its post is
+        if post is not None and post._state.db is not None:
+            return post._state.db
+        return sharding.post_db(instance.post_id) if instance.post_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self.get_db(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.get_db(model, hints.get('instance'))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the data migrations (RunPython, no model) run on "default" only, "reshard_posts" copies the rows to the
+        # shards; one meant for the shards says so with hints={'shards': True}
+        if model_name is None and not hints.get('shards') and sharding.is_shard_database(db):
+            return False
+        return None
+
+
+class ReadReplicaMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        try:
+            sticky = float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        routing = RequestRouting(sticky)
+        return routing, _current_routing.set(routing)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        routing, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_routing.reset(token)
+        return self.finish(request, response, routing)
+
+    async def __acall__(self, request):
+        routing, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_routing.reset(token)
+        return self.finish(request, response, routing)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routing = _current_routing.get()
+        if routing is not None and get_replica_alias() and not routing.sticky and request.method in SAFE_METHODS:
+            routing.replica = request.resolver_match.url_name in getattr(settings, 'SOCIAL_REPLICA_URL_NAMES', [])
+
+    def finish(self, request, response, routing):
+        if get_replica_alias() and (routing.wrote or request.method not in SAFE_METHODS):
+            seconds = getattr(settings, 'SOCIAL_REPLICA_STICKY_SECONDS', 15)
+            response.set_cookie(STICKY_COOKIE, '%d' % (time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,159 @@
+"""
+Full-text search over post bodies and comments
+
+On SQLite the text lives in the FTS5 table "social_search", filled and kept in sync by the
+triggers of migration 0009 (rowid = post id * 2 for posts, comment id * 2 + 1 for comments).
+Results are ranked by bm25, damped by the age of the matching text so recent posts come first.
+Other databases fall back to a plain (slow) icontains filter.
+With sharded posts (social/sharding.py) each shard indexes its own posts and comments, a search asks all of them.
+"""
+import re
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from . import sharding
+from .models import Post
+
+SEARCH_TABLE = 'social_search'
+MAX_TERMS = 10
+
+# (table, rowid of a row, post it belongs to, indexed text column)
+INDEXED_SOURCES = [
+    ('social_post', 'id * 2', 'id', 'body'),
+    ('social_comment', 'id * 2 + 1', 'post_id', 'comment'),
+]
+
+# Same table and triggers as migration 0009. SQLite drops the triggers of a table whenever a migration
+# rebuilds it (e.g. AddField), so they are created again after every migrate (see SocialConfig.ready)
+CREATE_INDEX_SQL = (
+    "CREATE VIRTUAL TABLE %s USING fts5("
+    "body, post_id UNINDEXED, created_on UNINDEXED, tokenize='unicode61 remove_diacritics 2')"
+)
+
+
+def get_triggers_sql(index_table=SEARCH_TABLE, name='search'):
+    """
+    CREATE TRIGGER statements keeping `index_table` in sync with the posts and comments,
+    the triggers are called <table>_<name>_ai/au/ad
+    """
+    statements = []
+    for table, rowid, post_id, column in INDEXED_SOURCES:
+        insert = "INSERT INTO %s(rowid, body, post_id, created_on) VALUES (%s, new.%s, new.%s, new.created_on);" % (
+            index_table, rowid.replace('id', 'new.id'), column, post_id)
+        delete = "DELETE FROM %s WHERE rowid = %s;" % (index_table, rowid.replace('id', 'old.id'))
+        statements += [
+            "CREATE TRIGGER IF NOT EXISTS %s_%s_ai AFTER INSERT ON %s BEGIN %s END" % (table, name, table, insert),
+            "CREATE TRIGGER IF NOT EXISTS %s_%s_au AFTER UPDATE OF %s ON %s BEGIN %s %s END" % (table, name, column, table, delete, insert),
+            "CREATE TRIGGER IF NOT EXISTS %s_%s_ad AFTER DELETE ON %s BEGIN %s END" % (table, name, table, delete),
+        ]
+    return statements
+
+
+def get_drop_triggers_sql(name='search'):
+    return ["DROP TRIGGER IF EXISTS %s_%s_%s" % (source[0], name, event) for source in INDEXED_SOURCES for event in ('ai', 'au', 'ad')]
+
+
+TRIGGERS_SQL = get_triggers_sql()
+
+
+def is_supported():
+    return connection.vendor == 'sqlite'
+
+
+def ensure_triggers(using='default', **kwargs):
+    """
+    post_migrate handler: put back the sync triggers a table rebuild may have dropped
+    """
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return
+    with db.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [SEARCH_TABLE])
+        if cursor.fetchone() is None: # migration 0009 not applied yet
+            return
+        for sql in TRIGGERS_SQL:
+            cursor.execute(sql)
+
+
+def index_batch(cursor, table, after_id, batch_size, index_table=SEARCH_TABLE):
+    """
+    Copy the next `batch_size` rows of `table` with id > after_id into the index
+    Returns the last id copied, or None when the table is exhausted
+    """
+    rowid, post_id, column = next((r, p, c) for t, r, p, c in INDEXED_SOURCES if t == table)
+    cursor.execute("SELECT MAX(id) FROM (SELECT id FROM %s WHERE id > %%s ORDER BY id LIMIT %%s)" % table, [after_id, batch_size])
+    last_id = cursor.fetchone()[0]
+    if last_id is None:
+        return None
+    cursor.execute(
+        "INSERT OR REPLACE INTO %s(rowid, body, post_id, created_on) SELECT %s, %s, %s, created_on FROM %s WHERE id > %%s AND id <= %%s"
+        % (index_table, rowid, column, post_id, table),
+        [after_id, last_id],
+    )
+    return last_id
+
+
+def build_match_query(text):
+    """
+    Turn user input into a safe FTS5 query: every word must match, the last one as a prefix
+    Returns None if there is nothing to search for
+    """
+    terms = re.findall(r"\w+", text or "")[:MAX_TERMS]
+    if not terms:
+        return None
+    quoted = ['"%s"' % term.replace('"', '""') for term in terms]
+    quoted[-1] += '*'
+    return " ".join(quoted)
+
+
+def search_posts(text, page=1, page_size=None):
+    """
+    Returns (posts of the page, has_next_page) for the search `text`
+    A post matches through its body or any of its comments, it is ranked by its best match
+    """
+    page_size = page_size or getattr(settings, 'SOCIAL_PAGE_SIZE', 20)
+    offset = (page - 1) * page_size
+    # with sharded posts every shard has its own index: each one returns its first offset + page_size + 1
+    # results and they are merged, the scores of the shards are close enough to be compared
+    dbs = sharding.get_post_dbs()
+    limit, skip = (page_size + 1, offset) if len(dbs) == 1 else (offset + page_size + 1, 0)
+
+    if not is_supported():
+        if not (text or "").strip():
+            return [], False
+        posts = []
+        for db in dbs:
+            posts += Post.objects.using(db).filter(body__icontains=text.strip()).select_related('author').order_by('-created_on', '-id')[skip:skip + limit]
+        posts = sorted(posts, key=lambda post: (post.created_on, post.pk), reverse=True)[offset - skip:offset - skip + page_size + 1]
+        return posts[:page_size], len(posts) > page_size
+
+    match = build_match_query(text)
+    if match is None:
+        return [], False
+
+    half_life = getattr(settings, 'SOCIAL_SEARCH_RECENCY_DAYS', 30)
+    matches = []
+    for db in dbs:
+        with connections[db or DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(
+                # bm25() can't be used inside an aggregate, so the matches are scored first in a materialized CTE
+                "WITH matches AS MATERIALIZED ("
+                "SELECT post_id, bm25({table}) / (1.0 + MAX(julianday('now') - julianday(created_on), 0) / %s) AS score "
+                "FROM {table} WHERE {table} MATCH %s "
+                # the deleted posts (until they are purged) are left out before the page is cut, through their partial index
+                "AND post_id NOT IN (SELECT id FROM social_post WHERE deleted_on IS NOT NULL)"
+                ") SELECT post_id, MIN(score) AS best FROM matches "
+                "GROUP BY post_id ORDER BY best, post_id DESC LIMIT %s OFFSET %s".format(table=SEARCH_TABLE),
+                [half_life, match, limit, skip],
+            )
+            matches += cursor.fetchall()
+    matches.sort(key=lambda row: (row[1], -row[0]))
+    post_ids = [row[0] for row in matches[offset - skip:offset - skip + page_size + 1]]
+
+    has_next = len(post_ids) > page_size
+    post_ids = post_ids[:page_size]
+    posts = {}
+    for db in dbs:
+        posts.update(Post.objects.using(db).select_related('author').in_bulk(post_ids))
+    return [posts[pk] for pk in post_ids if pk in posts], has_next
@@ -0,0 +1,162 @@
+"""
+Posts sharded by author (SOCIAL_POST_SHARDS)
+
+With SOCIAL_POST_SHARDS = ["shard0", "shard1", ...] (DATABASES aliases) the posts, their comments
+and reactions are stored on the shard of their author, everything else stays on "default".
+An author belongs to one of SLOTS logical slots (author id % SLOTS) and a slot to one shard
+(slot % number of shards), so adding shards moves whole slots ("manage.py reshard_posts").
+
+The id of a post or comment carries its slot ((milliseconds << 13) | (sequence << 6) | slot),
+so the shard of a post is found from its id alone, without a lookup table. The ids still grow
+with time and stay below 2**53 (safe in JavaScript). Posts created before sharding keep their
+small ids: those are looked up on every shard in turn the first time, then the shard found is
+kept in the cache (per list of shards, "reshard_posts" records where it moves them).
+
+- one author's timeline is a range scan on one shard
+- the latest/hot feeds read one page from every shard and merge them (pagination.merge_keyset_pages)
+- users and profiles are copied to every shard, the posts are joined with their authors there
+Without SOCIAL_POST_SHARDS every helper returns None ("let the routers decide"): nothing changes.
+"""
+import copy
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, router, transaction
+
+SLOTS = 64 # never change it: the slot is part of the ids
+ID_EPOCH_MS = 1704067200000 # 2024-01-01 UTC
+LEGACY_ID_LIMIT = 2 ** 40 # ids below were given by the database before sharding
+
+_sequence = itertools.count()
+_sequence_lock = threading.Lock()
+
+
+def get_shards():
+    return list(getattr(settings, 'SOCIAL_POST_SHARDS', []))
+
+
+def is_enabled():
+    return bool(get_shards())
+
+
+def get_post_dbs():
+    """
+    Databases to read to see every post: the shards, or [None] (the default routing) without sharding
+    """
+    return get_shards() or [None]
+
+
+def shard_for_slot(slot):
+    shards = get_shards()
+    return shards[slot % len(shards)]
+
+
+def author_db(author_id):
+    # shard of the posts of an author
+    if not is_enabled():
+        return None
+    return shard_for_slot(author_id % SLOTS)
+
+
+def post_db(post_pk):
+    """
+    Shard of a post (and of its comments and reactions), None without sharding
+    A post from before sharding is looked for on every shard the first time, one query per shard tried
+    """
+    if not is_enabled():
+        return None
+    post_pk = int(post_pk)
+    if post_pk >= LEGACY_ID_LIMIT:
+        return shard_for_slot(post_pk % SLOTS)
+
+    key = legacy_location_key(post_pk)
+    alias = cache.get(key)
+    if alias is not None:
+        return alias
+    from .models import Post
+    shards = get_shards()
+    for alias in shards:
+        if Post.all_objects.using(alias).filter(pk=post_pk).exists():
+            cache.set(key, alias, None)
+            return alias
+    return shards[0] # missing everywhere: any shard answers "does not exist" (not cached, it may be created later)
+
+
+def legacy_location_key(post_pk):
+    # the shard of a post from before sharding depends on the list of shards: adding one gives new keys
+    return 'post-shard:%s:%d' % (','.join(get_shards()), int(post_pk))
+
+
+def record_legacy_locations(post_pks, alias):
+    """
+    The posts from before sharding among `post_pks` are on `alias` now ("reshard_posts" moved them)
+    """
+    legacy = [pk for pk in post_pks if pk < LEGACY_ID_LIMIT]
+    if legacy:
+        cache.set_many({legacy_location_key(pk): alias for pk in legacy}, None)
+
+
+def new_id(slot):
+    # (milliseconds since ID_EPOCH_MS << 13) | (sequence << 6) | slot, 128 ids per millisecond and slot
+    with _sequence_lock:
+        sequence = next(_sequence) % 128
+    milliseconds = int(time.time() * 1000) - ID_EPOCH_MS
+    return (milliseconds << 13) | (sequence << 6) | (slot % SLOTS)
+
+
+def save_with_new_id(instance, slot, save, using=None, force_insert=False, **kwargs):
+    """
+    Insert a new post/comment with an id of `slot`, a new id is drawn if another process took the same one
+    `save` is the Model.save() of the instance, forced to insert: an UPDATE would overwrite the other row
+    The row goes to the shard chosen by PostShardRouter whatever `using` says: the managers
+    (Post.objects.create()) pass "default" along
+    """
+    using = router.db_for_write(type(instance), instance=instance) or using
+    for attempt in range(3):
+        instance.pk = new_id(slot)
+        try:
+            with transaction.atomic(using=using):
+                return save(force_insert=True, using=using, **kwargs)
+        except IntegrityError:
+            if attempt == 2:
+                raise
+
+
+def get_copy_dbs():
+    # shards holding copies of the users
+    return [alias for alias in get_shards() if alias != DEFAULT_DB_ALIAS]
+
+
+def is_shard_database(alias):
+    # a shard database, sharding on or not (the test runs have shards turned on by some tests only)
+    return alias != DEFAULT_DB_ALIAS and alias in set(get_shards()) | set(getattr(settings, 'SOCIAL_SHARD_DATABASES', []))
+
+
+def copy_users(users, profiles=()):
+    """
+    Copy (insert or update) users and profiles to every shard, in a few statements without signals
+    """
+    from django.contrib.auth.models import User
+    from .models import UserProfile
+
+    for alias in get_copy_dbs():
+        for model, rows in ((User, users), (UserProfile, profiles)):
+            rows = [copy.copy(row) for row in rows] # bulk_create marks the rows as saved on the shard
+            if not rows:
+                continue
+            pk = model._meta.pk
+            fields = [field.name for field in model._meta.concrete_fields if field is not pk]
+            model.objects.using(alias).bulk_create(rows, batch_size=500, update_conflicts=True, unique_fields=[pk.name], update_fields=fields)
+
+
+def delete_user_copies(user_pk):
+    """
+    Delete a user from the shards, with the posts, comments and reactions stored there
+    """
+    from django.contrib.auth.models import User
+
+    for alias in get_copy_dbs():
+        User.objects.using(alias).filter(pk=user_pk).delete()
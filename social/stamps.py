@@ -0,0 +1,166 @@
+"""
+Last-modified stamps of the pages, and conditional GET (304 Not Modified) on top of them
+
+A stamp is the time of the last change of what a page shows, kept in the SOCIAL_STAMP_CACHE cache:
+- "feed": the latest posts (any new, edited, deleted post, reaction, comment or author avatar)
+- "post:<pk>": a post page (the post, its comments and counters)
+- "profile:<pk>": a profile page (the profile, its numbers, follows and the posts of the user)
+- "trending": the trending tags panel, touched when social/tags.py computes a different list
+The writes touch them once committed (Post.update_counters/bump_version, the signals of
+social/models.py, the reaction queue), so checking a page costs one cache lookup and no query.
+
+A view opts in with @conditional_page(lambda request, **kwargs: [stamp keys]): a GET whose
+If-None-Match/If-Modified-Since still match the stamps gets a 304 before the view runs.
+The ETag also holds what makes the page differ between viewers (user, CSRF cookie, AJAX fragment).
+A stamp missing from the cache (evicted, restarted) counts as changed now. The cache must be shared
+by every process writing posts (a locmem cache is per process, fine for a single runserver).
+
+A page read from the replica (social/routers.py) shows the writes up to the replica position, the
+time its last refresh started ("sync_replica" stores it, set_replica_position()): its stamps are
+capped at that position, so the page gets a new ETag once the replica holds the change, not before.
+Without a known position a replica page has no ETag/Last-Modified and is always rendered.
+"""
+import datetime
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from . import routers, sharding
+
+FEED = 'feed'
+TRENDING = 'trending'
+REPLICA_POSITION = 'replica-position'
+
+
+def get_stamp_cache():
+    return caches[getattr(settings, 'SOCIAL_STAMP_CACHE', 'default')]
+
+
+def post_stamp(pk):
+    return 'post:%d' % int(pk)
+
+
+def profile_stamp(pk):
+    return 'profile:%d' % int(pk)
+
+
+def touch(keys, using=None):
+    """
+    Mark the stamps as changed now, once the transaction of `using` commits (right away outside one)
+    Touching earlier would let a request store the old page under the new stamp
+    """
+    keys = list(keys)
+    if keys:
+        transaction.on_commit(lambda: get_stamp_cache().set_many(dict.fromkeys(keys, time.time()), None), using=using)
+
+
+def touch_post(pk, author_id=None, using=None):
+    """
+    A post changed: its page, the profile of its author (which lists it) and the latest posts
+    """
+    def touch_now():
+        author = author_id if author_id is not None else get_post_author(pk)
+        keys = [post_stamp(pk), FEED] + ([profile_stamp(author)] if author is not None else [])
+        get_stamp_cache().set_many(dict.fromkeys(keys, time.time()), None)
+
+    if author_id is not None:
+        get_stamp_cache().set('post-author:%d' % int(pk), author_id, None)
+    transaction.on_commit(touch_now, using=using)
+
+
+def get_post_author(pk):
+    # author id of a post, remembered in the stamp cache so a reaction doesn't look it up every time
+    cache = get_stamp_cache()
+    key = 'post-author:%d' % int(pk)
+    author_id = cache.get(key)
+    if author_id is None:
+        from .models import Post
+
+        author_id = Post.objects.using(sharding.post_db(pk)).filter(pk=pk).values_list('author_id', flat=True).first()
+        if author_id is not None:
+            cache.set(key, author_id, None)
+    return author_id
+
+
+def get_stamps(keys):
+    """
+    {key: time of the last change} of these stamps, the missing ones are stored as changed now
+    """
+    cache = get_stamp_cache()
+    stamps = cache.get_many(keys)
+    now = time.time()
+    for key in keys:
+        if key not in stamps:
+            cache.add(key, now, None) # a touch stored meanwhile wins
+            stamps[key] = now
+    return stamps
+
+
+def set_replica_position(moment):
+    # the replica holds every write committed before `moment` (a time.time()), told by whatever refreshes it
+    get_stamp_cache().set(REPLICA_POSITION, moment, None)
+
+
+def get_page_stamps(keys):
+    """
+    Stamps of a page as the current request sees it, None when they can't tell (replica at an unknown position)
+    """
+    stamps = get_stamps(keys)
+    if routers.reads_replica():
+        position = get_stamp_cache().get(REPLICA_POSITION)
+        if position is None:
+            return None
+        stamps = {key: min(stamp, position) for key, stamp in stamps.items()} # not on the replica yet
+    return stamps
+
+
+def conditional_page(get_keys):
+    """
+    View decorator: answer a GET/HEAD with 304 Not Modified while the stamps of the page didn't change
+    `get_keys(request, *args, **kwargs)` returns the stamp keys the page shows, it must only read caches
+    The response always gets "Cache-Control: private, no-cache": the browser checks again on every view
+    """
+    def get_request_stamps(request, *args, **kwargs):
+        if not hasattr(request, '_social_stamps'): # asked for by both the ETag and the Last-Modified
+            request._social_stamps = get_page_stamps(get_keys(request, *args, **kwargs))
+        return request._social_stamps
+
+    def etag(request, *args, **kwargs):
+        stamps = get_request_stamps(request, *args, **kwargs)
+        if stamps is None:
+            return None
+        parts = ['%s=%r' % (key, stamps[key]) for key in sorted(stamps)]
+        parts += [
+            str(request.user.pk or 0),
+            request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''), # the forms of the page hold the token
+            request.headers.get('x-requested-with', ''), # the AJAX fragment has the url of the page
+        ]
+        return hashlib.md5('|'.join(parts).encode(), usedforsecurity=False).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        stamps = get_request_stamps(request, *args, **kwargs)
+        if stamps is None:
+            return None
+        return datetime.datetime.fromtimestamp(max(stamps.values()), tz=datetime.timezone.utc)
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if len(get_messages(request)):
+                response = view(request, *args, **kwargs) # the messages are shown by the next page rendered
+            else:
+                response = conditional_view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD'):
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return inner
+    return decorator
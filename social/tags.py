@@ -0,0 +1,167 @@
+"""
+Hashtags and mentions
+
+The "#tag" and "@username" of a post are parsed when it is written and stored in the
+PostTag/Mention tables, indexed like the timelines, so a tag page is a keyset paginated range
+scan instead of a search through Post.body.
+Trending tags come from TagBucket: one counter per tag and hour, bumped when a tag is used.
+The score of a tag is the sum of its buckets of the last SOCIAL_TRENDING_WINDOW_HOURS, each
+halved every SOCIAL_TRENDING_HALF_LIFE_HOURS of age, so only the counters of the window are
+read (never the posts) and the result is cached for a minute; when a new list differs from the
+last one the "trending" stamp is touched, the latest posts page shows the panel. The buckets that left the window
+are deleted by "manage.py prune_tag_buckets", never while a page renders.
+"""
+import datetime
+import heapq
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import stamps
+from .models import Hashtag, Mention, PostTag, TagBucket
+
+HASHTAG_RE = re.compile(r'(?<![\w&#])#(\w{1,50})')
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.@+-]{1,150})')
+TRENDING_CACHE_KEY = 'trending-tags'
+TRENDING_NAMES_KEY = 'trending-tags-names' # the names the panel last showed, never expires
+
+
+def parse_post(body):
+    """
+    ({tag names, lowercase}, {usernames}) of a post body
+    """
+    tags = {name.lower() for name in HASHTAG_RE.findall(body)}
+    usernames = {name.rstrip('.') for name in MENTION_RE.findall(body)} # "@bob." at the end of a sentence
+    return tags, usernames
+
+
+def get_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def get_tag_ids(names):
+    # {name: id}, creating the tags used for the first time
+    if not names:
+        return {}
+    Hashtag.objects.bulk_create([Hashtag(name=name) for name in names], ignore_conflicts=True)
+    return dict(Hashtag.objects.filter(name__in=names).values_list('name', 'pk'))
+
+
+def count_tags(counts, moment=None):
+    """
+    Add {tag id: uses} to the trending counters of the hour of `moment` (now by default)
+    The rows are created first, so concurrent writers only ever add to them
+    """
+    if not counts:
+        return
+    hour = get_bucket(moment or timezone.now())
+    TagBucket.objects.bulk_create([TagBucket(tag_id=tag_id, hour=hour) for tag_id in counts], ignore_conflicts=True)
+    for uses in set(counts.values()):
+        tag_ids = [tag_id for tag_id, count in counts.items() if count == uses]
+        TagBucket.objects.filter(tag_id__in=tag_ids, hour=hour).update(count=F('count') + uses)
+
+
+def index_post(post):
+    """
+    Store the tags and mentions of a post that was just created or edited
+    Tags newly added to the post count as a use in the current hour
+    """
+    names, usernames = parse_post(post.body)
+    with transaction.atomic():
+        tag_ids = set(get_tag_ids(names).values())
+        PostTag.objects.filter(post=post).exclude(tag_id__in=tag_ids).delete()
+        new_tag_ids = tag_ids - set(PostTag.objects.filter(post=post).values_list('tag_id', flat=True))
+        PostTag.objects.bulk_create(
+            [PostTag(post=post, tag_id=tag_id, created_on=post.created_on) for tag_id in new_tag_ids],
+            ignore_conflicts=True,
+        )
+        count_tags(dict.fromkeys(new_tag_ids, 1))
+
+        user_ids = set(User.objects.filter(username__in=usernames).values_list('pk', flat=True)) if usernames else set()
+        Mention.objects.filter(post=post).exclude(user_id__in=user_ids).delete()
+        Mention.objects.bulk_create(
+            [Mention(post=post, user_id=user_id, created_on=post.created_on) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+
+
+def index_new_posts(posts):
+    """
+    index_post() for a batch of posts that have no tags/mentions stored yet (bulk inserts)
+    Only the posts of the trending window are counted, in the hour they were written
+    """
+    parsed = [(post, *parse_post(post.body)) for post in posts]
+    tag_ids = get_tag_ids({name for post, names, usernames in parsed for name in names})
+    usernames = {username for post, names, post_usernames in parsed for username in post_usernames}
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk')) if usernames else {}
+
+    cutoff = get_bucket(timezone.now()) - datetime.timedelta(hours=get_window_hours())
+    buckets = {}
+    post_tags = []
+    mentions = []
+    for post, names, post_usernames in parsed:
+        for name in names:
+            post_tags.append(PostTag(post_id=post.pk, tag_id=tag_ids[name], created_on=post.created_on))
+            if post.created_on >= cutoff:
+                buckets.setdefault(get_bucket(post.created_on), Counter())[tag_ids[name]] += 1
+        mentions.extend(
+            Mention(post_id=post.pk, user_id=user_ids[username], created_on=post.created_on)
+            for username in post_usernames if username in user_ids
+        )
+
+    with transaction.atomic():
+        PostTag.objects.bulk_create(post_tags, batch_size=1000, ignore_conflicts=True)
+        Mention.objects.bulk_create(mentions, batch_size=1000, ignore_conflicts=True)
+        for hour, counts in buckets.items():
+            count_tags(counts, hour)
+
+
+def get_window_hours():
+    return getattr(settings, 'SOCIAL_TRENDING_WINDOW_HOURS', 24)
+
+
+def get_trending_tags(limit=10):
+    """
+    [(tag name, score), ...] of the most used tags of the window, best first
+    """
+    trending = cache.get(TRENDING_CACHE_KEY)
+    if trending is None:
+        trending = compute_trending_tags()
+        cache.set(TRENDING_CACHE_KEY, trending, getattr(settings, 'SOCIAL_TRENDING_TIMEOUT', 60))
+        names = [name for name, score in trending] # the panel doesn't show the scores
+        if cache.get(TRENDING_NAMES_KEY) != names:
+            cache.set(TRENDING_NAMES_KEY, names, None)
+            stamps.touch([stamps.TRENDING])
+    return trending[:limit]
+
+
+def compute_trending_tags(size=50):
+    # a single query with the tag names joined in, it runs while a page renders
+    now = timezone.now()
+    cutoff = get_bucket(now) - datetime.timedelta(hours=get_window_hours())
+    half_life = getattr(settings, 'SOCIAL_TRENDING_HALF_LIFE_HOURS', 6) * 3600.0
+
+    scores = Counter()
+    for name, hour, count in TagBucket.objects.filter(hour__gte=cutoff).values_list('tag__name', 'hour', 'count'):
+        scores[name] += count * 0.5 ** ((now - hour).total_seconds() / half_life)
+    return [(name, round(score, 2)) for name, score in heapq.nlargest(size, scores.items(), key=lambda item: item[1])]
+
+
+def prune_tag_buckets(batch_size=1000):
+    """
+    Delete the buckets that left the trending window, batch_size rows per statement ("manage.py prune_tag_buckets")
+    Returns how many were deleted
+    """
+    cutoff = get_bucket(timezone.now()) - datetime.timedelta(hours=get_window_hours())
+    deleted = 0
+    while True:
+        pks = list(TagBucket.objects.filter(hour__lt=cutoff).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += TagBucket.objects.filter(pk__in=pks).delete()[0]
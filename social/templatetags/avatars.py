@@ -0,0 +1,16 @@
+from django import template
+
+from ..images import thumbnail_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def avatar_url(profile, size):
+    """
+    {% avatar_url profile 48 %} -> URL of the pre-sized avatar of the profile picture,
+    or of the original picture while the avatars are not processed yet
+    """
+    if profile.picture_hash:
+        return thumbnail_url(profile.picture_hash, int(size))
+    return profile.picture.url if profile.picture else ''
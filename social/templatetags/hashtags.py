@@ -0,0 +1,13 @@
+from django import template
+
+from ..tags import get_trending_tags
+
+register = template.Library()
+
+
+@register.inclusion_tag('social/trending_tags.html')
+def trending_tags(limit=10):
+    """
+    {% trending_tags 10 %} -> panel linking to the pages of the trending hashtags
+    """
+    return {'tags': get_trending_tags(limit)}
@@ -0,0 +1,81 @@
+"""
+{% post_cards posts variant %} renders the post cards of a page through a fragment cache
+
+A card is cached under its post id, Post.version (bumped on edit, reaction and comment) and the
+UserProfile.version of its author (bumped when the avatar changes), so a stale card is never
+served, nothing has to be deleted and a new avatar doesn't rewrite every post of its user.
+The cache is the SOCIAL_POST_CARD_CACHE alias of CACHES: a bounded in-process LRU (locmem)
+by default, any shared backend (memcached, redis) can be plugged in through the settings.
+In write-behind mode (social/reaction_queue.py) the posts with clicks not flushed yet are rendered
+with the pending counts and not cached, their version changes once the clicks are applied.
+"""
+import copy
+
+from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .. import reaction_queue
+
+register = template.Library()
+
+# User content is always escaped, so a "<" can only come from these placeholders
+CSRF_PLACEHOLDER = '<!--csrf_token-->'
+NEXT_PLACEHOLDER = '<!--next_path-->'
+
+
+def get_card_cache():
+    return caches[getattr(settings, 'SOCIAL_POST_CARD_CACHE', 'default')]
+
+
+def card_cache_key(post, variant):
+    # the posts of the pages are read with select_related('author__profile')
+    return 'post-card:%s:%d:%d:%d' % (variant, post.pk, post.version, post.author.profile.version)
+
+
+def render_card(post, variant):
+    return render_to_string('social/post_card.html', {
+        'post': post,
+        'variant': variant,
+        'csrf_placeholder': CSRF_PLACEHOLDER,
+        'next_placeholder': NEXT_PLACEHOLDER,
+    })
+
+
+def with_counts(post, deltas):
+    post = copy.copy(post)
+    for field, delta in deltas.items():
+        setattr(post, field, max(getattr(post, field) + delta, 0))
+    return post
+
+
+@register.simple_tag(takes_context=True)
+def post_cards(context, posts, variant):
+    posts = list(posts)
+    pending = reaction_queue.pending_counts([post.pk for post in posts]) if reaction_queue.is_enabled() else {}
+    cache = get_card_cache()
+    keys = {post.pk: card_cache_key(post, variant) for post in posts if post.pk not in pending}
+    cached = cache.get_many(list(keys.values()))
+
+    missing = {}
+    cards = []
+    for post in posts:
+        if post.pk in pending:
+            cards.append(render_card(with_counts(post, pending[post.pk]), variant))
+            continue
+        card = cached.get(keys[post.pk])
+        if card is None:
+            card = missing[keys[post.pk]] = render_card(post, variant)
+        cards.append(card)
+    if missing:
+        cache.set_many(missing, getattr(settings, 'SOCIAL_POST_CARD_TIMEOUT', 3600))
+
+    html = "\n".join(cards)
+    request = context.get('request')
+    if request is not None and CSRF_PLACEHOLDER in html:
+        html = html.replace(CSRF_PLACEHOLDER, get_token(request)).replace(NEXT_PLACEHOLDER, escape(request.path))
+    return mark_safe(html)
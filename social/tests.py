@@ -1,3 +1,1987 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import datetime
+import html
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.template.backends.django import Template as DjangoTemplate
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .models import Post, Comment, Hashtag, Job, Mention, PostTag, Reaction, TagBucket, TimelineEntry, UserProfile, UserStats
+from . import benchmark, jobs, middleware, ranking, reaction_queue, search, sharding, stamps
+from .routers import STICKY_COOKIE
+from .images import process_profile_picture, render_thumbnails, thumbnail_name, thumbnail_url
+from .middleware import RequestStats, RequestTiming, install_template_timer, request_stats
+from .live import Broadcaster, broadcaster, latest_posts_events
+from .pagination import decode_cursor, encode_cursor
+from .search import search_posts
+from .tags import TRENDING_CACHE_KEY, count_tags, get_trending_tags, index_new_posts, prune_tag_buckets
+from .templatetags.post_cards import CSRF_PLACEHOLDER, NEXT_PLACEHOLDER, card_cache_key, get_card_cache
+
+# the post shards when SOCIAL_SHARD_PATHS turns sharding on, the tests reading posts may use them
+POST_DATABASES = {'default', *settings.SOCIAL_POST_SHARDS}
+
+
+class QueryRecorder:
+    # execute_wrapper keeping the raw sql and params of every query, so they can be EXPLAINed afterwards
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many:
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Every query run by the social views has to be served by an index:
+    EXPLAIN QUERY PLAN may not show a full table scan ("SCAN <table>" without an index)
+    or a sort in a temporary b-tree ("USE TEMP B-TREE FOR ORDER BY")
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.user.profile.followers.add(cls.reader)
+        for i in range(30):
+            post = Post.objects.create(body='post number %d #django' % i, author=cls.user if i % 2 else cls.reader)
+            TimelineEntry.fan_out(post)
+            Comment.objects.create(post=post, author=cls.reader, comment='comment %d' % i)
+            Reaction.toggle(post.pk, cls.reader, Reaction.LIKE)
+        cls.post = post
+        for db in sharding.get_post_dbs():
+            index_new_posts(Post.objects.using(db))
+
+    def setUp(self):
+        self.client.force_login(self.reader)
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedQueries(self, url, method='get', data=None):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+        self.assertTrue(recorder.queries, url)
+
+        for sql, params in recorder.queries:
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+                continue
+            for detail in self.explain(sql, params):
+                full_scan = detail.startswith('SCAN ') and 'INDEX' not in detail and 'VIRTUAL TABLE' not in detail
+                self.assertFalse(full_scan, "%s: full scan '%s' in\n%s" % (url, detail, sql))
+                self.assertNotIn('TEMP B-TREE', detail, "%s: temp b-tree sort in\n%s" % (url, sql))
+
+    def test_latest_posts(self):
+        self.assertIndexedQueries(reverse('latest-post-list'))
+
+    def test_latest_posts_older_page(self):
+        page = self.client.get(reverse('latest-post-list')).context['post_list']
+        self.assertIndexedQueries(reverse('latest-post-list') + '?before=' + page.older_cursor)
+
+    def test_home_timeline(self):
+        self.assertIndexedQueries(reverse('home-timeline'))
+
+    def test_my_posts(self):
+        self.assertIndexedQueries(reverse('my-post-list'))
+
+    def test_post_detail(self):
+        self.assertIndexedQueries(reverse('post-detail', kwargs={'pk': self.post.pk}))
+
+    def test_profile(self):
+        self.assertIndexedQueries(reverse('profile', kwargs={'pk': self.user.pk}))
+
+    def test_like(self):
+        self.assertIndexedQueries(reverse('like', kwargs={'pk': self.post.pk}), method='post')
+
+    def test_follow(self):
+        self.assertIndexedQueries(reverse('remove-follower', kwargs={'pk': self.user.pk}), method='post')
+        self.assertIndexedQueries(reverse('add-follower', kwargs={'pk': self.user.pk}), method='post')
+
+    def test_api_react(self):
+        self.assertIndexedQueries(reverse('api-react', kwargs={'pk': self.post.pk}), method='post', data={'value': 'dislike'})
+        self.assertIndexedQueries(reverse('api-unreact', kwargs={'pk': self.post.pk}), method='post')
+
+    def test_api_follow(self):
+        self.assertIndexedQueries(reverse('api-unfollow', kwargs={'pk': self.user.pk}), method='post')
+        self.assertIndexedQueries(reverse('api-follow', kwargs={'pk': self.user.pk}), method='post')
+
+    def test_async_pages(self):
+        self.assertIndexedQueries(reverse('async-latest-post-list'))
+        self.assertIndexedQueries(reverse('async-post-detail', kwargs={'pk': self.post.pk}))
+        self.assertIndexedQueries(reverse('async-profile', kwargs={'pk': self.user.pk}))
+
+    def test_tag_page(self):
+        page = self.client.get(reverse('tag', kwargs={'name': 'django'})).context['post_list']
+        self.assertTrue(page.has_older)
+        self.assertIndexedQueries(reverse('tag', kwargs={'name': 'django'}))
+        self.assertIndexedQueries(reverse('tag', kwargs={'name': 'django'}) + '?before=' + page.older_cursor)
+
+    def test_comment_pages(self):
+        for i in range(30):
+            Comment.objects.create(post=self.post, author=self.user, comment='more %d' % i)
+        page = self.client.get(reverse('post-detail', kwargs={'pk': self.post.pk})).context['comments']
+        self.assertTrue(page.has_older)
+        self.assertIndexedQueries(reverse('post-comments', kwargs={'pk': self.post.pk}) + '?before=' + page.older_cursor)
+        self.assertIndexedQueries(reverse('async-post-detail', kwargs={'pk': self.post.pk}) + '?before=' + page.older_cursor)
+
+    def test_hot_posts(self):
+        page = self.client.get(reverse('hot-post-list')).context['post_list']
+        self.assertTrue(page.has_older)
+        self.assertIndexedQueries(reverse('hot-post-list'))
+        self.assertIndexedQueries(reverse('hot-post-list') + '?before=' + page.older_cursor)
+        self.assertIndexedQueries(reverse('hot-post-list') + '?after=' + page.older_cursor)
+
+    def test_mentions_page(self):
+        self.assertIndexedQueries(reverse('mentions', kwargs={'username': 'author'}))
+
+    def test_delete_post(self):
+        self.client.force_login(self.post.author)
+        with self.captureOnCommitCallbacks(execute=True): # runs the "purge_post" job (inline)
+            self.assertIndexedQueries(reverse('post-delete', kwargs={'pk': self.post.pk}), method='post')
+
+
+class DeletePostTests(TestCase):
+    """
+    A deleted post is hidden right away (soft delete), its rows are purged afterwards in batches
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.commenters = [User.objects.create_user('commenter%d' % i, password='admin@123') for i in range(3)]
+        for commenter in cls.commenters:
+            cls.author.profile.followers.add(commenter)
+        cls.post = Post.objects.create(body='deleted soon #django @commenter0', author=cls.author)
+        cls.kept = Post.objects.create(body='kept #django', author=cls.author)
+        for post in (cls.post, cls.kept):
+            TimelineEntry.fan_out(post)
+        index_new_posts([cls.post, cls.kept])
+        for i in range(7): # 3, 2 and 2 comments
+            Comment.objects.create(post=cls.post, author=cls.commenters[i % 3], comment='comment %d' % i)
+        for commenter, value in zip(cls.commenters, (Reaction.LIKE, Reaction.LIKE, Reaction.DISLIKE)):
+            Comment.objects.create(post=cls.kept, author=commenter, comment='still here')
+            Reaction.toggle(cls.post.pk, commenter, value)
+            Reaction.toggle(cls.kept.pk, commenter, Reaction.LIKE)
+        cls.db = sharding.post_db(cls.post.pk) or 'default'
+
+    def stats(self, user):
+        return UserStats.objects.values_list('posts_count', 'comments_count', 'likes_received').get(pk=user.pk)
+
+    def rows(self, post):
+        return {
+            'post': Post.all_objects.using(self.db).filter(pk=post.pk).count(),
+            'comments': Comment.objects.using(self.db).filter(post_id=post.pk).count(),
+            'reactions': Reaction.objects.using(self.db).filter(post_id=post.pk).count(),
+            'timeline': TimelineEntry.objects.filter(post_id=post.pk).count(),
+            'tags': PostTag.objects.filter(post_id=post.pk).count(),
+            'mentions': Mention.objects.filter(post_id=post.pk).count(),
+        }
+
+    def test_soft_delete(self):
+        self.assertEqual(self.stats(self.author), (2, 0, 5))
+        post = Post.objects.using(self.db).get(pk=self.post.pk)
+        self.assertTrue(post.soft_delete())
+        self.assertFalse(post.soft_delete())
+
+        self.assertEqual(self.stats(self.author), (1, 0, 3)) # the numbers drop right away
+        self.assertFalse(Post.objects.using(self.db).filter(pk=self.post.pk).exists())
+        self.assertEqual([p.pk for p in Post.get_post_data("all", page_size=10)], [self.kept.pk])
+        self.assertEqual(self.rows(self.post), {'post': 1, 'comments': 7, 'reactions': 3, 'timeline': 3, 'tags': 1, 'mentions': 1})
+
+        # left out of the search before the page is cut: no next page for a post that isn't shown
+        self.assertEqual(search_posts('django', page_size=1), ([Post.objects.using(self.db).get(pk=self.kept.pk)], False))
+        self.assertEqual(search_posts('soon'), ([], False))
+
+    def test_purge_in_batches(self):
+        Post.objects.using(self.db).get(pk=self.post.pk).soft_delete()
+        with CaptureQueriesContext(connections[self.db]) as queries:
+            self.assertTrue(Post.purge(self.post.pk, batch_size=2))
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE FROM "social_comment"')]
+        self.assertEqual(len(deletes), 4) # 7 comments, 2 at a time
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE FROM "social_reaction"')]
+        self.assertEqual(len(deletes), 2)
+
+        self.assertEqual(self.rows(self.post), {'post': 0, 'comments': 0, 'reactions': 0, 'timeline': 0, 'tags': 0, 'mentions': 0})
+        self.assertEqual(self.rows(self.kept), {'post': 1, 'comments': 3, 'reactions': 3, 'timeline': 3, 'tags': 1, 'mentions': 0})
+        # the commenters keep the comment on the other post, the author was counted off by soft_delete()
+        self.assertEqual([self.stats(commenter)[1] for commenter in self.commenters], [1, 1, 1])
+        self.assertEqual(self.stats(self.author), (1, 0, 3))
+        kept = Post.objects.using(self.db).get(pk=self.kept.pk)
+        self.assertEqual((kept.likes_count, kept.comments_count), (3, 3))
+
+        self.assertFalse(Post.purge(self.post.pk)) # nothing left
+        self.assertFalse(Post.purge(self.kept.pk)) # not deleted
+
+    def test_delete_view(self):
+        self.client.force_login(self.author)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks: # runs the "purge_post" job (inline)
+            response = self.client.post(reverse('post-delete', kwargs={'pk': self.post.pk}))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(callbacks)
+        self.assertEqual(self.rows(self.post), {'post': 0, 'comments': 0, 'reactions': 0, 'timeline': 0, 'tags': 0, 'mentions': 0})
+        self.assertEqual(self.stats(self.author), (1, 0, 3))
+
+    @override_settings(SOCIAL_JOBS_INLINE=False)
+    def test_delete_view_queues_the_purge(self):
+        self.client.force_login(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('post-delete', kwargs={'pk': self.post.pk}))
+        self.assertEqual(self.rows(self.post)['comments'], 7)
+        self.assertEqual(list(Job.objects.values_list('name', 'payload')), [('purge_post', {'post_pk': self.post.pk})])
+
+        call_command('purge_deleted_posts', batch_size=3, stdout=io.StringIO())
+        self.assertEqual(self.rows(self.post)['post'], 0)
+        self.assertEqual([self.stats(commenter)[1] for commenter in self.commenters], [1, 1, 1])
+
+
+class ConditionalGetTests(TestCase):
+    """
+    The post, profile and latest posts pages answer 304 Not Modified until what they show changes (social/stamps.py)
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+        cls.other = Post.objects.create(body='another post', author=cls.reader)
+
+    def setUp(self):
+        self.client.force_login(self.reader)
+        self.urls = {
+            'feed': reverse('latest-post-list'),
+            'post': reverse('post-detail', kwargs={'pk': self.post.pk}),
+            'profile': reverse('profile', kwargs={'pk': self.author.pk}),
+        }
+        self.client.get(self.urls['feed']) # sets the CSRF cookie, which is part of the ETags
+        self.etags = {name: self.client.get(url)['ETag'] for name, url in self.urls.items()}
+
+    @contextlib.contextmanager
+    def committed(self):
+        # the stamps are touched once the writes commit, on the database of the post
+        with contextlib.ExitStack() as stack:
+            for db in self.databases:
+                stack.enter_context(self.captureOnCommitCallbacks(using=db, execute=True))
+            yield
+
+    def statuses(self):
+        return {name: self.client.get(url, HTTP_IF_NONE_MATCH=self.etags[name]).status_code for name, url in self.urls.items()}
+
+    def test_not_modified(self):
+        self.assertEqual(self.statuses(), {'feed': 304, 'post': 304, 'profile': 304})
+        response = self.client.get(self.urls['post'], HTTP_IF_NONE_MATCH=self.etags['post'])
+        self.assertEqual(response.content, b'')
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        # another user gets the page, not the 304 of the reader
+        self.client.force_login(self.author)
+        self.assertEqual(self.client.get(self.urls['post'], HTTP_IF_NONE_MATCH=self.etags['post']).status_code, 200)
+
+    def test_reaction_bumps_the_stamps(self):
+        with self.committed():
+            Reaction.toggle(self.post.pk, self.reader, Reaction.LIKE)
+        self.assertEqual(self.statuses(), {'feed': 200, 'post': 200, 'profile': 200})
+
+        response = self.client.get(self.urls['post'])
+        self.assertNotEqual(response['ETag'], self.etags['post'])
+        self.assertEqual(self.client.get(self.urls['post'], HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_comment_bumps_the_stamps(self):
+        with self.committed():
+            response = self.client.post(self.urls['post'], {'comment': 'a new comment'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.statuses(), {'feed': 200, 'post': 200, 'profile': 200})
+        self.assertContains(self.client.get(self.urls['post'], HTTP_IF_NONE_MATCH=self.etags['post']), 'a new comment')
+
+    def test_other_post_changes(self):
+        with self.committed():
+            Comment.objects.create(post=self.other, author=self.author, comment='elsewhere')
+        # the latest posts show the other post, the page and the profile of this one don't
+        self.assertEqual(self.statuses(), {'feed': 200, 'post': 304, 'profile': 304})
+
+    def test_trending_tags_change(self):
+        cache.delete(TRENDING_CACHE_KEY) # expired, the same list comes back
+        self.assertEqual(self.statuses(), {'feed': 304, 'post': 304, 'profile': 304})
+
+        count_tags({Hashtag.objects.create(name='django').pk: 3})
+        cache.delete(TRENDING_CACHE_KEY)
+        with self.committed(): # what the next view of the page does before checking its stamps
+            get_trending_tags()
+        self.assertEqual(self.statuses(), {'feed': 200, 'post': 304, 'profile': 304})
+        self.assertContains(self.client.get(self.urls['feed']), '#django')
+
+
+class PostCardTests(TestCase):
+    """
+    The cached post cards (social/templatetags/post_cards.py): rendered again once the post or the avatar of its author changes
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+        cls.other = Post.objects.create(body='another post', author=cls.author)
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_card_cache().clear()
+
+    def feed(self):
+        return self.client.get(reverse('latest-post-list')).content.decode()
+
+    def cache_key(self, post):
+        post = Post.objects.using(sharding.post_db(post.pk)).select_related('author__profile').get(pk=post.pk)
+        return card_cache_key(post, 'feed')
+
+    def test_cached(self):
+        self.feed()
+        key = self.cache_key(self.post)
+        self.assertIn('hello', get_card_cache().get(key))
+        get_card_cache().set(key, '<p>from the cache</p>')
+        self.assertIn('from the cache', self.feed())
+
+    def test_edit(self):
+        self.feed()
+        key = self.cache_key(self.post)
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('post-edit', kwargs={'pk': self.post.pk}), {'body': 'edited'})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotEqual(self.cache_key(self.post), key)
+        page = self.feed()
+        self.assertIn('edited', page)
+        self.assertNotIn('hello', page)
+
+    def test_reaction(self):
+        self.feed()
+        key = self.cache_key(self.post)
+        Reaction.toggle(self.post.pk, self.reader, Reaction.LIKE)
+        self.assertNotEqual(self.cache_key(self.post), key)
+        self.assertIn('<span data-count="likes_count"> 1 </span>', self.feed())
+
+    def test_avatar_change(self):
+        self.feed()
+        keys = [self.cache_key(self.post), self.cache_key(self.other)]
+        versions = list(Post.objects.using(sharding.author_db(self.author.pk)).order_by('pk').values_list('version', flat=True))
+        self.client.force_login(self.author)
+        picture = io.BytesIO()
+        Image.new('RGB', (10, 10), 'red').save(picture, 'PNG')
+        response = self.client.post(reverse('profile-edit', kwargs={'pk': self.author.pk}), {
+            'name': 'Author', 'bio': '', 'location': '',
+            'picture': SimpleUploadedFile('new.png', picture.getvalue(), content_type='image/png'),
+        })
+        self.assertEqual(response.status_code, 302)
+
+        # the cards of every post of the author change, the posts themselves are left alone
+        self.assertNotEqual(self.cache_key(self.post), keys[0])
+        self.assertNotEqual(self.cache_key(self.other), keys[1])
+        self.assertEqual(list(Post.objects.using(sharding.author_db(self.author.pk)).order_by('pk').values_list('version', flat=True)), versions)
+        self.assertIn(UserProfile.objects.get(pk=self.author.pk).picture.url, self.feed())
+
+    def test_profile_edit_keeps_the_cards(self):
+        self.feed()
+        key = self.cache_key(self.post)
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('profile-edit', kwargs={'pk': self.author.pk}), {'name': 'Author', 'bio': 'new bio', 'location': ''})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.cache_key(self.post), key) # the cards don't show the bio
+
+    def test_placeholders(self):
+        self.client.force_login(self.reader)
+        for cached in (False, True):
+            html = self.feed()
+            self.assertNotIn(CSRF_PLACEHOLDER, html, cached)
+            self.assertNotIn(NEXT_PLACEHOLDER, html, cached)
+            tokens = re.findall(r'name="csrfmiddlewaretoken" value="([^"]*)"', html)
+            self.assertEqual(len(tokens), 2 * 2 + 1, cached) # like and dislike of each card, the post form
+            for token in tokens:
+                self.assertEqual(len(token), 64) # a masked token of this request
+            self.assertEqual(html.count('name="next" value="%s"' % reverse('latest-post-list')), 2 * 2, cached)
+
+
+@skipUnless(search.is_supported(), "FTS5 search is SQLite only")
+class SearchTests(TestCase):
+    """
+    Full-text search (social/search.py): bm25 ranking damped by age, kept in sync by triggers, rebuilt by a swap
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+
+    def write(self, body, days=0):
+        return Post.objects.create(body=body, author=self.author, created_on=timezone.now() - datetime.timedelta(days=days))
+
+    def found(self, text):
+        return [post.body for post in search_posts(text)[0]]
+
+    def test_ranking(self):
+        self.write('django django django rocks')
+        self.write('a long post about python, the web, databases and also django somewhere in it')
+        self.assertEqual(self.found('django'), ['django django django rocks', 'a long post about python, the web, databases and also django somewhere in it'])
+        self.assertEqual(self.found('pyth'), ['a long post about python, the web, databases and also django somewhere in it']) # the last word is a prefix
+        self.assertEqual(self.found('django rocks'), ['django django django rocks']) # every word must match
+        self.assertEqual(self.found('"); DROP TABLE social_post; --'), []) # quoted, never FTS syntax
+
+    def test_comment_matches(self):
+        post = self.write('nothing to see')
+        Comment.objects.create(post=post, author=self.reader, comment='but the comment talks about django')
+        self.assertEqual(self.found('django'), ['nothing to see']) # once, through its comment
+
+    def test_recency_damping(self):
+        self.write('the same words', days=90)
+        self.write('the same words')
+        self.write('the same words', days=10)
+        posts = search_posts('same words')[0]
+        self.assertEqual([post.created_on for post in posts], sorted((post.created_on for post in posts), reverse=True))
+
+    def test_edit_and_delete(self):
+        post = self.write('first draft')
+        comment = Comment.objects.create(post=post, author=self.reader, comment='a typo in the draft')
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('post-edit', kwargs={'pk': post.pk}), {'body': 'final version'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.found('first'), [])
+        self.assertEqual(self.found('final'), ['final version'])
+
+        Comment.objects.using(comment._state.db).filter(pk=comment.pk).update(comment='fixed it')
+        self.assertEqual(self.found('typo'), [])
+        self.assertEqual(self.found('fixed'), ['final version'])
+        Comment.objects.using(comment._state.db).filter(pk=comment.pk).delete()
+        self.assertEqual(self.found('fixed'), [])
+
+        Post.objects.using(post._state.db).filter(pk=post.pk).delete() # purged
+        self.assertEqual(self.found('final'), [])
+
+    def test_rebuild(self):
+        kept = self.write('indexed before')
+        edited = self.write('edited during the rebuild')
+        self.write('deleted during the rebuild')
+        db = sharding.post_db(kept.pk) or 'default'
+        with connections[db].cursor() as cursor:
+            cursor.execute("DELETE FROM social_search") # drifted
+
+        index_batch = search.index_batch
+        writes = []
+
+        def writing_index_batch(*args, **kwargs):
+            # the site keeps running while the new index is built
+            if not writes:
+                writes.append(self.write('written during the rebuild'))
+                Post.objects.using(db).filter(pk=edited.pk).update(body='changed during the rebuild')
+                Post.objects.using(db).filter(body__startswith='deleted').delete()
+            return index_batch(*args, **kwargs)
+
+        with mock.patch.object(search, 'index_batch', writing_index_batch):
+            call_command('rebuild_search_index', '--batch-size', '2', stdout=io.StringIO())
+        self.assertEqual(sorted(self.found('rebuild')), ['changed during the rebuild', 'written during the rebuild'])
+        self.assertEqual(self.found('indexed'), ['indexed before'])
+        self.assertEqual(self.found('edited'), [])
+
+        with connections[db].cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name LIKE '%%search_new%%'")
+            self.assertEqual(cursor.fetchall(), []) # no table or trigger left from the build
+        self.write('written after the rebuild') # the triggers are back on the swapped index
+        self.assertEqual(self.found('after'), ['written after the rebuild'])
+
+
+class PaginationTests(TestCase):
+    """
+    Keyset pages of the feeds: every post exactly once, in (-created_on, -id) order, in both directions
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('author', password='admin@123')
+        start = timezone.now() - datetime.timedelta(days=1)
+        # posts 3 to 7 share the same created_on, the id breaks the tie
+        times = [start + datetime.timedelta(minutes=min(i, 3)) for i in range(8)]
+        cls.posts = [Post.objects.create(body='post %d' % i, author=cls.user, created_on=created_on) for i, created_on in enumerate(times)]
+        cls.newest_first = sorted(cls.posts, key=lambda post: (post.created_on, post.pk), reverse=True)
+
+    def walk(self, page, direction):
+        pages = [page]
+        while getattr(page, direction + '_cursor'):
+            page = Post.get_post_data("all", cursor=getattr(page, direction + '_cursor'), direction=direction, page_size=3)
+            pages.append(page)
+        return pages
+
+    def test_cursor_round_trip(self):
+        created_on = self.posts[3].created_on
+        self.assertEqual(decode_cursor(encode_cursor(created_on, 42)), (created_on, 42))
+        self.assertEqual(decode_cursor(encode_cursor(1.5e-7, 42), score=True), (1.5e-7, 42))
+        self.assertIsNone(decode_cursor(encode_cursor(1.5, 42))) # a score cursor on a page ordered by time
+        for cursor in (None, '', 'garbage', '12_', '_12', 's1.5_1', 'snan_1', '99999999999999999999999_1'):
+            self.assertIsNone(decode_cursor(cursor), cursor)
+
+    def test_older_pages(self):
+        pages = self.walk(Post.get_post_data("all", page_size=3), 'older')
+        self.assertEqual([post.pk for page in pages for post in page], [post.pk for post in self.newest_first])
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertFalse(pages[0].has_newer)
+        self.assertTrue(pages[0].has_older)
+        self.assertTrue(pages[-1].has_newer)
+        self.assertFalse(pages[-1].has_older)
+
+    def test_newer_pages(self):
+        last = self.walk(Post.get_post_data("all", page_size=3), 'older')[-1]
+        pages = self.walk(last, 'newer')
+        self.assertEqual([post.pk for page in reversed(pages) for post in page], [post.pk for post in self.newest_first])
+        self.assertFalse(pages[-1].has_newer) # back at the top
+        self.assertTrue(pages[-1].has_older)
+
+    @override_settings(SOCIAL_PAGE_SIZE=3)
+    def test_latest_posts_pages(self):
+        first = self.client.get(reverse('latest-post-list')).context['post_list']
+        self.assertEqual([post.pk for post in first], [post.pk for post in self.newest_first[:3]])
+        second = self.client.get(reverse('latest-post-list') + '?before=' + first.older_cursor).context['post_list']
+        self.assertEqual([post.pk for post in second], [post.pk for post in self.newest_first[3:6]])
+        back = self.client.get(reverse('latest-post-list') + '?after=' + second.newer_cursor).context['post_list']
+        self.assertEqual([post.pk for post in back], [post.pk for post in first])
+        self.assertFalse(back.has_newer)
+
+    @override_settings(SOCIAL_PAGE_SIZE=3)
+    def test_malformed_cursor_shows_the_first_page(self):
+        for query in ('?before=garbage', '?after=garbage', '?before=s1.5_3'):
+            page = self.client.get(reverse('latest-post-list') + query).context['post_list']
+            self.assertEqual([post.pk for post in page], [post.pk for post in self.newest_first[:3]], query)
+            self.assertFalse(page.has_newer, query)
+
+    @override_settings(SOCIAL_PAGE_SIZE=3)
+    def test_my_posts_pages(self):
+        self.client.force_login(self.user)
+        seen = []
+        url = reverse('my-post-list')
+        while url:
+            page = self.client.get(url).context['post_list']
+            seen += [post.pk for post in page]
+            url = reverse('my-post-list') + '?before=' + page.older_cursor if page.has_older else None
+        self.assertEqual(seen, [post.pk for post in self.newest_first])
+
+
+@override_settings(SOCIAL_COMMENT_PAGE_SIZE=10)
+class CommentPageTests(TestCase):
+    """
+    The comments of a post page, ten at a time here, and the "load more" fragment of the next ones
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+        start = timezone.now() - datetime.timedelta(hours=1)
+        for i in range(25):
+            Comment.objects.create(post=cls.post, author=cls.author, comment='comment %02d' % i, created_on=start + datetime.timedelta(minutes=i))
+
+    def comments(self, response):
+        return re.findall(r'<p>(comment \d+)</p>', response.content.decode())
+
+    def load_more_url(self, response):
+        match = re.search(r'data-fragment-url="([^"]+)"', response.content.decode())
+        return match and html.unescape(match[1])
+
+    def test_load_more(self):
+        response = self.client.get(reverse('post-detail', kwargs={'pk': self.post.pk}))
+        self.assertContains(response, '<strong>25 comments</strong>')
+        pages = [self.comments(response)]
+        url = self.load_more_url(response)
+        while url:
+            response = self.client.get(url)
+            self.assertNotContains(response, '<html') # only the fragment
+            pages.append(self.comments(response))
+            url = self.load_more_url(response)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([comment for page in pages for comment in page], ['comment %02d' % i for i in reversed(range(25))])
+
+    def test_count_follows_the_comments(self):
+        url = reverse('post-detail', kwargs={'pk': self.post.pk})
+        self.client.force_login(self.author)
+        self.client.post(url, {'comment': 'one more'})
+        self.assertContains(self.client.get(url), '<strong>26 comments</strong>')
+        comment = Comment.objects.using(sharding.post_db(self.post.pk)).get(comment='comment 00')
+        self.client.post(reverse('comment-delete', kwargs={'post_pk': self.post.pk, 'pk': comment.pk}))
+        self.assertContains(self.client.get(url), '<strong>25 comments</strong>')
+
+    def test_missing_or_deleted_post(self):
+        self.assertEqual(self.client.get(reverse('post-comments', kwargs={'pk': self.post.pk + 1000})).status_code, 404)
+        Post.objects.using(sharding.post_db(self.post.pk)).filter(pk=self.post.pk).update(deleted_on=timezone.now())
+        self.assertEqual(self.client.get(reverse('post-comments', kwargs={'pk': self.post.pk})).status_code, 404)
+
+
+class PostCounterTests(TestCase):
+    """
+    Post.likes_count/dislikes_count/comments_count follow the reactions and comments with F() updates,
+    reconcile_post_counters recounts them
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.users = [User.objects.create_user('user%d' % i, password='admin@123') for i in range(3)]
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+
+    def counts(self, post=None):
+        post = post or self.post
+        return Post.objects.using(sharding.post_db(post.pk)).values_list('likes_count', 'dislikes_count', 'comments_count').get(pk=post.pk)
+
+    def test_reactions(self):
+        for user in self.users:
+            Reaction.toggle(self.post.pk, user, Reaction.LIKE)
+        self.assertEqual(self.counts(), (3, 0, 0))
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.DISLIKE) # switched
+        self.assertEqual(self.counts(), (2, 1, 0))
+        Reaction.toggle(self.post.pk, self.users[1], Reaction.LIKE) # removed
+        self.assertEqual(self.counts(), (1, 1, 0))
+        Reaction.clear(self.post.pk, self.users[0])
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+        # a stale instance doesn't matter: the counters move in the database
+        stale = Post.objects.using(sharding.post_db(self.post.pk)).get(pk=self.post.pk)
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        Post.update_counters(stale.pk, dislikes_count=1)
+        self.assertEqual(self.counts(), (2, 1, 0))
+
+    def test_comments(self):
+        comments = [Comment.objects.create(post=self.post, author=user, comment='hi') for user in self.users]
+        self.assertEqual(self.counts(), (0, 0, 3))
+        comments[0].delete()
+        self.assertEqual(self.counts(), (0, 0, 2))
+
+        self.client.force_login(self.users[1])
+        response = self.client.post(reverse('comment-delete', kwargs={'post_pk': self.post.pk, 'pk': comments[1].pk}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.counts(), (0, 0, 1))
+
+    def test_deleted_post(self):
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        Comment.objects.create(post=self.post, author=self.users[1], comment='hi')
+        other = Post.objects.create(body='other', author=self.author)
+        Reaction.toggle(other.pk, self.users[0], Reaction.LIKE)
+        Post.objects.using(sharding.post_db(self.post.pk)).get(pk=self.post.pk).delete()
+        self.assertEqual(self.counts(other), (1, 0, 0)) # the other post isn't touched
+
+    def test_reconcile(self):
+        other = Post.objects.create(body='other', author=self.author)
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        Reaction.toggle(self.post.pk, self.users[1], Reaction.DISLIKE)
+        Comment.objects.create(post=self.post, author=self.users[2], comment='hi')
+        Reaction.toggle(other.pk, self.users[0], Reaction.LIKE)
+        db = sharding.post_db(self.post.pk)
+        Post.objects.using(db).filter(pk=self.post.pk).update(likes_count=9, dislikes_count=0, comments_count=0, hot_score=0) # drifted
+
+        out = io.StringIO()
+        call_command('reconcile_post_counters', batch_size=1, stdout=out)
+        self.assertIn("Checked 2 posts, fixed 1 drifted counters", out.getvalue())
+        self.assertEqual(self.counts(), (1, 1, 1))
+        self.assertEqual(self.counts(other), (1, 0, 0))
+        post = Post.objects.using(db).get(pk=self.post.pk)
+        self.assertAlmostEqual(post.hot_score, post.compute_hot_score())
+
+
+class HotScoreTests(TestCase):
+    """
+    Post.hot_score: ranking.hot_score(), moved by hot_score_delta() in the counter updates,
+    recomputed by rescore_hot_posts
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.users = [User.objects.create_user('user%d' % i, password='admin@123') for i in range(4)]
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+
+    def stored(self, post=None):
+        post = post or self.post
+        return Post.objects.using(sharding.post_db(post.pk)).get(pk=post.pk)
+
+    @override_settings(SOCIAL_HOT_HALF_LIFE_HOURS=12, SOCIAL_HOT_COMMENT_WEIGHT=2)
+    def test_hot_score(self):
+        epoch = ranking.HOT_EPOCH
+        half_life = datetime.timedelta(hours=12)
+        self.assertEqual(ranking.hot_score(0, 0, 0, epoch), 0)
+        self.assertEqual(ranking.hot_score(3, 0, 0, epoch), 2) # log2(1 + 3)
+        self.assertEqual(ranking.hot_score(0, 3, 0, epoch), -2)
+        self.assertEqual(ranking.hot_score(4, 1, 0, epoch), 2)
+        self.assertEqual(ranking.hot_score(1, 0, 1, epoch), 2) # a comment counts twice
+        self.assertEqual(ranking.hot_score(0, 0, 0, epoch + 3 * half_life), 3)
+        # a post one half-life younger with half the points (plus one) is level
+        self.assertEqual(ranking.hot_score(1, 0, 0, epoch + half_life), ranking.hot_score(3, 0, 0, epoch))
+        with self.settings(SOCIAL_HOT_HALF_LIFE_HOURS=6, SOCIAL_HOT_COMMENT_WEIGHT=0):
+            self.assertEqual(ranking.hot_score(0, 0, 1, epoch + half_life), 2)
+
+        post = Post.objects.create(body='new', author=self.author)
+        self.assertEqual(self.stored(post).hot_score, ranking.hot_score(0, 0, 0, post.created_on))
+
+    def test_delta_matches_recompute(self):
+        """
+        Every counter update moves the score to what a full recompute gives, through zero and negative points
+        """
+        steps = [
+            lambda: Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE),
+            lambda: Reaction.toggle(self.post.pk, self.users[1], Reaction.LIKE),
+            lambda: Reaction.toggle(self.post.pk, self.users[0], Reaction.DISLIKE),
+            lambda: Reaction.toggle(self.post.pk, self.users[2], Reaction.DISLIKE),
+            lambda: Reaction.toggle(self.post.pk, self.users[3], Reaction.DISLIKE),
+            lambda: Comment.objects.create(post=self.post, author=self.users[0], comment='hi'),
+            lambda: Reaction.clear(self.post.pk, self.users[1]),
+            lambda: Post.update_counters(self.post.pk, likes_count=2, comments_count=3),
+            lambda: Comment.objects.filter(post_id=self.post.pk).delete(),
+        ]
+        for i, step in enumerate(steps):
+            step()
+            post = self.stored()
+            with self.subTest(step=i, counters=(post.likes_count, post.dislikes_count, post.comments_count)):
+                self.assertAlmostEqual(post.hot_score, post.compute_hot_score(), places=9)
+
+    def test_rescore(self):
+        posts = [self.post] + [Post.objects.create(body='post %d' % i, author=self.author) for i in range(3)]
+        Reaction.toggle(posts[1].pk, self.users[0], Reaction.LIKE)
+        Comment.objects.create(post=posts[2], author=self.users[0], comment='hi')
+        Post.objects.using(sharding.post_db(posts[3].pk)).filter(pk=posts[3].pk).update(hot_score=F('hot_score') + 1e-6) # drifted
+
+        out = io.StringIO()
+        call_command('rescore_hot_posts', batch_size=1, stdout=out)
+        self.assertIn("Checked 4 posts, rescored 1", out.getvalue())
+        for post in posts:
+            post = self.stored(post)
+            self.assertAlmostEqual(post.hot_score, post.compute_hot_score(), places=9)
+
+        # a changed setting rescores the posts whose points term depends on it
+        with self.settings(SOCIAL_HOT_COMMENT_WEIGHT=5):
+            out = io.StringIO()
+            call_command('rescore_hot_posts', stdout=out)
+            self.assertIn("Checked 4 posts, rescored 1", out.getvalue())
+            self.assertEqual(self.stored(posts[2]).hot_score, ranking.hot_score(0, 0, 1, posts[2].created_on))
+
+        out = io.StringIO()
+        call_command('rescore_hot_posts', tolerance=10, stdout=out)
+        self.assertIn("Checked 4 posts, rescored 0", out.getvalue())
+
+
+class ReactionTests(TestCase):
+    """
+    One Reaction row per (post, user): toggle() switches it over or removes it, set()/clear() are idempotent
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.user = User.objects.create_user('user', password='admin@123')
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+        cls.db = sharding.post_db(cls.post.pk) or 'default'
+
+    def state(self):
+        reactions = list(Reaction.objects.using(self.db).filter(post_id=self.post.pk, user=self.user).values_list('value', flat=True))
+        counts = Post.objects.using(self.db).values_list('likes_count', 'dislikes_count').get(pk=self.post.pk)
+        return reactions, counts
+
+    def test_toggle(self):
+        steps = [
+            (Reaction.LIKE, Reaction.LIKE, ([Reaction.LIKE], (1, 0))),
+            (Reaction.DISLIKE, Reaction.DISLIKE, ([Reaction.DISLIKE], (0, 1))), # switched over
+            (Reaction.DISLIKE, None, ([], (0, 0))), # the same again removes it
+            (Reaction.DISLIKE, Reaction.DISLIKE, ([Reaction.DISLIKE], (0, 1))),
+            (Reaction.LIKE, Reaction.LIKE, ([Reaction.LIKE], (1, 0))),
+            (Reaction.LIKE, None, ([], (0, 0))),
+        ]
+        for value, result, state in steps:
+            self.assertEqual(Reaction.toggle(self.post.pk, self.user, value), result)
+            self.assertEqual(self.state(), state)
+
+    def test_set_and_clear(self):
+        self.assertTrue(Reaction.set(self.post.pk, self.user, Reaction.LIKE))
+        self.assertFalse(Reaction.set(self.post.pk, self.user, Reaction.LIKE)) # sent twice
+        self.assertEqual(self.state(), ([Reaction.LIKE], (1, 0)))
+        self.assertTrue(Reaction.set(self.post.pk, self.user, Reaction.DISLIKE))
+        self.assertEqual(self.state(), ([Reaction.DISLIKE], (0, 1)))
+        self.assertTrue(Reaction.clear(self.post.pk, self.user))
+        self.assertFalse(Reaction.clear(self.post.pk, self.user))
+        self.assertEqual(self.state(), ([], (0, 0)))
+        self.assertEqual(Reaction.get_user_reactions(self.user, [self.post.pk]), {})
+
+    def test_one_row_per_post_and_user(self):
+        Reaction.toggle(self.post.pk, self.user, Reaction.LIKE)
+        with self.assertRaises(IntegrityError), transaction.atomic(using=self.db):
+            Reaction.objects.using(self.db).create(post_id=self.post.pk, user=self.user, value=Reaction.DISLIKE)
+        self.assertEqual(self.state(), ([Reaction.LIKE], (1, 0)))
+
+    def test_double_click(self):
+        # the second click of a double-click inserts its row between the checks and the insert of the first one
+        create = QuerySet.create
+        clicks = []
+
+        def racing_create(queryset, **kwargs):
+            if queryset.model is Reaction and not clicks:
+                clicks.append(None)
+                clicks[0] = Reaction.toggle(self.post.pk, self.user, Reaction.LIKE) # the other click
+            return create(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'create', racing_create):
+            result = Reaction.toggle(self.post.pk, self.user, Reaction.LIKE)
+        self.assertEqual(clicks, [Reaction.LIKE])
+        self.assertIn(result, (None, Reaction.LIKE)) # like then unlike, or the other click rolled back with it
+        reactions, counts = self.state()
+        self.assertEqual(counts, (len(reactions), 0)) # the counter matches the rows whichever it was
+        self.assertLessEqual(len(reactions), 1)
+
+
+class ReactionMigrationTests(TransactionTestCase):
+    """
+    Migration 0007 moves the likes/dislikes M2M rows into Reaction
+    """
+    databases = {'default'}
+    before = [('social', '0006_post_counters')]
+    after = [('social', '0007_reaction')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes()) # back to the latest schema
+
+    def test_likes_copied(self):
+        apps = self.migrate(self.before)
+        OldUser = apps.get_model('auth', 'User')
+        OldPost = apps.get_model('social', 'Post')
+        author, fan, hater, both = [OldUser.objects.create(username=name) for name in ('author', 'fan', 'hater', 'both')]
+        post = OldPost.objects.create(body='hello', author=author)
+        post.likes.add(fan, both)
+        post.dislikes.add(hater, both)
+
+        apps = self.migrate(self.after)
+        NewReaction = apps.get_model('social', 'Reaction')
+        self.assertEqual(
+            sorted(NewReaction.objects.values_list('post_id', 'user_id', 'value')),
+            sorted([(post.pk, fan.pk, 1), (post.pk, hater.pk, -1), (post.pk, both.pk, 1)]), # a user in both tables keeps the like
+        )
+
+
+class HomeTimelineTests(TestCase):
+    """
+    Home timeline: posts copied to the followers when written (fan-out on write), the posts of
+    celebrity authors (more than SOCIAL_FANOUT_LIMIT followers) merged in when the timeline is read
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.other = User.objects.create_user('other', password='admin@123')
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.celebrity = User.objects.create_user('celebrity', password='admin@123')
+        cls.stranger = User.objects.create_user('stranger', password='admin@123')
+        cls.fan = User.objects.create_user('fan', password='admin@123')
+        for user in (cls.reader, cls.other):
+            cls.author.profile.followers.add(user)
+        for user in (cls.reader, cls.other, cls.fan):
+            cls.celebrity.profile.followers.add(user)
+
+    def follow(self, user, author, follow=True):
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True): # runs the "sync_timeline" job (inline)
+            response = self.client.post(reverse('add-follower' if follow else 'remove-follower', kwargs={'pk': author.pk}))
+        self.assertEqual(response.status_code, 302)
+
+    def write(self, author, body):
+        self.client.force_login(author)
+        with self.captureOnCommitCallbacks(execute=True): # runs the "process_new_post" job (inline)
+            self.client.post(reverse('latest-post-list'), {'body': body})
+        return Post.objects.using(sharding.author_db(author.pk)).get(author=author, body=body)
+
+    def entries(self, post):
+        return set(TimelineEntry.objects.filter(post_id=post.pk).values_list('owner_id', flat=True))
+
+    def home(self, user, page_size=3):
+        # every page of the home timeline, oldest page last
+        pages = [TimelineEntry.get_home_timeline(user, page_size=page_size)]
+        while pages[-1].older_cursor:
+            pages.append(TimelineEntry.get_home_timeline(user, cursor=pages[-1].older_cursor, page_size=page_size))
+        return [post.pk for page in pages for post in page]
+
+    def fan_out_on_read(self, user):
+        # the home timeline as it was computed before TimelineEntry: the posts of the followed authors and the user's own
+        followed = list(user.followers.values_list('pk', flat=True)) + [user.pk]
+        posts = [post for db in sharding.get_post_dbs() for post in Post.objects.using(db).filter(author__in=followed)]
+        return [post.pk for post in sorted(posts, key=lambda post: (post.created_on, post.pk), reverse=True)]
+
+    def test_new_post_reaches_the_followers(self):
+        post = self.write(self.author, 'for my followers')
+        self.assertEqual(self.entries(post), {self.reader.pk, self.other.pk})
+        self.assertIn(post.pk, self.home(self.reader))
+        self.assertNotIn(post.pk, self.home(self.stranger))
+
+    @override_settings(SOCIAL_FANOUT_LIMIT=2)
+    def test_celebrity_posts_merged_when_read(self):
+        post = self.write(self.celebrity, 'for my many followers')
+        self.assertEqual(self.entries(post), set()) # 3 followers, over the limit
+        self.assertEqual(UserProfile.get_celebrity_ids(self.reader), [self.celebrity.pk])
+        self.assertIn(post.pk, self.home(self.reader))
+        self.assertIn(post.pk, self.home(self.other))
+        self.assertNotIn(post.pk, self.home(self.stranger))
+
+        self.follow(self.stranger, self.celebrity) # no backfill either
+        self.assertEqual(self.entries(post), set())
+        self.assertIn(post.pk, self.home(self.stranger))
+
+    def test_follow_backfills_unfollow_prunes(self):
+        posts = [Post.objects.create(body='post %d' % i, author=self.author) for i in range(3)] # not fanned out
+        self.assertEqual(TimelineEntry.objects.filter(owner=self.stranger).count(), 0)
+
+        with override_settings(SOCIAL_TIMELINE_BACKFILL=2):
+            self.follow(self.stranger, self.author)
+        newest = sorted(posts, key=lambda post: (post.created_on, post.pk), reverse=True)[:2]
+        self.assertEqual(set(TimelineEntry.objects.filter(owner=self.stranger).values_list('post_id', flat=True)), {post.pk for post in newest})
+
+        own = Post.objects.create(body='mine', author=self.stranger)
+        self.follow(self.stranger, self.author, follow=False)
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.stranger).exists())
+        self.assertEqual(self.home(self.stranger), [own.pk]) # the user's own posts stay
+
+    @override_settings(SOCIAL_FANOUT_LIMIT=2)
+    def test_same_order_as_fan_out_on_read(self):
+        start = timezone.now() - datetime.timedelta(days=1)
+        authors = [self.author, self.celebrity, self.reader, self.stranger]
+        for i in range(12): # some posts at the same time, the id breaks the tie
+            post = Post.objects.create(body='post %d' % i, author=authors[i % 4], created_on=start + datetime.timedelta(minutes=i // 3))
+            TimelineEntry.fan_out(post)
+
+        expected = self.fan_out_on_read(self.reader)
+        self.assertEqual(len(expected), 9) # the stranger isn't followed
+        self.assertEqual(self.home(self.reader), expected)
+        self.assertEqual(self.home(self.reader, page_size=4), expected)
+
+        self.client.force_login(self.reader)
+        with override_settings(SOCIAL_PAGE_SIZE=4):
+            response = self.client.get(reverse('home-timeline'))
+        self.assertEqual([post.pk for post in response.context['post_list']], expected[:4])
+
+
+class MediaTests(SimpleTestCase):
+    """
+    serve_media(): validators answered with 304, single byte ranges with 206 or 416
+    """
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        with open(os.path.join(media_root.name, 'notes.txt'), 'wb') as f:
+            f.write(b'0123456789')
+        self.url = reverse('media', kwargs={'path': 'notes.txt'})
+
+    def content(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_full_response(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['ETag'].startswith('"'))
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.content(response), b'')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other", %s' % etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(response['Content-Length'], '4')
+        self.assertEqual(self.content(response), b'2345')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3') # the last 3 bytes
+        self.assertEqual(response['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(self.content(response), b'789')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=8-100') # clamped to the end of the file
+        self.assertEqual(response['Content-Range'], 'bytes 8-9/10')
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_range_of_a_changed_file(self):
+        # If-Range with another ETag: the file changed, the whole new file is sent
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), b'0123456789')
+
+
+class ProfilePictureTests(TestCase):
+    """
+    The WebP avatars of the profile pictures (social/images.py) and their backfill command
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', password='admin@123')
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name, SOCIAL_AVATAR_SIZES=[48, 100])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name, color='red', size=(300, 200), data=None):
+        if data is None:
+            picture = io.BytesIO()
+            Image.new('RGB', size, color).save(picture, 'JPEG')
+            data = picture.getvalue()
+        name = default_storage.save('uploads/profile_pictures/' + name, ContentFile(data))
+        UserProfile.objects.filter(pk=self.user.pk).update(picture=name, picture_hash='')
+        return name
+
+    def test_webp_avatars(self):
+        digest = render_thumbnails(self.upload('a.jpg'))
+        self.assertRegex(digest, r'^[0-9a-f]{32}$')
+        for size in (48, 100):
+            name = thumbnail_name(digest, size)
+            self.assertEqual(name, 'uploads/profile_pictures/thumbs/%s-%d.webp' % (digest, size))
+            with default_storage.open(name) as avatar:
+                image = Image.open(avatar)
+                self.assertEqual((image.format, image.size), ('WEBP', (size, size))) # cropped to a square
+        self.assertEqual(thumbnail_url(digest, 40), default_storage.url(thumbnail_name(digest, 48)))
+        self.assertEqual(thumbnail_url(digest, 500), default_storage.url(thumbnail_name(digest, 100))) # the largest one
+
+    def test_content_hash_names(self):
+        first = render_thumbnails(self.upload('a.jpg'))
+        self.assertEqual(render_thumbnails(self.upload('copy.jpg')), first) # same content, same avatars
+        self.assertNotEqual(render_thumbnails(self.upload('b.jpg', color='blue')), first)
+
+        name = self.upload('again.jpg')
+        with mock.patch.object(default_storage, 'save') as save:
+            render_thumbnails(name)
+        save.assert_not_called() # the avatars exist already
+
+    def test_process_profile_picture(self):
+        name = self.upload('a.jpg')
+        version = UserProfile.objects.get(pk=self.user.pk).version
+        process_profile_picture(self.user.pk)
+        profile = UserProfile.objects.get(pk=self.user.pk)
+        self.assertEqual(profile.picture_hash, render_thumbnails(name))
+        self.assertEqual(profile.version, version + 1) # the post cards show the new avatar
+
+    def test_invalid_picture(self):
+        self.upload('broken.jpg', data=b'not a picture')
+        with self.assertLogs('social.images', 'WARNING') as logs:
+            process_profile_picture(self.user.pk)
+        self.assertIn('Could not decode the picture of profile %d' % self.user.pk, logs.output[0])
+        self.assertEqual(UserProfile.objects.get(pk=self.user.pk).picture_hash, '') # the original is shown
+
+    def test_storage_errors_raised(self):
+        # the job is retried, unlike a picture that can't be decoded
+        self.upload('a.jpg')
+        with mock.patch.object(default_storage, 'save', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                process_profile_picture(self.user.pk)
+        self.assertEqual(UserProfile.objects.get(pk=self.user.pk).picture_hash, '')
+
+        with override_settings(SOCIAL_JOBS_INLINE=False):
+            jobs.enqueue('process_profile_picture', profile_pk=self.user.pk)
+        job = jobs.claim()[0]
+        with mock.patch.object(default_storage, 'save', side_effect=OSError('disk full')), self.assertLogs('social.jobs', 'WARNING'):
+            self.assertFalse(jobs.run(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED) # again, with a backoff
+        self.assertIn('disk full', job.last_error)
+
+    def test_backfill_command(self):
+        names = [self.upload('a.jpg')]
+        other = User.objects.create_user('other', password='admin@123')
+        UserProfile.objects.filter(pk=other.pk).update(picture=names[0]) # same file
+        broken = User.objects.create_user('broken', password='admin@123')
+        broken_name = default_storage.save('uploads/profile_pictures/broken.jpg', ContentFile(b'not a picture'))
+        UserProfile.objects.filter(pk=broken.pk).update(picture=broken_name)
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('process_profile_pictures', '--workers', '1', stdout=out, stderr=err)
+        self.assertIn('Processed 1 pictures, 1 failed', out.getvalue())
+        self.assertIn('broken.jpg', err.getvalue())
+        digest = render_thumbnails(names[0])
+        self.assertEqual(
+            dict(UserProfile.objects.filter(pk__in=[self.user.pk, other.pk, broken.pk]).values_list('pk', 'picture_hash')),
+            {self.user.pk: digest, other.pk: digest, broken.pk: ''},
+        )
+
+        out = io.StringIO()
+        call_command('process_profile_pictures', '--workers', '1', stdout=out, stderr=io.StringIO())
+        self.assertIn('Processed 0 pictures, 1 failed', out.getvalue()) # only the broken one is left
+
+
+class ReactionViewTests(TestCase):
+    """
+    The like/dislike and follow buttons: the JSON API, and the form views it falls back to
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+        cls.missing = cls.post.pk + 1000
+
+    def react(self, pk, value=None, undo=False):
+        if undo:
+            return self.client.post(reverse('api-unreact', kwargs={'pk': pk}))
+        return self.client.post(reverse('api-react', kwargs={'pk': pk}), {} if value is None else {'value': value})
+
+    def follow(self, pk, undo=False):
+        return self.client.post(reverse('api-unfollow' if undo else 'api-follow', kwargs={'pk': pk}))
+
+    def test_react(self):
+        self.client.force_login(self.reader)
+        payload = {'post': self.post.pk, 'reaction': 'like', 'likes_count': 1, 'dislikes_count': 0}
+        self.assertEqual(self.react(self.post.pk, 'like').json(), payload)
+        self.assertEqual(self.react(self.post.pk, 'like').json(), payload) # sent twice, counted once
+        self.assertEqual(self.react(self.post.pk, 'dislike').json(), {**payload, 'reaction': 'dislike', 'likes_count': 0, 'dislikes_count': 1})
+        self.assertEqual(self.react(self.post.pk, undo=True).json(), {**payload, 'reaction': None, 'likes_count': 0})
+        self.assertEqual(self.react(self.post.pk, undo=True).json()['dislikes_count'], 0)
+
+    def test_react_errors(self):
+        for response in (self.react(self.post.pk, 'like'), self.react(self.post.pk, undo=True)):
+            self.assertEqual((response.status_code, response.json()), (401, {'error': 'Login required'}))
+        self.client.force_login(self.reader)
+        for value in (None, 'love', 'LIKE'):
+            self.assertEqual(self.react(self.post.pk, value).status_code, 400, value)
+        self.assertEqual(self.react(self.missing, 'like').status_code, 404)
+        self.assertEqual(self.react(self.missing, undo=True).status_code, 404)
+        self.assertEqual(self.client.get(reverse('api-react', kwargs={'pk': self.post.pk})).status_code, 405)
+        self.assertFalse(Reaction.objects.using(sharding.post_db(self.post.pk)).exists())
+
+    def test_follow(self):
+        self.client.force_login(self.reader)
+        payload = {'profile': self.author.pk, 'following': True, 'followers_count': 1}
+        self.assertEqual(self.follow(self.author.pk).json(), payload)
+        self.assertEqual(self.follow(self.author.pk).json(), payload) # following twice changes nothing
+        self.assertEqual(self.follow(self.author.pk, undo=True).json(), {**payload, 'following': False, 'followers_count': 0})
+        self.assertEqual(self.follow(self.author.pk, undo=True).json()['followers_count'], 0)
+
+    def test_follow_errors(self):
+        self.assertEqual(self.follow(self.author.pk).status_code, 401)
+        self.client.force_login(self.reader)
+        response = self.follow(self.reader.pk)
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'You can not follow yourself'}))
+        self.assertEqual(self.follow(self.author.pk + 1000).status_code, 404)
+        self.assertEqual(self.follow(self.author.pk + 1000, undo=True).status_code, 404)
+
+    def test_form_views(self):
+        self.client.force_login(self.reader)
+        url = reverse('like', kwargs={'pk': self.post.pk})
+        self.assertEqual(self.client.get(url).status_code, 405) # a link or a prefetch doesn't like anything
+        self.assertFalse(Reaction.objects.using(sharding.post_db(self.post.pk)).exists())
+
+        response = self.client.post(url, {'next': '/home/'})
+        self.assertRedirects(response, '/home/', fetch_redirect_response=False)
+        self.assertEqual(Reaction.get_user_reactions(self.reader, [self.post.pk]), {self.post.pk: 'like'})
+        response = self.client.post(reverse('dislike', kwargs={'pk': self.post.pk}), {'next': 'https://example.com/'})
+        self.assertRedirects(response, '/latest-posts/', fetch_redirect_response=False) # not to another site
+        self.assertEqual(Reaction.get_user_reactions(self.reader, [self.post.pk]), {self.post.pk: 'dislike'})
+        self.assertEqual(self.client.post(reverse('like', kwargs={'pk': self.missing})).status_code, 404)
+
+
+class AsyncViewTests(TestCase):
+    """
+    The async pages (ASGI) show the same as their sync versions
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.author.profile.followers.add(cls.reader)
+        cls.post = Post.objects.create(body='hello #django', author=cls.author)
+        Post.objects.create(body='another post', author=cls.reader)
+        for i in range(3):
+            Comment.objects.create(post=cls.post, author=cls.reader, comment='comment %d' % i)
+        Reaction.toggle(cls.post.pk, cls.reader, Reaction.LIKE)
+
+    def html(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        # the csrf token is masked differently on every render, and the forms link back to the page itself
+        content = response.content.decode().replace('value="%s"' % url, 'value="<next>"')
+        return re.sub(r'name="csrfmiddlewaretoken" value="[^"]*"', 'name="csrfmiddlewaretoken"', content)
+
+    def test_same_pages(self):
+        pages = [
+            ('latest-post-list', {}),
+            ('post-detail', {'pk': self.post.pk}),
+            ('profile', {'pk': self.author.pk}),
+        ]
+        for login in (False, True):
+            if login:
+                self.client.force_login(self.reader)
+            for name, kwargs in pages:
+                with self.subTest(name=name, login=login):
+                    self.assertEqual(self.html(reverse('async-' + name, kwargs=kwargs)), self.html(reverse(name, kwargs=kwargs)))
+
+
+class UserStatsTests(TestCase):
+    """
+    UserStats follows the posts, comments, follows and likes through the signals, reconcile_user_stats fixes any drift
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+
+    def stats(self, user):
+        return UserStats.objects.values(*UserStats.COUNTER_FIELDS).get(pk=user.pk)
+
+    def test_posts_and_comments(self):
+        post = Post.objects.create(body='hello', author=self.author)
+        comment = Comment.objects.create(post=post, author=self.reader, comment='hi')
+        self.assertEqual(self.stats(self.author)['posts_count'], 1)
+        self.assertEqual(self.stats(self.reader)['comments_count'], 1)
+        comment.delete()
+        post.delete()
+        self.assertEqual(self.stats(self.author)['posts_count'], 0)
+        self.assertEqual(self.stats(self.reader)['comments_count'], 0)
+
+    def test_follows(self):
+        self.author.profile.followers.add(self.reader)
+        self.author.profile.followers.add(self.reader) # already following: counted once
+        self.assertEqual(self.stats(self.author)['followers_count'], 1)
+        self.assertEqual(self.stats(self.reader)['following_count'], 1)
+        self.reader.followers.remove(self.author.profile) # the reverse side of the same follow
+        self.assertEqual(self.stats(self.author)['followers_count'], 0)
+        self.assertEqual(self.stats(self.reader)['following_count'], 0)
+
+    def test_likes_received(self):
+        post = Post.objects.create(body='hello', author=self.author)
+        Reaction.toggle(post.pk, self.reader, Reaction.LIKE)
+        self.assertEqual(self.stats(self.author)['likes_received'], 1)
+        Reaction.toggle(post.pk, self.reader, Reaction.DISLIKE) # the like is switched to a dislike
+        self.assertEqual(self.stats(self.author)['likes_received'], 0)
+        Reaction.toggle(post.pk, self.reader, Reaction.LIKE)
+        post.delete()
+        self.assertEqual(self.stats(self.author)['likes_received'], 0)
+
+    def test_views(self):
+        """
+        The counters move through the pages that write posts, comments and follows, and show on the profile
+        """
+        self.client.force_login(self.author)
+        self.client.post(reverse('latest-post-list'), {'body': 'hello'})
+        self.client.post(reverse('latest-post-list'), {'body': 'again'})
+        self.assertEqual(self.stats(self.author)['posts_count'], 2)
+        posts = list(Post.get_post_data("filter", self.author))
+
+        self.client.force_login(self.reader)
+        self.client.post(reverse('add-follower', kwargs={'pk': self.author.pk}))
+        self.client.post(reverse('add-follower', kwargs={'pk': self.author.pk})) # already following
+        for post in posts:
+            self.client.post(reverse('post-detail', kwargs={'pk': post.pk}), {'comment': 'hi'})
+        self.assertEqual(self.stats(self.reader)['comments_count'], 2)
+        self.assertEqual(self.stats(self.reader)['following_count'], 1)
+        self.assertEqual(self.stats(self.author)['followers_count'], 1)
+        response = self.client.get(reverse('profile', kwargs={'pk': self.author.pk}))
+        self.assertEqual(
+            (response.context['number_of_followers'], response.context['number_of_following'], response.context['number_of_posts']),
+            (1, 0, 2)
+        )
+
+        comment = Comment.objects.using(sharding.post_db(posts[0].pk)).get(post=posts[0])
+        self.client.post(reverse('comment-delete', kwargs={'post_pk': posts[0].pk, 'pk': comment.pk}))
+        self.client.post(reverse('remove-follower', kwargs={'pk': self.author.pk}))
+        self.assertEqual(self.stats(self.reader)['comments_count'], 1)
+        self.assertEqual(self.stats(self.reader)['following_count'], 0)
+        self.assertEqual(self.stats(self.author)['followers_count'], 0)
+
+        # a deleted post leaves the author's numbers at once, its comments when it is purged
+        self.client.force_login(self.author)
+        self.client.post(reverse('post-delete', kwargs={'pk': posts[1].pk}))
+        self.assertEqual(self.stats(self.author)['posts_count'], 1)
+        self.assertEqual(self.stats(self.reader)['comments_count'], 1)
+        Post.purge(posts[1].pk)
+        self.assertEqual(self.stats(self.reader)['comments_count'], 0)
+
+    def test_reconcile_report(self):
+        self.author.profile.followers.add(self.reader)
+        UserStats.objects.filter(pk=self.author.pk).update(followers_count=0, following_count=3) # drifted
+        out = io.StringIO()
+        call_command('reconcile_user_stats', workers=1, chunk_size=1, stdout=out)
+        self.assertIn("followers_count  1 drifted", out.getvalue())
+        self.assertIn("following_count  1 drifted", out.getvalue())
+        self.assertIn("Checked 2 users, 2 drifted values fixed", out.getvalue())
+        self.assertEqual((self.stats(self.author)['followers_count'], self.stats(self.author)['following_count']), (1, 0))
+
+        out = io.StringIO()
+        call_command('reconcile_user_stats', workers=1, stdout=out)
+        self.assertIn("Checked 2 users, 0 drifted values fixed", out.getvalue())
+
+    def test_reconcile(self):
+        post = Post.objects.create(body='hello', author=self.author)
+        Comment.objects.create(post=post, author=self.reader, comment='hi')
+        Reaction.toggle(post.pk, self.reader, Reaction.LIKE)
+        self.author.profile.followers.add(self.reader)
+        expected = {user.pk: self.stats(user) for user in (self.author, self.reader)}
+
+        UserStats.objects.filter(pk=self.author.pk).update(posts_count=7, likes_received=0) # drifted
+        UserStats.objects.filter(pk=self.reader.pk).delete() # missing
+        call_command('reconcile_user_stats', workers=1, stdout=io.StringIO())
+        self.assertEqual({user.pk: self.stats(user) for user in (self.author, self.reader)}, expected)
+
+    def test_reconcile_dry_run(self):
+        UserStats.objects.filter(pk=self.author.pk).update(posts_count=7)
+        call_command('reconcile_user_stats', workers=1, dry_run=True, stdout=io.StringIO())
+        self.assertEqual(self.stats(self.author)['posts_count'], 7)
+
+
+@override_settings(SOCIAL_QUERY_BUDGET_STRICT=True)
+class RequestTimingTests(TestCase):
+    """
+    RequestTimingMiddleware: Server-Timing header, per url name statistics, the staff only metrics page
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', password='admin@123')
+        cls.staff = User.objects.create_user('staff', password='admin@123', is_staff=True)
+        Post.objects.create(body='hello', author=cls.user)
+
+    def setUp(self):
+        request_stats.clear()
+        self.addCleanup(request_stats.clear)
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('latest-post-list'))
+        match = re.fullmatch(r'db;dur=([\d.]+);desc="(\d+) queries", tpl;dur=([\d.]+), view;dur=([\d.]+)', response['Server-Timing'])
+        self.assertIsNotNone(match, response['Server-Timing'])
+        db_ms, queries, template_ms, view_ms = float(match[1]), int(match[2]), float(match[3]), float(match[4])
+        self.assertGreater(queries, 0)
+        self.assertGreater(template_ms, 0) # the template timer is installed by the app, not by the middleware
+        self.assertLessEqual(db_ms + template_ms, view_ms)
+
+    def test_template_timer_installed_once(self):
+        install_template_timer()
+        install_template_timer()
+        self.assertIs(DjangoTemplate.render, middleware._timed_template_render)
+        self.assertIsNot(middleware._original_template_render, middleware._timed_template_render)
+
+    def test_histogram(self):
+        stats = RequestStats(window=3)
+        for view_ms in (3, 7, 400, 3000):
+            timing = RequestTiming()
+            timing.view_time, timing.queries = view_ms / 1000, 2
+            stats.record('page', timing)
+        summary = stats.summary()['page']
+        self.assertEqual(summary['count'], 3) # the oldest sample left the window
+        self.assertEqual({bucket: count for bucket, count in summary['histogram'].items() if count}, {'<=10': 1, '<=500': 1, '>2500': 1})
+        self.assertEqual(summary['view_ms']['p50'], 400)
+        self.assertEqual(summary['queries_max'], 2)
+
+    def test_metrics_page(self):
+        for i in range(3):
+            self.client.get(reverse('latest-post-list'))
+        self.client.force_login(self.staff)
+        summary = self.client.get(reverse('request-metrics')).json()['latest-post-list']
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(sum(summary['histogram'].values()), 3)
+        self.assertGreater(summary['queries_avg'], 0)
+
+        self.client.get(reverse('request-metrics'), {'reset': 1})
+        self.assertEqual(list(self.client.get(reverse('request-metrics')).json()), ['request-metrics'])
+
+    def test_metrics_staff_only(self):
+        self.assertEqual(self.client.get(reverse('request-metrics')).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('request-metrics')).status_code, 403)
+
+
+class BenchmarkTests(TestCase):
+    """
+    run_benchmark drives every route, the staff only ones as its own user
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.author.profile.followers.add(cls.reader)
+        User.objects.create_user('other', password='admin@123') # followed and unfollowed
+
+    def setUp(self):
+        self.client.force_login(self.author)
+        with self.captureOnCommitCallbacks(execute=True): # hashtags and mentions (inline job)
+            self.client.post(reverse('latest-post-list'), {'body': 'benchmarking #django with @reader'})
+        post = Post.objects.using(sharding.author_db(self.author.pk)).get(author=self.author)
+        Comment.objects.create(post=post, author=self.reader, comment='hi')
+
+    def test_routes(self):
+        report = benchmark.run_benchmark(iterations=1, warmup=0, host='testserver')
+        routes = report['routes']
+        self.assertEqual(report['skipped'], [])
+        self.assertEqual(routes['search']['url'], reverse('search') + '?q=benchmarking')
+        self.assertEqual(routes['tag']['url'], reverse('tag', kwargs={'name': 'django'}))
+        self.assertEqual(routes['mentions']['url'], reverse('mentions', kwargs={'username': 'reader'}))
+        for name in ('search', 'tag', 'mentions', 'request-metrics'):
+            self.assertEqual(routes[name]['status'], 200, name)
+        self.assertEqual((report['meta']['users'], report['meta']['posts']), (3, 1))
+
+        # no account of the dataset is made staff, the benchmark user is reused by the next run
+        self.assertFalse(User.objects.filter(is_staff=True).exclude(username=benchmark.BENCHMARK_USERNAME).exists())
+        benchmark.run_benchmark(iterations=1, warmup=0, host='testserver')
+        self.assertEqual(User.objects.filter(username=benchmark.BENCHMARK_USERNAME).count(), 1)
+
+    def test_staff_user_taken(self):
+        User.objects.create_user(benchmark.BENCHMARK_USERNAME)
+        with self.assertRaises(ValueError):
+            benchmark.get_staff_user()
+
+
+class QueryBudgetTests(TestCase):
+    """
+    The pages with a query budget (SOCIAL_QUERY_BUDGETS) stay within it, trending tags panel not cached yet
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.reader = User.objects.create_user('reader', password='admin@123')
+        cls.author.profile.followers.add(cls.reader)
+        posts = [Post.objects.create(body='post %d #django #python' % i, author=cls.author) for i in range(5)]
+        index_new_posts(posts)
+
+    @skipIf(len(settings.SOCIAL_POST_SHARDS) > 1, "the budgets are for one database, the feeds read a page from every shard")
+    def test_pages(self):
+        urls = [
+            reverse('latest-post-list'),
+            reverse('hot-post-list'),
+            reverse('profile', kwargs={'pk': self.author.pk}),
+            reverse('async-latest-post-list'),
+            reverse('async-profile', kwargs={'pk': self.author.pk}),
+        ]
+        for login in (False, True):
+            if login:
+                self.client.force_login(self.reader)
+                urls += [reverse('home-timeline'), reverse('my-post-list')]
+            for url in urls:
+                cache.delete(TRENDING_CACHE_KEY)
+                self.assertEqual(self.client.get(url).status_code, 200, url) # QueryBudgetExceeded otherwise
+
+    def test_trending_tags(self):
+        cache.delete(TRENDING_CACHE_KEY)
+        self.assertEqual(sorted(name for name, score in get_trending_tags()), ['django', 'python'])
+
+    def test_prune_tag_buckets(self):
+        old = timezone.now() - datetime.timedelta(hours=settings.SOCIAL_TRENDING_WINDOW_HOURS + 2)
+        count_tags({Hashtag.objects.get(name='django').pk: 3}, old)
+        self.assertEqual(prune_tag_buckets(batch_size=1), 1)
+        self.assertFalse(TagBucket.objects.filter(hour__lt=old + datetime.timedelta(hours=1)).exists())
+        self.assertTrue(TagBucket.objects.exists()) # the buckets of the window stay
+
+
+class ReactionQueueTests(TestCase):
+    """
+    Write-behind reactions (social/reaction_queue.py): queued, shown right away, applied by flush()
+    """
+    databases = POST_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='admin@123')
+        cls.users = [User.objects.create_user('user%d' % i, password='admin@123') for i in range(3)]
+        cls.post = Post.objects.create(body='hello', author=cls.author)
+
+    def setUp(self):
+        queue_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(queue_dir.cleanup)
+        settings_override = override_settings(
+            SOCIAL_REACTION_WRITE_BEHIND=True,
+            SOCIAL_REACTION_QUEUE_PATH=os.path.join(queue_dir.name, 'queue.sqlite3'),
+            SOCIAL_REACTION_FLUSH_THREAD=False, # flushed by the tests
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def counts(self, post):
+        return Post.objects.using(sharding.post_db(post.pk)).values_list('likes_count', 'dislikes_count').get(pk=post.pk)
+
+    def reactions(self, post):
+        return Reaction.objects.using(sharding.post_db(post.pk)).filter(post_id=post.pk)
+
+    def test_queued_then_flushed(self):
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        self.assertFalse(self.reactions(self.post).exists())
+        self.assertEqual(self.counts(self.post), (0, 0))
+        # shown before the flush
+        self.assertEqual(Reaction.get_user_reactions(self.users[0], [self.post.pk]), {self.post.pk: 'like'})
+        self.assertEqual(Reaction.get_counts(self.post.pk), {'likes_count': 1, 'dislikes_count': 0})
+
+        self.assertEqual(reaction_queue.flush(), 1)
+        self.assertEqual(self.reactions(self.post).get().value, Reaction.LIKE)
+        self.assertEqual(self.counts(self.post), (1, 0))
+        self.assertEqual(UserStats.objects.get(pk=self.author.pk).likes_received, 1)
+        self.assertEqual(reaction_queue.flush(), 0)
+
+    def test_repeated_clicks_collapse(self):
+        user = self.users[0]
+        for value in (Reaction.LIKE, Reaction.LIKE, Reaction.LIKE, Reaction.DISLIKE):
+            Reaction.toggle(self.post.pk, user, value) # like, none, like, dislike
+        Reaction.set(self.post.pk, user, Reaction.DISLIKE) # no change, not queued
+        self.assertEqual(reaction_queue.flush(), 4)
+        self.assertEqual(list(self.reactions(self.post).values_list('user_id', 'value')), [(user.pk, Reaction.DISLIKE)])
+        self.assertEqual(self.counts(self.post), (0, 1))
+
+    def test_same_counters_as_direct_writes(self):
+        clicks = [(0, Reaction.LIKE), (1, Reaction.DISLIKE), (0, Reaction.DISLIKE), (2, Reaction.LIKE), (1, Reaction.DISLIKE), (2, Reaction.LIKE), (2, Reaction.LIKE)]
+        direct = Post.objects.create(body='direct', author=self.author)
+        for user, value in clicks:
+            Reaction.toggle(self.post.pk, self.users[user], value)
+        with override_settings(SOCIAL_REACTION_WRITE_BEHIND=False):
+            for user, value in clicks:
+                Reaction.toggle(direct.pk, self.users[user], value)
+        reaction_queue.flush(limit=2) # several batches
+        reaction_queue.flush()
+
+        self.assertEqual(self.counts(self.post), self.counts(direct))
+        self.assertEqual(
+            sorted(self.reactions(self.post).values_list('user_id', 'value')),
+            sorted(self.reactions(direct).values_list('user_id', 'value')),
+        )
+
+    def test_queue_not_locked_while_applying(self):
+        apply = reaction_queue.apply
+        during = []
+
+        def slow_apply(final, db):
+            # a click and a second flusher arrive while the batch is applied to the main database
+            Reaction.toggle(self.post.pk, self.users[0], Reaction.DISLIKE)
+            during.append(reaction_queue.flush())
+            apply(final, db)
+
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        with mock.patch.object(reaction_queue, 'apply', slow_apply):
+            self.assertEqual(reaction_queue.flush(), 1)
+        self.assertEqual(during, [0]) # the claimed batch is not applied twice
+        self.assertEqual(self.reactions(self.post).get().value, Reaction.LIKE)
+        self.assertEqual(reaction_queue.get_connection().execute("SELECT value FROM pending").fetchall(), [(Reaction.DISLIKE,)])
+
+        self.assertEqual(reaction_queue.flush(), 1) # the click queued meanwhile
+        self.assertEqual(self.reactions(self.post).get().value, Reaction.DISLIKE)
+        self.assertEqual(self.counts(self.post), (0, 1))
+
+    def test_failed_batch_retried(self):
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        with mock.patch.object(reaction_queue, 'apply', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                reaction_queue.flush()
+        self.assertEqual(reaction_queue.flush(), 1) # claim dropped, no need to wait for the lease
+        self.assertEqual(self.counts(self.post), (1, 0))
+
+    def test_lease_of_dead_flusher(self):
+        Reaction.toggle(self.post.pk, self.users[0], Reaction.LIKE)
+        self.assertEqual(len(reaction_queue.claim(10)), 1) # its flusher never comes back
+        self.assertEqual(reaction_queue.flush(), 0)
+        with override_settings(SOCIAL_REACTION_FLUSH_LEASE=0):
+            self.assertEqual(reaction_queue.flush(), 1)
+        self.assertEqual(self.counts(self.post), (1, 0))
+
+
+class LiveEventsTests(TestCase):
+    """
+    The broadcaster and the event stream of the live "N new posts" (social/live.py)
+    """
+    databases = POST_DATABASES
+
+    async def test_publish_wakes_subscribers(self):
+        events = Broadcaster(size=2)
+        subscription, seq = events.subscribe()
+        thread = threading.Thread(target=events.publish, args=[{'pk': 1}]) # published by a request thread
+        thread.start()
+        await asyncio.wait_for(subscription[1].wait(), 5)
+        thread.join()
+        self.assertEqual(events.events_since(seq), ([{'pk': 1}], 0, 1))
+
+        events.publish({'pk': 2})
+        events.publish({'pk': 3})
+        self.assertEqual(events.events_since(seq), ([{'pk': 2}, {'pk': 3}], 1, 3)) # {'pk': 1} is gone
+
+        events.unsubscribe(subscription)
+        self.assertEqual(events.subscribers, set())
+
+    async def test_stream(self):
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'http', 'method': 'GET', 'path': '/live/latest-posts/', 'query_string': b''}
+        stream = asyncio.ensure_future(latest_posts_events(scope, received.get, sent.put))
+
+        start = await asyncio.wait_for(sent.get(), 5)
+        self.assertEqual(start['status'], 200)
+        self.assertEqual((await sent.get())['body'], b'retry: 5000\n\n')
+        self.assertEqual(len(broadcaster.subscribers), 1)
+
+        broadcaster.publish({'pk': 2 ** 62}) # newer than any post
+        body = (await asyncio.wait_for(sent.get(), 5))['body'].decode()
+        self.assertTrue(body.startswith('event: posts\n'))
+        self.assertEqual(json.loads(body.split('data: ')[1]), {'count': 1, 'more': False, 'since': None})
+
+        # a client going away is dropped
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(stream, 5)
+        self.assertEqual((await sent.get())['body'], b'')
+        self.assertEqual(broadcaster.subscribers, set())
+
+
+@override_settings(SOCIAL_JOBS_INLINE=False, SOCIAL_JOB_BACKOFF=5, SOCIAL_JOB_MAX_BACKOFF=3600)
+class JobTests(TestCase):
+    """
+    Jobs queued in the Job table and run by the workers (social/jobs.py)
+    """
+
+    def setUp(self):
+        self.calls = []
+
+        def record(**payload):
+            self.calls.append(payload)
+
+        def fail(**payload):
+            raise ValueError("failed %r" % payload)
+
+        jobs.job('test_record')(record)
+        jobs.job('test_fail', max_attempts=2)(fail)
+        self.addCleanup(jobs.REGISTRY.pop, 'test_record')
+        self.addCleanup(jobs.REGISTRY.pop, 'test_fail')
+
+    def test_queued_not_inline(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            queued = jobs.enqueue('test_record', pk=1)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.calls, [])
+        self.assertEqual((queued.status, queued.payload, queued.max_attempts), (Job.QUEUED, {'pk': 1}, 5))
+
+        self.assertEqual(jobs.work(burst=True), (1, 0))
+        self.assertEqual(self.calls, [{'pk': 1}])
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.claimed_by), (Job.DONE, 1, ''))
+
+    def test_claimed_once(self):
+        for i in range(5):
+            jobs.enqueue('test_record', pk=i)
+        later = jobs.enqueue('test_record', delay=datetime.timedelta(hours=1), pk=5)
+
+        first = jobs.claim(limit=3)
+        second = jobs.claim(limit=3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertNotEqual(first[0].claimed_by, second[0].claimed_by)
+        self.assertEqual(jobs.claim(), []) # the running jobs aren't claimed again, the delayed one isn't due
+        self.assertEqual(Job.objects.get(pk=later.pk).status, Job.QUEUED)
+
+        # a worker that lost its lease doesn't overwrite the job claimed by another one
+        stale = first[0]
+        Job.objects.filter(pk=stale.pk).update(status=Job.QUEUED, run_at=timezone.now())
+        [retaken] = jobs.claim()
+        self.assertEqual(retaken.pk, stale.pk)
+        jobs.run(stale)
+        self.assertEqual(Job.objects.get(pk=stale.pk).status, Job.RUNNING)
+        jobs.run(retaken)
+        self.assertEqual(Job.objects.get(pk=stale.pk).status, Job.DONE)
+
+    def test_retry_then_failed(self):
+        queued = jobs.enqueue('test_fail', pk=1)
+        self.assertEqual(queued.max_attempts, 2)
+
+        [claimed] = jobs.claim()
+        before = timezone.now()
+        with self.assertLogs('social.jobs', 'WARNING'):
+            self.assertFalse(jobs.run(claimed))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.claimed_by), (Job.QUEUED, 1, ''))
+        self.assertIn("ValueError: failed {'pk': 1}", queued.last_error)
+        # retried in SOCIAL_JOB_BACKOFF seconds, give or take the jitter
+        self.assertGreaterEqual(queued.run_at, before + datetime.timedelta(seconds=2.5))
+        self.assertLessEqual(queued.run_at, timezone.now() + datetime.timedelta(seconds=5))
+        self.assertEqual(jobs.claim(), []) # not due yet
+
+        Job.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('social.jobs', 'WARNING'):
+            self.assertEqual(jobs.work(burst=True), (0, 1))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.FAILED, 2))
+        self.assertEqual(jobs.claim(), [])
+
+    def test_backoff(self):
+        for attempts, seconds in [(1, 5), (2, 10), (3, 20), (20, 3600)]:
+            delay = jobs.get_backoff(attempts).total_seconds()
+            self.assertGreaterEqual(delay, seconds / 2)
+            self.assertLessEqual(delay, seconds)
+
+    def test_recover_expired_lease(self):
+        jobs.enqueue('test_record', pk=1)
+        jobs.enqueue('test_fail', pk=2)
+        claimed = jobs.claim()
+        Job.objects.filter(name='test_fail').update(attempts=2) # out of attempts
+        Job.objects.update(run_at=timezone.now() - datetime.timedelta(seconds=1)) # the worker died
+
+        self.assertEqual(jobs.recover(), 1)
+        self.assertEqual(
+            dict(Job.objects.values_list('name', 'status')),
+            {'test_record': Job.QUEUED, 'test_fail': Job.FAILED},
+        )
+        self.assertEqual(len(claimed), 2)
+
+
+@skipIf(settings.SOCIAL_POST_SHARDS, "the read replica isn't combined with sharded posts")
+@override_settings(SOCIAL_READ_REPLICA='replica')
+class ReadReplicaTests(TransactionTestCase):
+    """
+    The read-heavy pages read from the replica, until the user writes (social/routers.py)
+    The "replica" test database mirrors "default": it sees the rows committed there
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='admin@123')
+        self.post = Post.objects.create(body='hello', author=self.user)
+        self.client.force_login(self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        post_queries = lambda queries: [query['sql'] for query in queries if 'social_post' in query['sql']]
+        return response, post_queries(primary), post_queries(replica)
+
+    def test_reads_from_the_replica(self):
+        for url in (reverse('latest-post-list'), reverse('post-detail', kwargs={'pk': self.post.pk}), reverse('profile', kwargs={'pk': self.user.pk})):
+            response, primary, replica = self.get(url)
+            self.assertEqual(primary, [], url)
+            self.assertTrue(replica, url)
+            self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        # the other pages read from the primary
+        response, primary, replica = self.get(reverse('hot-post-list'))
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+    def test_primary_after_a_write(self):
+        url = reverse('post-detail', kwargs={'pk': self.post.pk})
+        response = self.client.post(url, {'comment': 'a new comment'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        self.assertTrue(response.cookies[STICKY_COOKIE]['httponly'])
+
+        # the next pages read from the primary while the cookie lasts, the new comment is on them
+        response, primary, replica = self.get(url)
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+        self.assertContains(response, 'a new comment')
+        response, primary, replica = self.get(reverse('latest-post-list'))
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+        self.client.cookies[STICKY_COOKIE] = '0' # expired
+        response, primary, replica = self.get(url)
+        self.assertEqual(primary, [])
+        self.assertTrue(replica)
+
+    def test_etag_follows_the_replica(self):
+        url = reverse('post-detail', kwargs={'pk': self.post.pk})
+        stamps.get_stamp_cache().delete(stamps.REPLICA_POSITION)
+        self.assertFalse(self.get(url)[0].has_header('ETag')) # how old the replica is isn't known
+
+        stamps.set_replica_position(time.time())
+        etag = self.get(url)[0]['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Reaction.toggle(self.post.pk, self.user, Reaction.LIKE) # not on the replica yet
+        stale_etag = self.get(url)[0]['ETag']
+        self.assertNotEqual(stale_etag, etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=stale_etag).status_code, 304)
+
+        stamps.set_replica_position(time.time()) # refreshed, the page read before is out of date
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=stale_etag).status_code, 200)
+
+        # a user kept on the primary gets the ETag of the stamps
+        self.client.cookies[STICKY_COOKIE] = '%d' % (time.time() + 60)
+        primary_etag = self.get(url)[0]['ETag']
+        stamps.get_stamp_cache().delete(stamps.REPLICA_POSITION)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=primary_etag).status_code, 304)
+
+
+SHARDS = settings.SOCIAL_SHARD_DATABASES[:2]
+
+
+@skipUnless(len(SHARDS) == 2, "needs two shard databases")
+@override_settings(SOCIAL_POST_SHARDS=SHARDS)
+class ShardingTests(TestCase):
+    """
+    Posts, comments and reactions stored on the shard of their author (social/sharding.py)
+    """
+    databases = {'default', *SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        # one author on each shard
+        cls.authors = {}
+        while len(cls.authors) < 2:
+            user = User.objects.create_user('author%d' % User.objects.count(), password='admin@123')
+            cls.authors.setdefault(sharding.author_db(user.pk), user)
+        cls.other = {SHARDS[0]: SHARDS[1], SHARDS[1]: SHARDS[0]}
+
+    def setUp(self):
+        cache.clear() # where the posts from before sharding were found
+
+    def stored_on(self, model, pk):
+        manager = model.all_objects if model is Post else model.objects
+        return [db for db in ('default', *SHARDS) if manager.using(db).filter(pk=pk).exists()]
+
+    def test_users_copied(self):
+        for db in SHARDS:
+            self.assertEqual(User.objects.using(db).filter(pk__in=[user.pk for user in self.authors.values()]).count(), 2)
+
+    def test_created_on_the_author_shard(self):
+        for db, author in self.authors.items():
+            post = Post.objects.create(body='hello', author=author)
+            self.assertEqual(self.stored_on(Post, post.pk), [db])
+            self.assertEqual(post._state.db, db)
+            self.assertGreaterEqual(post.pk, sharding.LEGACY_ID_LIMIT)
+            self.assertEqual(sharding.post_db(post.pk), db)
+
+            # the comments and reactions of other users go with the post
+            commenter = self.authors[self.other[db]]
+            comment = Comment.objects.create(post=post, author=commenter, comment='hi')
+            self.assertEqual(self.stored_on(Comment, comment.pk), [db])
+            comment = Comment.objects.create(post_id=post.pk, author=commenter, comment='hi again')
+            self.assertEqual(self.stored_on(Comment, comment.pk), [db])
+            Reaction.toggle(post.pk, commenter, Reaction.LIKE)
+            self.assertEqual(Reaction.objects.using(db).filter(post_id=post.pk).count(), 1)
+            self.assertEqual(Post.objects.using(db).get(pk=post.pk).likes_count, 1)
+
+    def test_legacy_ids(self):
+        db = SHARDS[1]
+        legacy = Post(pk=5, body='posted before sharding', author=self.authors[db])
+        legacy.save(using=db)
+        self.assertEqual(sharding.post_db(5), db)
+        self.assertEqual(sharding.post_db(6), SHARDS[0]) # missing everywhere
+
+        self.assertEqual(Post.get_post_data("get", 5).body, 'posted before sharding')
+        response = self.client.get(reverse('post-detail', kwargs={'pk': 5}))
+        self.assertContains(response, 'posted before sharding')
+        comment = Comment.objects.create(post_id=5, author=self.authors[SHARDS[0]], comment='an old post')
+        self.assertEqual(self.stored_on(Comment, comment.pk), [db])
+        self.assertEqual(list(Comment.get_comment_page(5)), [comment])
+
+    def test_legacy_location_cached(self):
+        db = SHARDS[1]
+        Post(pk=5, body='posted before sharding', author=self.authors[db]).save(using=db)
+        with self.assertNumQueries(1, using=SHARDS[0]), self.assertNumQueries(1, using=db):
+            for i in range(3):
+                self.assertEqual(sharding.post_db(5), db) # looked for on every shard once
+        with self.assertNumQueries(2, using=SHARDS[0]), self.assertNumQueries(2, using=db):
+            self.assertEqual(sharding.post_db(6), SHARDS[0]) # a missing post isn't remembered
+            self.assertEqual(sharding.post_db(6), SHARDS[0])
+
+    def test_reshard_records_legacy_locations(self):
+        author = self.authors[SHARDS[0]]
+        Post(pk=5, body='on the wrong shard', author=author).save(using=SHARDS[1])
+        self.assertEqual(sharding.post_db(5), SHARDS[1])
+
+        out = io.StringIO()
+        call_command('reshard_posts', stdout=out)
+        self.assertIn('Moved 1 posts to the shard of their author', out.getvalue())
+        self.assertEqual(self.stored_on(Post, 5), [SHARDS[0]])
+        with self.assertNumQueries(0, using=SHARDS[0]), self.assertNumQueries(0, using=SHARDS[1]):
+            self.assertEqual(sharding.post_db(5), SHARDS[0])
+        self.assertContains(self.client.get(reverse('post-detail', kwargs={'pk': 5})), 'on the wrong shard')
+
+    def test_merged_pages(self):
+        start = timezone.now() - datetime.timedelta(days=1)
+        posts = [
+            Post.objects.create(body='post %d' % i, author=author, created_on=start + datetime.timedelta(minutes=i // 2))
+            for i, author in enumerate(list(self.authors.values()) * 4) # every shard has a post at the same time
+        ]
+        newest_first = [post.pk for post in sorted(posts, key=lambda post: (post.created_on, post.pk), reverse=True)]
+
+        pages = [Post.get_post_data("all", page_size=3)]
+        while pages[-1].older_cursor:
+            pages.append(Post.get_post_data("all", cursor=pages[-1].older_cursor, page_size=3))
+        self.assertEqual([post.pk for page in pages for post in page], newest_first)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertFalse(pages[-1].has_older)
+
+        newer = [pages[-1]]
+        while newer[-1].newer_cursor:
+            newer.append(Post.get_post_data("all", cursor=newer[-1].newer_cursor, direction="newer", page_size=3))
+        self.assertEqual([post.pk for page in reversed(newer) for post in page], newest_first)
+
+        with override_settings(SOCIAL_PAGE_SIZE=3):
+            response = self.client.get(reverse('latest-post-list'))
+        self.assertEqual([post.pk for post in response.context['post_list']], newest_first[:3])
+
+    def test_search_every_shard(self):
+        for db, author in self.authors.items():
+            Post.objects.create(body='searching the %s shard' % db, author=author)
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        posts, has_next = search_posts('searching', page_size=1)
+        self.assertTrue(has_next)
+        posts, has_next = search_posts('searching')
+        self.assertEqual(sorted(post.body for post in posts), ['searching the %s shard' % db for db in SHARDS])
+        self.assertFalse(has_next)
@@ -2,8 +2,11 @@ from django.urls import path
 from .views import *
 urlpatterns = [
     path('latest-posts/', PostListView.as_view(), name='latest-post-list'),
+    path('hot/', HotPostListView.as_view(), name='hot-post-list'),
+    path('home/', HomeTimelineView.as_view(), name='home-timeline'),
     path('my-posts/', my_posts, name='my-post-list'),
     path('post/<int:pk>', PostDetailView.as_view(), name='post-detail'),
+    path('post/<int:pk>/comments', CommentListView.as_view(), name='post-comments'),
     path('post/edit/<int:pk>', PostEditView.as_view(), name='post-edit'),
     path('post/delete/<int:pk>', PostDeleteView.as_view(), name='post-delete'),
     path('post/<int:post_pk>/comment/delete/<int:pk>', CommentDeleteView.as_view(), name='comment-delete'),
@@ -15,5 +18,16 @@ urlpatterns = [
     path('profile/<int:pk>/follwers/remove', RemoveFollower.as_view(), name='remove-follower'), 
     path('profile/<int:pk>/follwers/remove', RemoveFollower.as_view(), name='remove-follower'), 
     # path('profile/<int:pk>/follwers/add', unfollow, name='unfollow'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('tag/<str:name>', TagView.as_view(), name='tag'),
+    path('mentions/<str:username>', MentionsView.as_view(), name='mentions'),
+    path('async/latest-posts/', AsyncPostListView.as_view(), name='async-latest-post-list'),
+    path('async/post/<int:pk>', AsyncPostDetailView.as_view(), name='async-post-detail'),
+    path('async/profile/<int:pk>', AsyncProfileView.as_view(), name='async-profile'),
     path('error/', error_view, name='error-page'), 
+    path('metrics/requests/', request_metrics, name='request-metrics'),
+    path('api/post/<int:pk>/react', ReactApiView.as_view(), name='api-react'),
+    path('api/post/<int:pk>/unreact', UnreactApiView.as_view(), name='api-unreact'),
+    path('api/profile/<int:pk>/follow', FollowApiView.as_view(), name='api-follow'),
+    path('api/profile/<int:pk>/unfollow', UnfollowApiView.as_view(), name='api-unfollow'),
 ]
\ No newline at end of file
@@ -1,32 +1,62 @@
-from django.shortcuts import render, HttpResponseRedirect, HttpResponse, redirect
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, HttpResponseRedirect, HttpResponse, redirect, get_object_or_404
+from django.http import JsonResponse
 from django.views import View
-from .models import Post, Comment, UserProfile
+from .models import Post, Comment, UserProfile, UserStats, Reaction, TimelineEntry, PostTag, Mention
 from .forms import PostForm, CommentForm
 from django.views.generic.edit import UpdateView, DeleteView
 from django.urls import reverse_lazy
+from django.utils.http import url_has_allowed_host_and_scheme
 from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
+from .pagination import get_cursor, get_page_size
+from .middleware import request_stats
+from .search import search_posts
+from .images import schedule_profile_picture
+from .live import LIVE_PATH, publish_post
+from .jobs import enqueue
+from .stamps import FEED, TRENDING, conditional_page, post_stamp, profile_stamp, touch
+from .tags import get_trending_tags
+from . import sharding
+
+def get_feed_stamps(request, **kwargs):
+    # the page shows the trending tags panel too, its list is computed again first when the cached one expired
+    get_trending_tags()
+    return [FEED, TRENDING]
+
 
 class PostListView(View):
     """
     Any user can see the latest post/tweet but only logged in user can write a new post/tweet
     """
 
+    @method_decorator(conditional_page(get_feed_stamps))
     def get(self, request, *args, **kwargs):
         """
         It will show all the posts/tweets on the platform - ordered by latest date
+        One page at a time, ?before=<cursor> / ?after=<cursor> move to older/newer posts
+        An AJAX request only gets the post cards, the live updates use it to insert the new posts
         """
+        cursor, direction = get_cursor(request)
         try:
-            posts = Post.get_post_data("all")
+            posts = Post.get_post_data("all", cursor=cursor, direction=direction, page_size=get_page_size())
         except:
             posts = None
             return render(request, "social/error_page.html")
-        form = PostForm()
+        reactions = Reaction.get_user_reactions(request.user, [post.pk for post in posts])
 
+        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+            return render(request, 'social/post_cards_fragment.html', {'post_list': posts, 'reactions': reactions})
+
+        form = PostForm()
         context = {
             'post_list': posts,
-            'form': form
+            'reactions': reactions,
+            'form': form,
+            'live_url': None if posts.has_newer else LIVE_PATH, # "N new posts" only make sense on the newest page
         }
         return render(request, 'social/post_list.html', context)
 
@@ -36,7 +66,7 @@ class PostListView(View):
         Only logged in user can write a new post/tweet
         """
         try:
-            posts = Post.get_post_data("filter", request.user)
+            posts = Post.get_post_data("filter", request.user, page_size=get_page_size())
         except:
             posts = None
             return render(request, "social/error_page.html")
@@ -46,22 +76,45 @@ class PostListView(View):
             new_post = form.save(commit=False) # Creates object "new_post" but doesn't save it into database (created on memory level only)
             new_post.author = request.user 
             new_post.save()
+            enqueue('process_new_post', post_pk=new_post.pk) # home timelines of the followers, hashtags and mentions
+            publish_post(new_post) # "new posts" notice of the open latest posts pages
             return HttpResponseRedirect('/latest-posts/') # once post/tweet is posted, it will redirect to same url/page
 
         context = {
             'post_list': posts,
+            'reactions': Reaction.get_user_reactions(request.user, [post.pk for post in posts]),
             'form': form
         }
 
         return render(request, 'social/post_list.html', context)
 
+class HomeTimelineView(LoginRequiredMixin, View):
+    """
+    Logged in user can see the posts/tweets of the accounts he/she follows
+    """
+    def get(self, request, *args, **kwargs):
+        cursor, direction = get_cursor(request)
+        try:
+            posts = TimelineEntry.get_home_timeline(request.user, cursor=cursor, direction=direction, page_size=get_page_size())
+        except:
+            posts = None
+            return render(request, "social/error_page.html")
+
+        context = {
+            'post_list': posts,
+            'reactions': Reaction.get_user_reactions(request.user, [post.pk for post in posts]),
+            'form': PostForm(),
+        }
+        return render(request, 'social/post_list.html', context)
+
 @login_required(login_url='index')
 def my_posts(request):
     """
     Logged in user can see all of his/her posts/tweets in "My Posts" navbar field
     """
+    cursor, direction = get_cursor(request)
     try:
-        posts = Post.get_post_data("filter", request.user)
+        posts = Post.get_post_data("filter", request.user, cursor=cursor, direction=direction, page_size=get_page_size())
     except:
         posts = None
         return render(request, "social/error_page.html")
@@ -76,9 +129,10 @@ class PostDetailView(View):
     Any user can see all the comments on the post
     Only logged in user can comment on the post
     """
+    @method_decorator(conditional_page(lambda request, pk, **kwargs: [post_stamp(pk)]))
     def get(self, request, pk, *args, **kwargs):
         """
-        Show all comment(s) of a post/tweet
+        Show the comment(s) of a post/tweet, one page at a time (latest first, ?before=<cursor> for older ones)
         """
         try:
             post = Post.get_post_data("get", pk)
@@ -87,7 +141,7 @@ class PostDetailView(View):
             return render(request, "social/error_page.html")
         form = CommentForm()
 
-        comments = Comment.objects.filter(post=post).order_by('-created_on')
+        comments = Comment.get_comment_page(post.pk, cursor=request.GET.get('before'))
 
         context = {
             'post': post,
@@ -116,7 +170,7 @@ class PostDetailView(View):
             new_comment.save()
             return HttpResponseRedirect('/post/'+str(pk)) # after commenting, it will redirect to same page and form() will be blank again
         
-        comments = Comment.objects.filter(post=post).order_by('-created_on')
+        comments = Comment.get_comment_page(post.pk)
 
         context = {
             'post': post,
@@ -126,6 +180,18 @@ class PostDetailView(View):
 
         return render(request, 'social/post_detail.html', context)
 
+class CommentListView(View):
+    """
+    "Load more" of the comments of a post: only the next page of comments, rendered as a fragment
+    """
+    def get(self, request, pk, *args, **kwargs):
+        get_object_or_404(Post.objects.using(sharding.post_db(pk)).only('pk'), pk=pk) # not for a missing or deleted post
+        context = {
+            'post_pk': pk,
+            'comments': Comment.get_comment_page(pk, cursor=request.GET.get('before')),
+        }
+        return render(request, 'social/comment_list.html', context)
+
 class PostEditView(LoginRequiredMixin, UpdateView):
     """
     If user of the post/tweet is logged in then he/she can delete the post
@@ -135,10 +201,19 @@ class PostEditView(LoginRequiredMixin, UpdateView):
     fields = ['body']
     template_name = 'social/post_edit.html'
 
+    def get_queryset(self):
+        return Post.objects.using(sharding.post_db(self.kwargs['pk']))
+
     def get_success_url(self):
         pk = self.kwargs['pk']
         return reverse_lazy('post-detail', kwargs={'pk': pk}) # to redirect on the same page after editing the post
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        Post.bump_version(pk=self.object.pk) # the cached post card shows the old body
+        enqueue('reindex_post', post_pk=self.object.pk) # the hashtags/mentions may have changed
+        return response
+
     def get(self, request, *args, **kwargs):
         """
         Will check whether current logged in user is the same as post's author
@@ -165,6 +240,15 @@ class PostDeleteView(LoginRequiredMixin, DeleteView):
     template_name = 'social/post_delete.html'
     success_url = reverse_lazy('my-post-list') # once deleted, redirect back to 'my-post-list' url
 
+    def get_queryset(self):
+        return Post.objects.using(sharding.post_db(self.kwargs['pk']))
+
+    def form_valid(self, form):
+        # hidden right away, the comments and reactions are deleted in small batches by the "purge_post" job
+        if self.object.soft_delete():
+            enqueue('purge_post', post_pk=self.object.pk)
+        return HttpResponseRedirect(self.get_success_url())
+
     def get(self, request, *args, **kwargs):
         """
         Will check whether current logged in user is the same as post's author
@@ -190,6 +274,9 @@ class CommentDeleteView(LoginRequiredMixin, DeleteView):
     model = Comment
     template_name = 'social/comment_delete.html'
 
+    def get_queryset(self):
+        return Comment.objects.using(sharding.post_db(self.kwargs['post_pk'])) # stored with the post
+
     def get_success_url(self):
         pk = self.kwargs['post_pk']
         return reverse_lazy('post-detail', kwargs={'pk': pk}) # Will redirect to the that 'post' after comment is deleted
@@ -212,27 +299,30 @@ class CommentDeleteView(LoginRequiredMixin, DeleteView):
             return render(request, 'social/error_page.html')
 
 class ProfileView(View):
+    """
+    Any user can see a profile with its numbers and posts/tweets
+    The numbers come precomputed from UserStats with the profile and the posts are paginated,
+    so a popular profile costs the same number of queries as a new one
+    """
+    @method_decorator(conditional_page(lambda request, pk, **kwargs: [profile_stamp(pk)]))
     def get(self, request, pk, *args, **kwargs):
-        profile = UserProfile.objects.get(pk=pk) # If primary key matches then store the object into profile
+        try:
+            profile = UserProfile.objects.select_related('user__stats').get(pk=pk) # If primary key matches then store the object into profile
+        except UserProfile.DoesNotExist:
+            return render(request, "social/error_page.html")
         user = profile.user
+        stats = UserStats.get_for(user)
 
-        followers = profile.followers.all()        
-        number_of_followers = len(followers)
-
-        if number_of_followers == 0:
-            is_following = False
-        else:                
-            for follower in followers:
-                if follower == request.user:
-                    is_following = True
-                    break
-                else:
-                    is_following = False
+        number_of_followers = stats.followers_count
+        number_of_following = stats.following_count
+        number_of_posts = stats.posts_count
+        is_following = request.user.is_authenticated and profile.followers.filter(pk=request.user.pk).exists()
 
+        cursor, direction = get_cursor(request)
         try:
-            posts = Post.get_post_data("filter", profile.user)
+            posts = Post.get_post_data("filter", user, cursor=cursor, direction=direction, page_size=get_page_size())
         except:
-            post = None
+            posts = None
             return render(request, "social/error_page.html")
 
         context = {
@@ -240,15 +330,185 @@ class ProfileView(View):
             'user': user,
             'posts': posts,
             'number_of_followers': number_of_followers,
+            'number_of_following': number_of_following,
+            'number_of_posts': number_of_posts,
             'is_following': is_following
         }
 
         return render(request, 'social/profile.html', context)
 
+class SearchView(View):
+    """
+    Any user can search the posts/tweets and their comments, best and latest matches first
+    """
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        posts, has_next = search_posts(query, page=page, page_size=get_page_size())
+
+        context = {
+            'query': query,
+            'post_list': posts,
+            'page': page,
+            'has_next': has_next,
+        }
+        return render(request, 'social/search.html', context)
+
+# Async versions of the read-only pages, for ASGI deployments (twitter_clone/asgi.py)
+# The independent queries of a page are awaited together with asyncio.gather(), but that doesn't make them
+# concurrent: in Django 4.1 every async ORM call is sync_to_async(thread_sensitive=True), so they run one
+# after another on the single shared sync thread. What these views save is a worker thread per request,
+# the event loop stays free while the queries wait on the database.
+async def aload_user(request):
+    # request.user is read lazily from the session, which can't be done from async code
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+async def arender(request, template_name, context=None):
+    return await sync_to_async(render)(request, template_name, context)
+
+
+class AsyncPostListView(View):
+    """
+    Async PostListView.get(), writing a post still goes through the latest-post-list form
+    """
+    async def get(self, request, *args, **kwargs):
+        cursor, direction = get_cursor(request)
+        try:
+            user, posts = await asyncio.gather(
+                aload_user(request),
+                Post.aget_post_data("all", cursor=cursor, direction=direction, page_size=get_page_size()),
+            )
+        except:
+            return await arender(request, "social/error_page.html")
+
+        context = {
+            'post_list': posts,
+            'reactions': await Reaction.aget_user_reactions(user, [post.pk for post in posts]),
+            'form': PostForm(),
+            'live_url': None if posts.has_newer else LIVE_PATH,
+        }
+        return await arender(request, 'social/post_list.html', context)
+
+
+class AsyncPostDetailView(View):
+    """
+    Async PostDetailView.get(), the post and its comments are fetched in one gather()
+    """
+    async def get(self, request, pk, *args, **kwargs):
+        try:
+            user, post, comments = await asyncio.gather(
+                aload_user(request),
+                Post.aget_post_data("get", pk),
+                Comment.aget_comment_page(pk, cursor=request.GET.get('before')),
+            )
+        except Post.DoesNotExist:
+            return await arender(request, "social/error_page.html")
+
+        context = {
+            'post': post,
+            'form': CommentForm(),
+            'comments': comments,
+        }
+        return await arender(request, 'social/post_detail.html', context)
+
+
+class AsyncProfileView(View):
+    """
+    Async ProfileView.get(), the follow check and the page of posts are fetched in one gather()
+    """
+    async def get(self, request, pk, *args, **kwargs):
+        try:
+            viewer, profile = await asyncio.gather(aload_user(request), UserProfile.objects.select_related('user__stats').aget(pk=pk))
+        except UserProfile.DoesNotExist:
+            return await arender(request, "social/error_page.html")
+        user = profile.user
+        stats = UserStats.get_for(user)
+
+        cursor, direction = get_cursor(request)
+        queries = [Post.aget_post_data("filter", user, cursor=cursor, direction=direction, page_size=get_page_size())]
+        if viewer.is_authenticated:
+            queries.append(profile.followers.filter(pk=viewer.pk).aexists())
+        try:
+            posts, *is_following = await asyncio.gather(*queries)
+        except:
+            return await arender(request, "social/error_page.html")
+
+        context = {
+            'profile': profile,
+            'user': user,
+            'posts': posts,
+            'number_of_followers': stats.followers_count,
+            'number_of_following': stats.following_count,
+            'number_of_posts': stats.posts_count,
+            'is_following': bool(is_following and is_following[0])
+        }
+        return await arender(request, 'social/profile.html', context)
+
+class TagView(View):
+    """
+    Any user can see the posts/tweets with a hashtag, latest first
+    Served from the PostTag index with keyset pagination, the post bodies are never searched
+    """
+    def get(self, request, name, *args, **kwargs):
+        cursor, direction = get_cursor(request)
+        posts = Post.paginate_entries(PostTag.objects.filter(tag__name=name.lower()), cursor=cursor, direction=direction, page_size=get_page_size())
+
+        context = {
+            'title': '#' + name.lower(),
+            'post_list': posts,
+            'reactions': Reaction.get_user_reactions(request.user, [post.pk for post in posts]),
+        }
+        return render(request, 'social/tagged_posts.html', context)
+
+class MentionsView(View):
+    """
+    Any user can see the posts/tweets mentioning a user, latest first
+    """
+    def get(self, request, username, *args, **kwargs):
+        cursor, direction = get_cursor(request)
+        posts = Post.paginate_entries(Mention.objects.filter(user__username=username), cursor=cursor, direction=direction, page_size=get_page_size())
+
+        context = {
+            'title': '@' + username,
+            'post_list': posts,
+            'reactions': Reaction.get_user_reactions(request.user, [post.pk for post in posts]),
+        }
+        return render(request, 'social/tagged_posts.html', context)
+
+class HotPostListView(View):
+    """
+    Any user can see the hot posts/tweets: the most liked/commented lately, see social/ranking.py
+    The score is stored on the post, so a page is a range scan of the (hot_score, id) index
+    """
+    def get(self, request, *args, **kwargs):
+        cursor, direction = get_cursor(request)
+        posts = Post.get_post_data("hot", cursor=cursor, direction=direction, page_size=get_page_size())
+
+        context = {
+            'title': 'Hot posts',
+            'post_list': posts,
+            'reactions': Reaction.get_user_reactions(request.user, [post.pk for post in posts]),
+        }
+        return render(request, 'social/tagged_posts.html', context)
+
 # If post/comment doesn't exists
 def error_view(request):
     return render(request, "social/error_page.html")
 
+# Request timings collected by RequestTimingMiddleware (staff only)
+def request_metrics(request):
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    if request.GET.get('reset'):
+        request_stats.clear()
+    return JsonResponse(request_stats.summary())
+
 # To edit the profile
 class ProfileEditView(LoginRequiredMixin, UpdateView):
     model = UserProfile
@@ -260,6 +520,16 @@ class ProfileEditView(LoginRequiredMixin, UpdateView):
         pk = self.kwargs["pk"]
         return reverse_lazy('profile', kwargs={'pk': pk})
 
+    def form_valid(self, form):
+        if 'picture' in form.changed_data:
+            form.instance.picture_hash = '' # show the original until the new avatars are ready
+        response = super().form_valid(form)
+        touch([profile_stamp(self.object.pk)])
+        if 'picture' in form.changed_data:
+            UserProfile.bump_version(self.object.pk) # post cards show the avatar
+            schedule_profile_picture(self.object.pk)
+        return response
+
     def get(self, request, *args, **kwargs):
         """
         Will check whether current logged in user is the same as Profile User
@@ -281,6 +551,7 @@ class AddFollower(LoginRequiredMixin, View):
     def post(self, request, pk, *args, **kwargs):
         profile = UserProfile.objects.get(pk=pk)
         profile.followers.add(request.user) # adding logged-in user to the list of followers by using ".add()"
+        enqueue('sync_timeline', owner_pk=request.user.pk, author_pk=profile.pk)
         return redirect('profile', pk=profile.pk)
 
 
@@ -288,69 +559,104 @@ class RemoveFollower(LoginRequiredMixin, View):
     def post(self, request, pk, *args, **kwargs):
         profile = UserProfile.objects.get(pk=pk)
         profile.followers.remove(request.user) # remove from followers list
+        enqueue('sync_timeline', owner_pk=request.user.pk, author_pk=profile.pk)
         return redirect('profile', pk=profile.pk)
 
+def redirect_next(request, default='/latest-posts/'):
+    # back to the page of the form, never to another site
+    next = request.POST.get('next', default)
+    if not url_has_allowed_host_and_scheme(next, allowed_hosts={request.get_host()}, require_https=request.is_secure()):
+        next = default
+    return HttpResponseRedirect(next)
+
 class AddLike(LoginRequiredMixin, View):
     """
-    When clicking on LIKE button
+    When clicking on LIKE button (a POST: it changes the reactions)
     If user has not liked the post already then add a like else remove a like
     If user has disliked the post already then remove the dislike and add a like
     """    
-    def get(self, request, pk, *args, **kwargs):
-        post = Post.get_post_data("get", pk)
-        # post = Post.objects.get(pk=pk)
-
-        is_disike = False 
-        for dislike in post.dislikes.all():
-            if dislike == request.user:
-                is_disike = True
-                break
-        if is_disike:
-            post.dislikes.remove(request.user) # if disliked the post already then remove the dislike
-
-        post_likes = post.likes.all()
-        is_like = False 
-        for like in post_likes:
-            if like == request.user:
-                is_like = True
-                break
-        if not is_like:
-            post.likes.add(request.user) # if not liked then add a like
-        if is_like:
-            post.likes.remove(request.user) # if liked then remove a like 
-        
-        next = request.POST.get('next', '/latest-posts/')
-        return HttpResponseRedirect(next)
+    def post(self, request, pk, *args, **kwargs):
+        post = get_object_or_404(Post.objects.using(sharding.post_db(pk)).only('pk'), pk=pk)
+        Reaction.toggle(post.pk, request.user, Reaction.LIKE)
+        return redirect_next(request)
         
 class AddDisLike(LoginRequiredMixin, View):
     """
-    When clicking on DISLIKE button
+    When clicking on DISLIKE button (a POST: it changes the reactions)
     If user has not disliked the post already then add a dislike else remove a dislike
     If user has liked the post already then remove the like and add a dislike 
     """
-    def get(self, request, pk, *args, **kwargs):
-        post = Post.get_post_data("get", pk)
-
-        is_like = False 
-        for like in post.likes.all():
-            if like == request.user:
-                is_like = True
-                break
-        if is_like:
-            post.likes.remove(request.user)# if user liked the post already then remove the like
-
-        post_dislikes = post.dislikes.all()
-        is_dislike = False 
-        for dislike in post_dislikes:
-            if dislike == request.user:
-                is_dislike = True
-                break
-        if not is_dislike:
-            post.dislikes.add(request.user) # if not disliked then add a dislike
-        if is_dislike:
-            post.dislikes.remove(request.user) # if disliked then remove a dislike
-        
-        next = request.POST.get('next', '/latest-posts/')
-        return HttpResponseRedirect(next)
+    def post(self, request, pk, *args, **kwargs):
+        post = get_object_or_404(Post.objects.using(sharding.post_db(pk)).only('pk'), pk=pk)
+        Reaction.toggle(post.pk, request.user, Reaction.DISLIKE)
+        return redirect_next(request)
+
+
+# JSON API used by the like/dislike and follow buttons, one small request instead of a redirect and a full page render
+# The buttons stay plain forms and fall back to the views above when JavaScript or a request fails
+class JsonLoginRequiredMixin:
+    """
+    Like LoginRequiredMixin, but answers 401 JSON instead of redirecting to the login page
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Login required'}, status=401)
+        return super().dispatch(request, *args, **kwargs)
+
+
+def reaction_response(pk, reaction):
+    counts = Reaction.get_counts(pk)
+    return JsonResponse({'post': pk, 'reaction': reaction, **counts})
+
+
+class ReactApiView(JsonLoginRequiredMixin, View):
+    """
+    POST value=like|dislike -> {"post", "reaction", "likes_count", "dislikes_count"}
+    """
+    def post(self, request, pk, *args, **kwargs):
+        names = {name: value for value, name in Reaction.NAMES.items()}
+        value = names.get(request.POST.get('value'))
+        if value is None:
+            return JsonResponse({'error': 'value must be "like" or "dislike"'}, status=400)
+        if not Post.objects.using(sharding.post_db(pk)).filter(pk=pk).exists():
+            return JsonResponse({'error': 'Post not found'}, status=404)
+        Reaction.set(pk, request.user, value)
+        return reaction_response(pk, Reaction.NAMES[value])
 
 
+class UnreactApiView(JsonLoginRequiredMixin, View):
+    def post(self, request, pk, *args, **kwargs):
+        if not Post.objects.using(sharding.post_db(pk)).filter(pk=pk).exists():
+            return JsonResponse({'error': 'Post not found'}, status=404)
+        Reaction.clear(pk, request.user)
+        return reaction_response(pk, None)
+
+
+class FollowApiView(JsonLoginRequiredMixin, View):
+    """
+    POST -> {"profile", "following", "followers_count"}, following twice changes nothing
+    """
+    follow = True
+
+    def post(self, request, pk, *args, **kwargs):
+        try:
+            profile = UserProfile.objects.select_related('user').get(pk=pk)
+        except UserProfile.DoesNotExist:
+            return JsonResponse({'error': 'Profile not found'}, status=404)
+        if profile.user == request.user:
+            return JsonResponse({'error': 'You can not follow yourself'}, status=400)
+
+        following = profile.followers.filter(pk=request.user.pk).exists()
+        if self.follow and not following:
+            profile.followers.add(request.user)
+            enqueue('sync_timeline', owner_pk=request.user.pk, author_pk=profile.pk)
+        elif not self.follow and following:
+            profile.followers.remove(request.user)
+            enqueue('sync_timeline', owner_pk=request.user.pk, author_pk=profile.pk)
+
+        followers_count = UserStats.objects.filter(pk=profile.pk).values_list('followers_count', flat=True).first()
+        return JsonResponse({'profile': profile.pk, 'following': self.follow, 'followers_count': followers_count or 0})
+
+
+class UnfollowApiView(FollowApiView):
+    follow = False
@@ -2,6 +2,8 @@
 ASGI config for twitter_clone project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The live updates of the latest posts page (social/live.py) are served here directly,
+every other request goes through Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "twitter_clone.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from social.live import LIVE_PATH, latest_posts_events # imported once Django is set up
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == LIVE_PATH:
+        await latest_posts_events(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
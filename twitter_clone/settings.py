@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -26,6 +27,8 @@ SECRET_KEY = "nothing here"
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+TESTING = sys.argv[1:2] == ['test'] # manage.py test
+
 ALLOWED_HOSTS = []
 
 
@@ -63,6 +66,8 @@ SITE_ID = 1
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "social.middleware.RequestTimingMiddleware",
+    "social.routers.ReadReplicaMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -103,6 +108,61 @@ DATABASES = {
     }
 }
 
+# Read replica (social/routers.py): the read-heavy pages read from SOCIAL_READ_REPLICA, writes go to "default"
+# Locally the replica is a copy of db.sqlite3 refreshed by "manage.py sync_replica --interval 5"
+SOCIAL_REPLICA_PATH = os.environ.get('SOCIAL_REPLICA_PATH')
+if SOCIAL_REPLICA_PATH or TESTING: # the tests turn the replica on with override_settings(SOCIAL_READ_REPLICA="replica")
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": SOCIAL_REPLICA_PATH or BASE_DIR / "replica.sqlite3",
+        "TEST": {"MIRROR": "default"},
+    }
+SOCIAL_READ_REPLICA = "replica" if SOCIAL_REPLICA_PATH else None
+SOCIAL_REPLICA_URL_NAMES = ['latest-post-list', 'post-detail', 'profile', 'my-post-list'] # GET requests only
+SOCIAL_REPLICA_STICKY_SECONDS = 15 # reads stay on the primary this long after a write, must exceed the replication lag
+
+# Sharded posts (social/sharding.py): posts, comments and reactions are stored on the shard of their author
+# Locally the shards are SQLite files, SOCIAL_SHARD_PATHS="shard0.sqlite3:shard1.sqlite3" adds "shard0", "shard1"...
+# then "manage.py migrate --database shardN" for each one and "manage.py reshard_posts" move the posts there
+# The test runs always have two shards, the sharding tests turn them on with override_settings(SOCIAL_POST_SHARDS=[...])
+SOCIAL_SHARD_PATHS = [path for path in os.environ.get('SOCIAL_SHARD_PATHS', '').split(os.pathsep) if path]
+if TESTING and not SOCIAL_SHARD_PATHS:
+    SOCIAL_SHARD_DATABASES = ["shard0", "shard1"]
+    SOCIAL_POST_SHARDS = [] # no sharding
+else:
+    SOCIAL_SHARD_DATABASES = ["shard%d" % index for index in range(len(SOCIAL_SHARD_PATHS))]
+    SOCIAL_POST_SHARDS = SOCIAL_SHARD_DATABASES # empty: no sharding
+DATABASES.update({
+    alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": SOCIAL_SHARD_PATHS[index] if SOCIAL_SHARD_PATHS else BASE_DIR / ("%s.sqlite3" % alias)}
+    for index, alias in enumerate(SOCIAL_SHARD_DATABASES)
+})
+
+DATABASE_ROUTERS = ['social.routers.PostShardRouter', 'social.routers.ReadReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# "post_cards" holds the rendered post cards (social/templatetags/post_cards.py), locmem is a bounded
+# in-process LRU, switch its BACKEND to memcached/redis to share the cards between processes
+# "stamps" holds the last-modified stamps of the pages (social/stamps.py), it must be shared by every
+# process that writes posts (memcached/redis) as soon as there is more than one
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "post_cards": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "post-cards",
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    },
+    "stamps": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "stamps",
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -151,4 +211,75 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 LOGIN_REDIRECT_URL = 'index'
 ACCOUNT_EMAIL_REQUIRED = True
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
\ No newline at end of file
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Social app
+SOCIAL_PAGE_SIZE = 20 # posts per page on the keyset paginated feeds
+SOCIAL_COMMENT_PAGE_SIZE = 20 # comments per page (and per "load more") on the post page
+SOCIAL_FANOUT_LIMIT = 10000 # authors with more followers are read on demand instead of copied into every home timeline
+SOCIAL_TIMELINE_BACKFILL = 100 # latest posts copied into a home timeline when following someone
+
+# Request timing (social.middleware.RequestTimingMiddleware)
+SOCIAL_TIMING_WINDOW = 1000 # samples kept per url name for /metrics/requests/
+SOCIAL_QUERY_BUDGETS = {
+    'latest-post-list': 6,
+    'hot-post-list': 6,
+    'my-post-list': 6,
+    'home-timeline': 8,
+    'profile': 10,
+    'async-latest-post-list': 6,
+    'async-profile': 10,
+}
+SOCIAL_QUERY_BUDGET_STRICT = os.environ.get('SOCIAL_QUERY_BUDGET_STRICT') == '1' # fail requests over budget (tests/CI)
+
+SOCIAL_SEARCH_RECENCY_DAYS = 30 # a search match this many days old ranks half as high as a brand new one
+
+# Trending hashtags (social/tags.py)
+SOCIAL_TRENDING_WINDOW_HOURS = 24 # hourly tag counters older than this are ignored, "prune_tag_buckets" deletes them
+SOCIAL_TRENDING_HALF_LIFE_HOURS = 6 # a use this many hours old counts half as much as a new one
+SOCIAL_TRENDING_TIMEOUT = 60 # seconds the trending tags are cached
+
+# Write-behind likes/dislikes (social/reaction_queue.py): clicks are queued in a side file and applied in batches
+SOCIAL_REACTION_WRITE_BEHIND = os.environ.get('SOCIAL_REACTION_WRITE_BEHIND') == '1'
+SOCIAL_REACTION_QUEUE_PATH = BASE_DIR / 'reaction_queue.sqlite3'
+SOCIAL_REACTION_FLUSH_INTERVAL = 0.2 # seconds the flusher waits when the queue is empty
+SOCIAL_REACTION_FLUSH_BATCH = 1000 # queued clicks applied per transaction
+SOCIAL_REACTION_FLUSH_LEASE = 60 # seconds before the batch of a flusher that died is applied again
+SOCIAL_REACTION_FLUSH_THREAD = True # False when "flush_reactions --watch" runs as its own process
+
+# Hot posts ranking (social/ranking.py), "rescore_hot_posts" must run after changing these
+SOCIAL_HOT_HALF_LIFE_HOURS = 12 # a post needs twice the points to rank like one this many hours younger
+SOCIAL_HOT_COMMENT_WEIGHT = 2 # points of a comment, a like is 1 and a dislike -1
+
+# Background jobs (social/jobs.py), run by "manage.py run_jobs" unless SOCIAL_JOBS_INLINE
+# Inline (the default) runs the jobs in the request after the commit, nothing else to start
+# SOCIAL_JOBS_INLINE=0 queues them instead: "run_jobs" must then keep running, see README.md
+SOCIAL_JOBS_INLINE = os.environ.get('SOCIAL_JOBS_INLINE', '1') == '1'
+SOCIAL_JOB_WORKERS = 2 # processes started by run_jobs
+SOCIAL_JOB_POLL_INTERVAL = 1.0 # seconds an idle worker waits before looking for jobs again
+SOCIAL_JOB_LEASE = 600 # seconds a claimed job may run before another worker takes it over
+SOCIAL_JOB_MAX_ATTEMPTS = 5
+SOCIAL_JOB_BACKOFF = 5 # seconds before the first retry, doubled after every failure
+SOCIAL_JOB_MAX_BACKOFF = 3600
+SOCIAL_JOB_KEEP_DAYS = 7 # finished jobs are deleted after this many days
+SOCIAL_PURGE_BATCH = 500 # rows deleted per statement when purging a deleted post ("purge_post" job, "purge_deleted_posts")
+
+# Live "N new posts" of the latest posts page (social/live.py, served by twitter_clone/asgi.py)
+SOCIAL_LIVE_MAX_COUNT = 99 # shown as "99+" beyond this
+SOCIAL_LIVE_HEARTBEAT = 15 # seconds between keep-alive comments of an idle event stream
+
+# Post cards fragment cache (social/templatetags/post_cards.py)
+SOCIAL_POST_CARD_CACHE = 'post_cards' # CACHES alias of the post card fragment cache
+SOCIAL_POST_CARD_TIMEOUT = 3600
+
+# Conditional GET of the post, profile and latest posts pages (social/stamps.py)
+SOCIAL_STAMP_CACHE = 'stamps' # CACHES alias of the last-modified stamps
+
+# Profile picture avatars (social/images.py)
+SOCIAL_AVATAR_SIZES = [48, 100, 200] # square WebP avatars generated for every profile picture
+SOCIAL_AVATAR_QUALITY = 80
+SOCIAL_IMAGE_WORKERS = 2 # threads processing new uploads off the request
+
+# Media files (social/media.py), content-hashed avatars are always cached for a year
+SOCIAL_MEDIA_MAX_AGE = 3600 # Cache-Control max-age of the other uploads
+SOCIAL_MEDIA_ACCEL_REDIRECT = None # internal nginx location of MEDIA_ROOT (e.g. '/protected-media/') to let nginx send the files